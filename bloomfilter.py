@@ -30,6 +30,14 @@ from binascii import hexlify, unhexlify
 from .logger import get_logger
 logger = get_logger(__name__)
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the number of bits that are set in each possible byte value, used to count the bits in a filter
+_BITS_SET = tuple(bin(i).count("1") for i in xrange(256))
+
 
 class BloomFilter(object):
 
@@ -64,6 +72,14 @@ class BloomFilter(object):
       storage = (original.bytes, original.functions, original.prefix)
       # storage can be written to disk, socket, etc
       clone = BloomFilter(storage[0], storage[1], storage[2])
+
+    The bits are stored in a bytearray where bit N is found in byte N / 8 at position N % 8.  This is
+    the same layout that is used by the bytes property, hence (de)serialisation is a plain copy.
+
+    Multiple keys can be processed in bulk using get_positions, add_positions, and
+    contains_positions.  Each key is hashed only once and the resulting positions can be applied to
+    every BloomFilter with the same size, functions, and prefix.  When NumPy is available the
+    positions are kept in an array and all k bits for all keys are set or tested in a single pass.
     """
 
     @staticmethod
@@ -84,7 +100,7 @@ class BloomFilter(object):
             prefix = kargs.get("prefix", args[2] if len(args) >= 3 else "")
             assert 0 < len(bytes_), len(bytes_)
             logger.debug("bloom filter based on %d bytes and k_functions %d", len(bytes_), k_functions)
-            filter_ = long(hexlify(bytes_[::-1]), 16)
+            filter_ = bytearray(bytes_)
 
         # matches: BloomFilter(int:m_size, float:f_error_rate, str:prefix="")
         elif len(args) >= 2 and isinstance(args[0], int) and isinstance(args[1], float):
@@ -96,7 +112,7 @@ class BloomFilter(object):
             assert 0.0 < f_error_rate < 1.0, f_error_rate
             logger.debug("constructing bloom filter based on m_size %d bits and f_error_rate %f", m_size, f_error_rate)
             k_functions = cls._get_k_functions(m_size, cls._get_n_capacity(m_size, f_error_rate))
-            filter_ = 0
+            filter_ = bytearray(m_size / 8)
 
         # matches: BloomFilter(float:f_error_rate, int:n_capacity, str:prefix="")
         elif len(args) >= 2 and isinstance(args[0], float) and isinstance(args[1], int):
@@ -109,7 +125,7 @@ class BloomFilter(object):
                          n_capacity)
             m_size = int(ceil(abs((n_capacity * log(f_error_rate)) / (log(2) ** 2)) / 8.0) * 8)
             k_functions = cls._get_k_functions(m_size, n_capacity)
-            filter_ = 0
+            filter_ = bytearray(m_size / 8)
 
         else:
             raise RuntimeError("Unknown combination of argument types %s" % str([type(arg) for arg in args]))
@@ -127,14 +143,15 @@ class BloomFilter(object):
         assert 0 < self._k_functions <= self._m_size, [self._k_functions, self._m_size]
         assert isinstance(self._prefix, str), type(self._prefix)
         assert 0 <= len(self._prefix) < 256, len(self._prefix)
-        assert isinstance(self._filter, (int, long)), type(self._filter)
+        assert isinstance(self._filter, bytearray), type(self._filter)
+        assert len(self._filter) * 8 == self._m_size, [len(self._filter), self._m_size]
 
         if __debug__:
             hypothetical_error_rates = [0.4, 0.3, 0.2, 0.1, 0.01, 0.001, 0.0001]
             logger.debug("m size:      %d    ~%d bytes", self._m_size, self._m_size / 8)
             logger.debug("k functions: %d", self._k_functions)
             logger.debug("prefix:      %s", self._prefix.encode("HEX"))
-            logger.debug("filter:      %s", self._filter)
+            logger.debug("filter:      %s", hexlify(self._filter))
             logger.debug("hypothetical error rate: %s", " | ".join("%.4f" % hypothetical_error_rate
                                                                    for hypothetical_error_rate
                                                                    in hypothetical_error_rates))
@@ -171,16 +188,21 @@ class BloomFilter(object):
                                            "x" * (hashfn().digest_size - bits_required / 8)))).unpack
         self._salt = hashfn(self._prefix)
 
+        # the bulk api interprets the concatenated digests as a (keys, digest_size / chunk_size) matrix
+        self._chunks_per_digest = hashfn().digest_size / chunk_size
+        self._numpy_dtype = numpy.dtype(">u%d" % chunk_size) if numpy else None
+
     def add(self, key):
         """
         Add KEY to the BloomFilter.
         """
         filter_ = self._filter
+        m_size = self._m_size
         hash_ = self._salt.copy()
         hash_.update(key)
         for pos in self._fmt_unpack(hash_.digest()):
-            filter_ |= 1 << (pos % self._m_size)
-        self._filter = filter_
+            pos %= m_size
+            filter_[pos >> 3] |= 1 << (pos & 7)
 
     def add_keys(self, keys):
         """
@@ -200,15 +222,30 @@ class BloomFilter(object):
             # while generators are more memory efficient, this list will be relatively short.
             # 07/05/12 Niels: using no list at all is even more efficient/faster
             for pos in fmt_unpack(hash_.digest()):
-                filter_ |= 1 << (pos % m_size)
+                pos %= m_size
+                filter_[pos >> 3] |= 1 << (pos & 7)
 
-        self._filter = filter_
+    def add_bloom_filter(self, other):
+        """
+        Add all keys in the OTHER BloomFilter, that must have the same size, functions, and prefix.
+        """
+        assert isinstance(other, BloomFilter), type(other)
+        assert self._m_size == other._m_size, [self._m_size, other._m_size]
+        assert self._k_functions == other._k_functions, [self._k_functions, other._k_functions]
+        assert self._prefix == other._prefix, [self._prefix, other._prefix]
+        if numpy:
+            filter_ = numpy.frombuffer(self._filter, dtype=numpy.uint8)
+            numpy.bitwise_or(filter_, numpy.frombuffer(other._filter, dtype=numpy.uint8), out=filter_)
+
+        else:
+            filter_ = long(hexlify(self._filter), 16) | long(hexlify(other._filter), 16)
+            self._filter = bytearray(unhexlify("%0*x" % (self._m_size / 4, filter_)))
 
     def clear(self):
         """
         Set all bits in the filter to zero.
         """
-        self._filter = 0
+        self._filter = bytearray(self._m_size / 8)
 
     def __contains__(self, key):
         filter_ = self._filter
@@ -218,7 +255,8 @@ class BloomFilter(object):
         hash_.update(key)
 
         for pos in self._fmt_unpack(hash_.digest()):
-            if not filter_ & (1 << (pos % m_size_)):
+            pos %= m_size_
+            if not filter_[pos >> 3] & (1 << (pos & 7)):
                 return False
         return True
 
@@ -243,10 +281,83 @@ class BloomFilter(object):
             # while generators are more memory efficient, this list will be relatively short.
             # 07/05/12 Niels: using no list at all is even more efficient/faster
             for pos in fmt_unpack(hash_.digest()):
-                if not filter_ & (1 << (pos % m_size)):
+                pos %= m_size
+                if not filter_[pos >> 3] & (1 << (pos & 7)):
                     yield tup
                     break
 
+    def get_positions(self, keys):
+        """
+        Returns the bit positions for a sequence of KEYS.
+
+        Every key is hashed exactly once.  The result can be given to add_positions and
+        contains_positions of this BloomFilter, or of any other BloomFilter with the same size,
+        functions, and prefix.
+
+        When NumPy is available this returns an array with one row of k positions for each key,
+        otherwise it returns a list with a tuple of k positions for each key.
+        """
+        salt_copy = self._salt.copy
+        m_size = self._m_size
+
+        if numpy:
+            digests = []
+            for key in keys:
+                assert isinstance(key, str)
+                hash_ = salt_copy()
+                hash_.update(key)
+                digests.append(hash_.digest())
+
+            positions = numpy.frombuffer("".join(digests), dtype=self._numpy_dtype)
+            positions = positions.reshape(len(digests), self._chunks_per_digest)[:, :self._k_functions]
+            # uint64 % int results in a float64 array, hence the explicit uint64 modulo
+            return (positions.astype(numpy.uint64) % numpy.uint64(m_size)).astype(numpy.int64)
+
+        else:
+            fmt_unpack = self._fmt_unpack
+            positions = []
+            for key in keys:
+                assert isinstance(key, str)
+                hash_ = salt_copy()
+                hash_.update(key)
+                positions.append(tuple(pos % m_size for pos in fmt_unpack(hash_.digest())))
+            return positions
+
+    def add_positions(self, positions):
+        """
+        Set the bits for POSITIONS, as returned by get_positions, in the BloomFilter.
+        """
+        if numpy and isinstance(positions, numpy.ndarray):
+            assert positions.ndim == 2 and positions.shape[1] == self._k_functions, positions.shape
+            positions = positions.ravel()
+            numpy.bitwise_or.at(numpy.frombuffer(self._filter, dtype=numpy.uint8),
+                                positions >> 3,
+                                numpy.left_shift(1, positions & 7).astype(numpy.uint8))
+
+        else:
+            filter_ = self._filter
+            for key_positions in positions:
+                assert len(key_positions) == self._k_functions, len(key_positions)
+                for pos in key_positions:
+                    filter_[pos >> 3] |= 1 << (pos & 7)
+
+    def contains_positions(self, positions):
+        """
+        Returns a list of booleans, one for each row in POSITIONS as returned by get_positions,
+        where True indicates that the key is (probably) in the BloomFilter.
+        @rtype: [bool]
+        """
+        if numpy and isinstance(positions, numpy.ndarray):
+            assert positions.ndim == 2 and positions.shape[1] == self._k_functions, positions.shape
+            filter_ = numpy.frombuffer(self._filter, dtype=numpy.uint8)
+            return ((filter_[positions >> 3] & numpy.left_shift(1, positions & 7)) != 0).all(axis=1).tolist()
+
+        else:
+            filter_ = self._filter
+            return [all(filter_[pos >> 3] & (1 << (pos & 7)) for pos in key_positions)
+                    for key_positions
+                    in positions]
+
     def get_capacity(self, f_error_rate):
         """
         Returns the capacity given a certain error rate.
@@ -271,7 +382,7 @@ class BloomFilter(object):
         The number of bits in the bloom filter that are set.
         @rtype: int
         """
-        return sum(1 if self._filter & (1 << i) else 0 for i in range(self._m_size))
+        return sum(_BITS_SET[byte] for byte in self._filter)
 
     @property
     def size(self):
@@ -303,7 +414,4 @@ class BloomFilter(object):
         bytes as well as the number of functions are required.
         @rtype: string
         """
-        # hex should be m_size/4, hex is 16 instead of 8 -> hence half the number of "hexes" in m_size
-        hex_ = '%x' % self._filter
-        padding = '0' * (self._m_size /4 - len(hex_))
-        return unhexlify(padding + hex_)[::-1]
+        return str(self._filter)
@@ -1,3 +1,5 @@
+from weakref import WeakValueDictionary
+
 from .logger import get_logger
 logger = get_logger(__name__)
 
@@ -32,13 +34,30 @@ assert isinstance(CANDIDATE_INTRO_LIFETIME, float)
 assert isinstance(CANDIDATE_LIFETIME, float)
 
 
+def intern_address(address, *others):
+    """
+    Returns ADDRESS with an interned host.  When ADDRESS equals one of OTHERS that tuple is returned
+    instead, hence candidates whose addresses are the same share a single tuple.
+    """
+    for other in others:
+        if address == other:
+            return other
+    host = intern(address[0])
+    return address if host is address[0] else (host, address[1])
+
+
 class Candidate(object):
 
+    # trackers keep hundreds of thousands of candidates, hence these do not have a __dict__
+    __slots__ = ["_sock_addr", "_tunnel", "_hash"]
+
     def __init__(self, sock_addr, tunnel):
         assert is_address(sock_addr), sock_addr
         assert isinstance(tunnel, bool), type(tunnel)
-        self._sock_addr = sock_addr
+        self._sock_addr = intern_address(sock_addr)
         self._tunnel = tunnel
+        # candidates are looked up in dictionaries and sets all the time
+        self._hash = hash(self._sock_addr)
 
     @property
     def sock_addr(self):
@@ -66,7 +85,102 @@ class Candidate(object):
         return not (isinstance(other, Candidate) and self._sock_addr == other.sock_addr)
 
     def __hash__(self):
-        return hash(str(self._sock_addr))
+        return self._hash
+
+class CandidateAddress(object):
+
+    """
+    The LAN address, WAN address, and connection type of the peer at SOCK_ADDR.
+
+    A peer that is in many communities is a WalkCandidate in each of them.  These WalkCandidates
+    share one CandidateAddress, obtained from the CandidateRegistry, hence its addresses are stored
+    and updated once.
+    """
+
+    __slots__ = ["_sock_addr", "_lan_address", "_wan_address", "_connection_type", "__weakref__"]
+
+    def __init__(self, sock_addr, lan_address, wan_address, connection_type):
+        assert is_address(sock_addr), sock_addr
+        assert is_address(lan_address)
+        assert is_address(wan_address)
+        assert isinstance(connection_type, unicode) and connection_type in (u"unknown", u"public", u"symmetric-NAT")
+        super(CandidateAddress, self).__init__()
+        self._sock_addr = intern_address(sock_addr)
+        self._lan_address = intern_address(lan_address, self._sock_addr)
+        self._wan_address = intern_address(wan_address, self._sock_addr, self._lan_address)
+        self._connection_type = connection_type
+
+    @property
+    def sock_addr(self):
+        return self._sock_addr
+
+    @property
+    def lan_address(self):
+        return self._lan_address
+
+    @property
+    def wan_address(self):
+        return self._wan_address
+
+    @property
+    def connection_type(self):
+        return self._connection_type
+
+    def update(self, lan_address, wan_address, connection_type):
+        assert lan_address == ("0.0.0.0", 0) or is_address(lan_address), lan_address
+        assert wan_address == ("0.0.0.0", 0) or is_address(wan_address), wan_address
+        assert isinstance(connection_type, unicode), type(connection_type)
+        assert connection_type in (u"unknown", u"public", "symmetric-NAT"), connection_type
+        if lan_address != ("0.0.0.0", 0):
+            self._lan_address = intern_address(lan_address, self._sock_addr, self._lan_address)
+        if wan_address != ("0.0.0.0", 0):
+            self._wan_address = intern_address(wan_address, self._sock_addr, self._lan_address, self._wan_address)
+        # someone can also reset from a known connection_type to unknown (i.e. it now believes it is
+        # no longer public nor symmetric NAT)
+        self._connection_type = u"public" if connection_type == u"unknown" and lan_address == wan_address else connection_type
+
+        if __debug__:
+            if not (self._sock_addr == self._lan_address or self._sock_addr == self._wan_address):
+                logger.error("Either LAN %s or the WAN %s should be SOCK_ADDR %s", self._lan_address, self._wan_address, self._sock_addr)
+
+
+class CandidateRegistry(object):
+
+    """
+    The CandidateAddress instances of all communities, keyed by SOCK_ADDR.
+
+    Only CandidateAddress instances that are used by at least one WalkCandidate are kept.
+    """
+
+    def __init__(self):
+        super(CandidateRegistry, self).__init__()
+        # SOCK_ADDR:CandidateAddress dictionary
+        self._addresses = WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def __contains__(self, sock_addr):
+        return sock_addr in self._addresses
+
+    def get(self, sock_addr):
+        """
+        Returns the CandidateAddress for SOCK_ADDR or None.
+        """
+        return self._addresses.get(sock_addr)
+
+    def get_or_create(self, sock_addr, lan_address, wan_address, connection_type):
+        """
+        Returns the CandidateAddress for SOCK_ADDR.  An existing CandidateAddress is updated with
+        LAN_ADDRESS, WAN_ADDRESS, and CONNECTION_TYPE, otherwise a new one is created.
+        """
+        address = self._addresses.get(sock_addr)
+        if address is None:
+            address = self._addresses[sock_addr] = CandidateAddress(sock_addr, lan_address, wan_address, connection_type)
+        else:
+            address.update(lan_address, wan_address, connection_type)
+        return address
+
 
 class WalkCandidate(Candidate):
 
@@ -87,20 +201,33 @@ class WalkCandidate(Candidate):
       after the introduction-response message (talking about the candidate) was received.
     """
 
-    def __init__(self, sock_addr, tunnel, lan_address, wan_address, connection_type):
+    __slots__ = ["_address", "_associations", "_last_walk_reply", "_last_walk", "_last_stumble", "_last_intro",
+                 "_global_time", "_index"]
+
+    def __init__(self, sock_addr, tunnel, lan_address, wan_address, connection_type, address=None):
+        """
+        Create a WalkCandidate.  When ADDRESS, a CandidateAddress from the CandidateRegistry, is
+        given it is shared with the candidates for SOCK_ADDR in other communities, otherwise the
+        addresses belong to this candidate alone.
+        """
         assert is_address(sock_addr), sock_addr
         assert isinstance(tunnel, bool), type(tunnel)
         assert is_address(lan_address)
         assert is_address(wan_address)
         assert isinstance(connection_type, unicode) and connection_type in (u"unknown", u"public", u"symmetric-NAT")
+        assert address is None or isinstance(address, CandidateAddress), type(address)
+        assert address is None or address.sock_addr == sock_addr, [address.sock_addr, sock_addr]
 
-        super(WalkCandidate, self).__init__(sock_addr, tunnel)
-        self._lan_address = lan_address
-        self._wan_address = wan_address
-        self._connection_type = connection_type
+        if address is None:
+            super(WalkCandidate, self).__init__(sock_addr, tunnel)
+            self._address = CandidateAddress(self._sock_addr, lan_address, wan_address, connection_type)
+        else:
+            super(WalkCandidate, self).__init__(address.sock_addr, tunnel)
+            self._address = address
 
-        # Member instances that this Candidate is associated with
-        self._associations = set()
+        # Member instances that this Candidate is associated with.  A tuple since there is nearly
+        # always only one
+        self._associations = ()
 
         # properties to determine the category
         self._last_walk_reply = 0.0
@@ -111,31 +238,51 @@ class WalkCandidate(Candidate):
         # the highest global time that one of the walks reported from this Candidate
         self._global_time = 0
 
+        # the CandidateIndex that is notified when the timestamps change
+        self._index = None
+
         if __debug__:
-            if not (self.sock_addr == self._lan_address or self.sock_addr == self._wan_address):
-                logger.error("Either LAN %s or the WAN %s should be SOCK_ADDR %s", self._lan_address, self._wan_address, self.sock_addr)
+            if not (self.sock_addr == self.lan_address or self.sock_addr == self.wan_address):
+                logger.error("Either LAN %s or the WAN %s should be SOCK_ADDR %s", self.lan_address, self.wan_address, self.sock_addr)
                 assert False
 
+    @property
+    def address(self):
+        """
+        The CandidateAddress with the LAN address, WAN address, and connection type.
+        """
+        return self._address
+
     @property
     def lan_address(self):
-        return self._lan_address
+        return self._address.lan_address
 
     @property
     def wan_address(self):
-        return self._wan_address
+        return self._address.wan_address
 
     @property
     def connection_type(self):
-        return self._connection_type
+        return self._address.connection_type
+
+    @property
+    def index(self):
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        self._index = index
 
     def merge(self, other):
         assert isinstance(other, WalkCandidate), type(other)
-        self._associations.update(other._associations)
+        self._associations += tuple(member for member in other._associations if not member in self._associations)
         self._last_walk_reply = max(self._last_walk_reply, other._last_walk_reply)
         self._last_walk = max(self._last_walk, other._last_walk)
         self._last_stumble = max(self._last_stumble, other._last_stumble)
         self._last_intro = max(self._last_intro, other._last_intro)
         self._global_time = max(self._global_time, other._global_time)
+        if self._index is not None:
+            self._index.refresh(self)
 
     @property
     def global_time(self):
@@ -151,7 +298,8 @@ class WalkCandidate(Candidate):
         handshake, the member can be associated with the candidate.
         """
         assert isinstance(member, Member)
-        self._associations.add(member)
+        if not member in self._associations:
+            self._associations += (member,)
 
     def is_associated(self, member):
         """
@@ -165,7 +313,10 @@ class WalkCandidate(Candidate):
         Remove the association with a member.
         """
         assert isinstance(member, Member)
-        self._associations.remove(member)
+        if not member in self._associations:
+            raise KeyError(member)
+        index = self._associations.index(member)
+        self._associations = self._associations[:index] + self._associations[index + 1:]
 
     def get_members(self):
         """
@@ -238,12 +389,28 @@ class WalkCandidate(Candidate):
 
         return None
 
+    def get_next_change(self, now):
+        """
+        Returns the first moment after NOW at which get_category or is_eligible_for_walk may return
+        something else, or None when this will not happen unless a timestamp is updated.
+        """
+        moments = [moment
+                   for moment
+                   in (self._last_walk_reply + CANDIDATE_WALK_LIFETIME,
+                       self._last_stumble + CANDIDATE_STUMBLE_LIFETIME,
+                       self._last_intro + CANDIDATE_INTRO_LIFETIME,
+                       self._last_walk + CANDIDATE_ELIGIBLE_DELAY)
+                   if moment > now]
+        return min(moments) if moments else None
+
     def walk(self, now):
         """
         Called when we are about to send an introduction-request to this candidate.
         """
         assert isinstance(now, float), type(now)
         self._last_walk = now
+        if self._index is not None:
+            self._index.refresh(self)
 
     def walk_response(self, now):
         """
@@ -252,6 +419,8 @@ class WalkCandidate(Candidate):
         assert isinstance(now, float), type(now)
         assert now == -1.0 or self._last_walk_reply <= now, self._last_walk_reply
         self._last_walk_reply = now
+        if self._index is not None:
+            self._index.refresh(self)
 
     def stumble(self, now):
         """
@@ -259,6 +428,8 @@ class WalkCandidate(Candidate):
         """
         assert isinstance(now, float), type(now)
         self._last_stumble = now
+        if self._index is not None:
+            self._index.refresh(self)
 
     def intro(self, now):
         """
@@ -266,38 +437,33 @@ class WalkCandidate(Candidate):
         """
         assert isinstance(now, float), type(now)
         self._last_intro = now
+        if self._index is not None:
+            self._index.refresh(self)
 
     def update(self, tunnel, lan_address, wan_address, connection_type):
+        """
+        Update the addresses and connection type.  These are shared with the candidates for
+        SOCK_ADDR in other communities when the CandidateAddress is.
+        """
         assert isinstance(tunnel, bool)
-        assert lan_address == ("0.0.0.0", 0) or is_address(lan_address), lan_address
-        assert wan_address == ("0.0.0.0", 0) or is_address(wan_address), wan_address
-        assert isinstance(connection_type, unicode), type(connection_type)
-        assert connection_type in (u"unknown", u"public", "symmetric-NAT"), connection_type
         self._tunnel = tunnel
-        if lan_address != ("0.0.0.0", 0):
-            self._lan_address = lan_address
-        if wan_address != ("0.0.0.0", 0):
-            self._wan_address = wan_address
-        # someone can also reset from a known connection_type to unknown (i.e. it now believes it is
-        # no longer public nor symmetric NAT)
-        self._connection_type = u"public" if connection_type == u"unknown" and lan_address == wan_address else connection_type
-
-        if __debug__:
-            if not (self.sock_addr == self._lan_address or self.sock_addr == self._wan_address):
-                logger.error("Either LAN %s or the WAN %s should be SOCK_ADDR %s", self._lan_address, self._wan_address, self.sock_addr)
+        self._address.update(lan_address, wan_address, connection_type)
 
     def __str__(self):
-        if self._sock_addr == self._lan_address == self._wan_address:
-            return "{%s:%d}" % self._lan_address
-        elif self._sock_addr in (self._lan_address, self._wan_address):
-            return "{%s:%d %s:%d}" % (self._lan_address[0], self._lan_address[1], self._wan_address[0], self._wan_address[1])
+        lan_address, wan_address = self._address.lan_address, self._address.wan_address
+        if self._sock_addr == lan_address == wan_address:
+            return "{%s:%d}" % lan_address
+        elif self._sock_addr in (lan_address, wan_address):
+            return "{%s:%d %s:%d}" % (lan_address[0], lan_address[1], wan_address[0], wan_address[1])
         else:
             # should not occur
-            return "{%s:%d %s:%d %s:%d}" % (self._sock_addr[0], self._sock_addr[1], self._lan_address[0], self._lan_address[1], self._wan_address[0], self._wan_address[1])
+            return "{%s:%d %s:%d %s:%d}" % (self._sock_addr[0], self._sock_addr[1], lan_address[0], lan_address[1], wan_address[0], wan_address[1])
 
 
 class BootstrapCandidate(WalkCandidate):
 
+    __slots__ = []
+
     def __init__(self, sock_addr, tunnel):
         super(BootstrapCandidate, self).__init__(sock_addr, tunnel, sock_addr, sock_addr, connection_type=u"public")
 
@@ -319,5 +485,7 @@ class BootstrapCandidate(WalkCandidate):
 
 class LoopbackCandidate(Candidate):
 
+    __slots__ = []
+
     def __init__(self):
         super(LoopbackCandidate, self).__init__(("localhost", 0), False)
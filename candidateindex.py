@@ -0,0 +1,281 @@
+"""
+The CandidateIndex holds the WalkCandidates of a community, keyed by their socket address, and
+keeps them grouped by category such that the candidate walker does not need to look at every
+candidate.
+
+A candidate is in the walk, stumble, or intro category, or in none.  Its category only changes when
+one of its timestamps is updated, the candidate then notifies the index, or when one of its
+timestamps expires.  The index keeps a heap with the moment at which each candidate may change and
+processes the expired entries whenever it is used, hence candidates expire lazily.
+
+For each category there is a heap with the candidates that are eligible for a walk, ordered by the
+timestamp that the walker uses to choose between them.  Heap entries are not removed when a
+candidate changes.  Instead each entry carries the version of the candidate at the time it was
+pushed, outdated entries are dropped once they reach the top of the heap.
+"""
+
+from collections import OrderedDict
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import time
+
+from .candidate import WalkCandidate
+from .logger import get_logger
+logger = get_logger(__name__)
+
+CATEGORIES = (u"walk", u"stumble", u"intro")
+
+# a heap is rebuilt without its outdated entries when it holds more than COMPACT_FACTOR entries for
+# each candidate, plus COMPACT_MINIMUM
+COMPACT_FACTOR = 4
+COMPACT_MINIMUM = 64
+
+
+class _Record(object):
+    __slots__ = ["candidate", "sequence", "version", "category"]
+
+    def __init__(self, candidate, sequence):
+        self.candidate = candidate
+        # the order in which the candidates were added to the index
+        self.sequence = sequence
+        # incremented whenever the candidate is filed again, invalidating its heap entries
+        self.version = 0
+        # False until the candidate is filed for the first time
+        self.category = False
+
+
+class Rotation(object):
+
+    """
+    A round robin over the candidates in one or more categories, in the order in which they were
+    added to the index.
+    """
+
+    def __init__(self, index, categories):
+        assert isinstance(index, CandidateIndex), type(index)
+        assert all(category in CATEGORIES for category in categories), categories
+        super(Rotation, self).__init__()
+        self._index = index
+        self._categories = frozenset(categories)
+        # (sequence, sock_addr) heaps with the candidates after and before the current position
+        self._ahead = []
+        self._behind = []
+        self._position = -1
+        # SOCK_ADDR:SEQUENCE dictionary with the candidates that are in either heap
+        self._queued = {}
+
+    @property
+    def categories(self):
+        return self._categories
+
+    def push(self, record):
+        """
+        Called by the index when the candidate of RECORD enters one of our categories.
+        """
+        sock_addr = record.candidate.sock_addr
+        if self._queued.get(sock_addr) != record.sequence:
+            self._queued[sock_addr] = record.sequence
+            heappush(self._ahead if record.sequence > self._position else self._behind, (record.sequence, sock_addr))
+
+            if len(self._queued) > COMPACT_FACTOR * len(self._index) + COMPACT_MINIMUM:
+                self._ahead = [entry for entry in self._ahead if self._is_valid(*entry)]
+                self._behind = [entry for entry in self._behind if self._is_valid(*entry)]
+                heapify(self._ahead)
+                heapify(self._behind)
+                self._queued = dict((sock_addr, sequence) for sequence, sock_addr in self._ahead + self._behind)
+
+    def _is_valid(self, sequence, sock_addr):
+        record = self._index.get_record(sock_addr)
+        return record is not None and record.sequence == sequence and record.category in self._categories
+
+    def next(self, strict=False):
+        """
+        Returns the next candidate, or None when a full round did not find one.
+
+        When STRICT is True candidates with an unknown LAN or WAN address (0.0.0.0:0) are skipped.
+        """
+        self._index.expire(time())
+        wrapped = False
+        while True:
+            if not self._ahead:
+                if wrapped or not self._behind:
+                    return None
+                self._ahead, self._behind = self._behind, self._ahead
+                wrapped = True
+
+            sequence, sock_addr = heappop(self._ahead)
+            if not self._is_valid(sequence, sock_addr):
+                if self._queued.get(sock_addr) == sequence:
+                    del self._queued[sock_addr]
+                continue
+
+            heappush(self._behind, (sequence, sock_addr))
+            self._position = sequence
+            candidate = self._index[sock_addr]
+            if strict and (candidate.lan_address == ("0.0.0.0", 0) or candidate.wan_address == ("0.0.0.0", 0)):
+                continue
+            return candidate
+
+
+class CandidateIndex(OrderedDict):
+
+    """
+    An SOCK_ADDR:WalkCandidate ordered dictionary that keeps the candidates grouped by category.
+    """
+
+    def __init__(self):
+        # SOCK_ADDR:_Record dictionary
+        self._records = {}
+        self._sequence = count()
+        # CATEGORY:{SOCK_ADDR:WalkCandidate} dictionary, the None category holds the obsolete
+        # candidates
+        self._members = dict((category, {}) for category in CATEGORIES + (None,))
+        # CATEGORY:[(timestamp, sequence, version, sock_addr)] heaps with the candidates that are
+        # eligible for a walk
+        self._eligible = dict((category, []) for category in CATEGORIES)
+        # (moment, version, sock_addr) heap with the moments at which candidates may change
+        self._changes = []
+        # SOCK_ADDR set with the candidates that changed since the index was last used
+        self._dirty = set()
+        self._rotations = []
+        super(CandidateIndex, self).__init__()
+
+    def __setitem__(self, sock_addr, candidate):
+        assert isinstance(candidate, WalkCandidate), type(candidate)
+        assert sock_addr == candidate.sock_addr, [sock_addr, candidate.sock_addr]
+        record = self._records.get(sock_addr)
+        if record and record.candidate is candidate:
+            return
+
+        if record:
+            self._remove(record)
+        super(CandidateIndex, self).__setitem__(sock_addr, candidate)
+        self._records[sock_addr] = _Record(candidate, next(self._sequence))
+        candidate.index = self
+        self._dirty.add(sock_addr)
+
+    def __delitem__(self, sock_addr):
+        super(CandidateIndex, self).__delitem__(sock_addr)
+        self._remove(self._records.pop(sock_addr))
+
+    def clear(self):
+        for record in self._records.values():
+            self._remove(record)
+        self._records.clear()
+        super(CandidateIndex, self).clear()
+
+    def _remove(self, record):
+        sock_addr = record.candidate.sock_addr
+        record.version += 1
+        if record.category is not False:
+            del self._members[record.category][sock_addr]
+        self._dirty.discard(sock_addr)
+        if record.candidate.index is self:
+            record.candidate.index = None
+
+    def get_record(self, sock_addr):
+        return self._records.get(sock_addr)
+
+    def refresh(self, candidate):
+        """
+        Called by CANDIDATE when one of its timestamps changed.
+        """
+        record = self._records.get(candidate.sock_addr)
+        if record and record.candidate is candidate:
+            self._dirty.add(candidate.sock_addr)
+
+    def _file(self, record, now):
+        """
+        Put the candidate of RECORD in its category at NOW and schedule its next change.
+        """
+        candidate = record.candidate
+        sock_addr = candidate.sock_addr
+        record.version += 1
+
+        category = candidate.get_category(now)
+        if category != record.category:
+            if record.category is not False:
+                del self._members[record.category][sock_addr]
+            self._members[category][sock_addr] = candidate
+            for rotation in self._rotations:
+                if category in rotation.categories and record.category not in rotation.categories:
+                    rotation.push(record)
+            record.category = category
+
+        if category and candidate.is_eligible_for_walk(now):
+            timestamp = {u"walk": candidate.last_walk, u"stumble": candidate.last_stumble, u"intro": candidate.last_intro}[category]
+            self._push(self._eligible[category], (timestamp, record.sequence, record.version, sock_addr), 2)
+
+        moment = candidate.get_next_change(now)
+        if moment is not None:
+            self._push(self._changes, (moment, record.version, sock_addr), 1)
+
+    def _push(self, heap, entry, version_index):
+        heappush(heap, entry)
+        if len(heap) > COMPACT_FACTOR * len(self._records) + COMPACT_MINIMUM:
+            records = self._records
+            heap[:] = [entry for entry in heap if entry[-1] in records and records[entry[-1]].version == entry[version_index]]
+            heapify(heap)
+
+    def expire(self, now):
+        """
+        File the candidates that changed, or that may have changed before NOW, again.
+        """
+        records = self._records
+        if self._dirty:
+            dirty, self._dirty = self._dirty, set()
+            for sock_addr in dirty:
+                self._file(records[sock_addr], now)
+
+        changes = self._changes
+        while changes and changes[0][0] <= now:
+            _, version, sock_addr = heappop(changes)
+            record = records.get(sock_addr)
+            if record and record.version == version:
+                self._file(record, now)
+
+    def get_candidates(self, categories, now):
+        """
+        Returns a list with the candidates in CATEGORIES at NOW, in no particular order.
+        """
+        self.expire(now)
+        return [candidate for category in categories for candidate in self._members[category].itervalues()]
+
+    def get_category_size(self, category, now):
+        """
+        Returns the number of candidates in CATEGORY at NOW.
+        """
+        self.expire(now)
+        return len(self._members[category])
+
+    def get_walk_candidates(self, now):
+        """
+        Returns a list with, for the walk, stumble, and intro categories, the candidate that is
+        eligible for a walk at NOW and that was walked to, stumbled upon, or introduced the longest
+        ago.  The list contains None for categories without eligible candidates.
+        """
+        self.expire(now)
+        records = self._records
+        candidates = []
+        for category in CATEGORIES:
+            heap = self._eligible[category]
+            while heap:
+                _, _, version, sock_addr = heap[0]
+                record = records.get(sock_addr)
+                if record and record.version == version:
+                    break
+                heappop(heap)
+            candidates.append(records[heap[0][3]].candidate if heap else None)
+        return candidates
+
+    def create_rotation(self, categories):
+        """
+        Returns a new Rotation over the candidates in CATEGORIES.
+        """
+        rotation = Rotation(self, categories)
+        self.expire(time())
+        for record in sorted(self._records.itervalues(), key=lambda record: record.sequence):
+            if record.category in rotation.categories:
+                rotation.push(record)
+        self._rotations.append(rotation)
+        return rotation
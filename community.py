@@ -8,7 +8,8 @@ Community instance.
 @contact: dispersy@frayja.com
 """
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict
+from hashlib import sha1
 from itertools import islice, groupby
 from math import ceil
 from random import random, Random, randint, shuffle
@@ -23,7 +24,9 @@ from twisted.python.threadable import isInIOThread
 from .authentication import NoAuthentication, MemberAuthentication, DoubleMemberAuthentication
 from .bloomfilter import BloomFilter
 from .candidate import Candidate, WalkCandidate, BootstrapCandidate
+from .candidateindex import CandidateIndex
 from .conversion import BinaryConversion, DefaultConversion, Conversion
+from .delayindex import DelayIndex
 from .destination import CommunityDestination, CandidateDestination
 from .distribution import SyncDistribution, GlobalTimePruning, LastSyncDistribution, DirectDistribution, FullSyncDistribution
 from .exception import ConversionNotFoundException, MetaNotFoundException
@@ -37,6 +40,7 @@ from .payload import (AuthorizePayload, RevokePayload, UndoPayload, DestroyCommu
 from .requestcache import RequestCache, SignatureRequestCache, IntroductionRequestCache
 from .resolution import PublicResolution, LinearResolution, DynamicResolution
 from .statistics import CommunityStatistics
+from .syncrange import SyncRangeIndex
 from .timeline import Timeline
 from .util import runtime_duration_warning, attach_runtime_statistics, get_logger, deprecated
 
@@ -47,6 +51,14 @@ DOWNLOAD_MM_PK_INTERVAL = 15.0
 PERIODIC_CLEANUP_INTERVAL = 5.0
 TAKE_STEP_INTERVAL = 5
 
+# the sync responder reads SYNC_RESPONSE_PAGE_SIZE rows with its first query, every next query
+# reads twice as many rows up to SYNC_RESPONSE_MAX_PAGE_SIZE
+SYNC_RESPONSE_PAGE_SIZE = 8
+SYNC_RESPONSE_MAX_PAGE_SIZE = 128
+
+# the number of seconds that the packet ids of a sync response are reused for identical requests
+SYNC_RESPONSE_CACHE_TIMEOUT = 30.0
+
 class SyncCache(object):
 
     def __init__(self, time_low, time_high, modulo, offset, bloom_filter):
@@ -257,9 +269,12 @@ class Community(object):
         # batch caching incoming packets
         self._batch_cache = {}
 
-        # delayed list for incoming packet/messages which are delayed
-        self._delayed_key = defaultdict(list)
-        self._delayed_value = defaultdict(list)
+        # [meta, batch, verified] lists for batches whose signatures are being verified by the
+        # signature verifier.  batches are decoded in this order once they are verified
+        self._verifying_batches = deque()
+
+        # incoming packets/messages which are delayed
+        self._delayed = DelayIndex()
 
         lc = LoopingCall(self._periodically_clean_delayed)
         lc.start(PERIODIC_CLEANUP_INTERVAL, now=True)
@@ -355,6 +370,21 @@ class Community(object):
         # sync range bloom filters
         self._sync_cache = None
         self._sync_cache_skip_count = 0
+        self._sync_range = SyncRangeIndex(self)
+
+        # digests of recently stored packets in least recently used order.  exact duplicates of
+        # these packets are dropped before they are decoded
+        self._recent_packets = OrderedDict()
+
+        # incremented whenever packets are stored, removed, undone, or redone.  CACHE_KEY:(TIMESTAMP,
+        # PACKET_IDS) dictionary with the sync responses for bloom filter requests, in least
+        # recently used order, the key includes the sync version at the time the response was made
+        self._sync_version = 0
+        self._sync_response_cache = OrderedDict()
+        # the sync version when the database was last committed.  the read-only connections only see
+        # committed packets, hence their responses are only cached when nothing is uncommitted
+        self._committed_sync_version = 0
+        self._dispersy.database.attach_commit_callback(self._on_database_commit)
         if __debug__:
             b = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate)
             logger.debug("sync bloom:    size: %d;  capacity: %d;  error-rate: %f", int(ceil(b.size // 8)), b.get_capacity(self.dispersy_sync_bloom_filter_error_rate), self.dispersy_sync_bloom_filter_error_rate)
@@ -371,7 +401,7 @@ class Community(object):
         self._nrsyncpackets = 0
 
         # Initialize all the candidate iterators
-        self._candidates = OrderedDict()
+        self._candidates = CandidateIndex()
 
         self._walked_candidates = self._iter_category(u'walk')
         self._stumbled_candidates = self._iter_category(u'stumble')
@@ -411,7 +441,7 @@ class Community(object):
     @property
     def candidates(self):
         """
-        Dictionary containing sock_addr:Candidate pairs.
+        CandidateIndex containing sock_addr:Candidate pairs.
         """
         return self._candidates
 
@@ -627,6 +657,19 @@ class Community(object):
     def dispersy_sync_bloom_filter_strategy(self):
         return self._dispersy_claim_sync_bloom_filter_largest
 
+    @property
+    def dispersy_sync_bloom_filter_key(self):
+        """
+        The column in the sync table whose values are added to our sync bloom filters, either
+        "packet" or "digest".
+
+        This is decided by the conversion that encodes our dispersy-introduction-request messages.
+        Peers decode these messages using a conversion with the same version, hence they will use
+        the same key when checking the bloom filter.
+        @rtype: str
+        """
+        return self.get_conversion_for_message(self.get_meta_message(u"dispersy-introduction-request")).bloom_filter_key
+
     @property
     def dispersy_sync_skip_enable(self):
         return True  # _sync_skip_
@@ -635,6 +678,39 @@ class Community(object):
     def dispersy_sync_cache_enable(self):
         return True  # _cache_enable_
 
+    @property
+    def dispersy_recent_packets_size(self):
+        """
+        The maximum number of recently stored packets that are remembered, exact duplicates of
+        these packets are dropped before they are decoded.
+
+        Setting this to zero disables the recent packets cache.
+        @rtype: int
+        """
+        return 4096
+
+    @property
+    def dispersy_sync_response_cache_size(self):
+        """
+        The maximum number of sync responses that are remembered.  Peers reuse their bloom filters
+        many times, identical requests are answered using the packet ids of the previous response
+        as long as the sync table did not change, for at most SYNC_RESPONSE_CACHE_TIMEOUT seconds.
+
+        Setting this to zero disables the sync response cache.
+        @rtype: int
+        """
+        return 256
+
+    @property
+    def dispersy_verify_batch_size(self):
+        """
+        The minimal number of packets in an incoming batch before its signatures are verified by
+        the worker processes of the signature verifier, if Dispersy has one.  Smaller batches are
+        verified on the reactor thread, unless they arrive while other batches are being verified.
+        @rtype: int
+        """
+        return 16
+
     def dispersy_store(self, messages):
         """
         Called after new MESSAGES have been stored in the database.
@@ -642,8 +718,22 @@ class Community(object):
         if __debug__:
             cached = 0
 
+        self._sync_version += 1
+        for message in messages:
+            if message.meta in self._sync_range.meta_messages:
+                self._sync_range.add(message.distribution.global_time, message.packet)
+
+        size = self.dispersy_recent_packets_size
+        if size:
+            recent_packets = self._recent_packets
+            for message in messages:
+                recent_packets[message.packet_digest] = None
+            while len(recent_packets) > size:
+                recent_packets.popitem(False)
+
         if self._sync_cache:
             cache = self._sync_cache
+            key = self.dispersy_sync_bloom_filter_key
             for message in messages:
                 if (message.distribution.priority > 32 and
                     cache.time_low <= message.distribution.global_time <= cache.time_high and
@@ -653,7 +743,7 @@ class Community(object):
                         cached += 1
 
                     # update cached bloomfilter to avoid duplicates
-                    cache.bloom_filter.add(message.packet)
+                    cache.bloom_filter.add(message.packet if key == "packet" else message.packet_digest)
 
                     # if this message was received from the candidate we send the bloomfilter too, increment responses
                     if (cache.candidate and message.candidate and cache.candidate.sock_addr == message.candidate.sock_addr):
@@ -681,7 +771,7 @@ class Community(object):
                     cache.responses_received = 0
                     cache.candidate = request_cache.helper_candidate
 
-                    logger.debug("%s reuse #%d (packets received: %d; %s)", self._cid.encode("HEX"), cache.times_used, cache.responses_received, hex(cache.bloom_filter._filter))
+                    logger.debug("%s reuse #%d (packets received: %d; %s)", self._cid.encode("HEX"), cache.times_used, cache.responses_received, cache.bloom_filter.bytes.encode("HEX"))
                     return cache.time_low, cache.time_high, cache.modulo, cache.offset, cache.bloom_filter
 
             elif self._sync_cache.times_used == 0:
@@ -730,6 +820,11 @@ class Community(object):
             if from_gbtime < 1:
                 from_gbtime = int(self._random.random() * self.global_time)
 
+            # prefer the sync range index, it only reads packets that are not cached yet
+            sync = self._sync_range.claim_sync_bloom_filter(from_gbtime, acceptable_global_time)
+            if sync:
+                return sync
+
             if from_gbtime > 1 and self._nrsyncpackets >= capacity:
                 # use from_gbtime -1/+1 to include from_gbtime
                 right, rightdata = self._select_bloomfilter_range(request_cache, syncable_messages, from_gbtime - 1, capacity, True)
@@ -830,11 +925,13 @@ class Community(object):
 
     def _select_and_fix(self, request_cache, syncable_messages, global_time, to_select, higher=True):
         assert isinstance(syncable_messages, unicode)
+        # the bloom filter key is either the packet or its digest
+        key = self.dispersy_sync_bloom_filter_key
         if higher:
-            data = list(self._dispersy.database.execute(u"SELECT global_time, packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time > ? ORDER BY global_time ASC LIMIT ?" % (syncable_messages),
+            data = list(self._dispersy.database.execute(u"SELECT global_time, %s FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time > ? ORDER BY global_time ASC LIMIT ?" % (key, syncable_messages),
                        (global_time, to_select + 1)))
         else:
-            data = list(self._dispersy.database.execute(u"SELECT global_time, packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time < ? ORDER BY global_time DESC LIMIT ?" % (syncable_messages),
+            data = list(self._dispersy.database.execute(u"SELECT global_time, %s FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time < ? ORDER BY global_time DESC LIMIT ?" % (key, syncable_messages),
                        (global_time, to_select + 1)))
 
         fixed = False
@@ -861,15 +958,17 @@ class Community(object):
             bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
             capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
-            self._nrsyncpackets = list(self._dispersy.database.execute(u"SELECT count(*) FROM sync WHERE meta_message IN (%s) AND undone = 0 LIMIT 1" % (syncable_messages)))[0][0]
+            self._nrsyncpackets = self._sync_range.total
             modulo = int(ceil(self._nrsyncpackets / float(capacity)))
+            # the bloom filter key is either the packet or its digest
+            key = self.dispersy_sync_bloom_filter_key
             if modulo > 1:
                 offset = randint(0, modulo - 1)
-                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync WHERE meta_message IN (%s) AND sync.undone = 0 AND (sync.global_time + ?) %% ? = 0" % syncable_messages, (offset, modulo)))
+                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.%s FROM sync WHERE meta_message IN (%s) AND sync.undone = 0 AND (sync.global_time + ?) %% ? = 0" % (key, syncable_messages), (offset, modulo)))
             else:
                 offset = 0
                 modulo = 1
-                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync WHERE meta_message IN (%s) AND sync.undone = 0" % syncable_messages))
+                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.%s FROM sync WHERE meta_message IN (%s) AND sync.undone = 0" % (key, syncable_messages)))
 
             bloom.add_keys(packets)
 
@@ -898,6 +997,15 @@ class Community(object):
         """
         return 10 * 1024
 
+    @property
+    def dispersy_upload_rate(self):
+        """
+        The maximum number of bytes per second that are sent for this community, or None when only
+        the global and per candidate limits of the endpoint rate limiter apply.
+        @rtype: int or None
+        """
+        return None
+
     @property
     def dispersy_acceptable_global_time_range(self):
         return 10000
@@ -1029,6 +1137,8 @@ class Community(object):
 
         self._pending_tasks.clear()
         self._request_cache.clear()
+        self._verifying_batches.clear()
+        self._dispersy.database.detach_commit_callback(self._on_database_commit)
         self._dispersy.detach_community(self)
 
     def claim_global_time(self):
@@ -1046,16 +1156,44 @@ class Community(object):
         """
         if global_time > self._global_time:
             logger.debug("updating global time %d -> %d", self._global_time, global_time)
-            self._global_time = global_time
+            previous_global_time, self._global_time = self._global_time, global_time
 
             if self._do_pruning:
-                # Check for messages that need to be pruned because the global time changed.
+                # Check for messages that need to be pruned because the global time changed.  the
+                # sync version is not incremented, the sync response cache is keyed on the global
+                # time instead
                 for meta in self._meta_messages.itervalues():
                     if isinstance(meta.distribution, SyncDistribution) and isinstance(meta.distribution.pruning, GlobalTimePruning):
-                         self._dispersy.database.execute(
+                        self._dispersy.database.execute(
                             u"DELETE FROM sync WHERE meta_message = ? AND global_time <= ?",
                             (meta.database_id, self._global_time - meta.distribution.pruning.prune_threshold))
 
+                        # packets up to the previous threshold were already pruned
+                        if meta in self._sync_range.meta_messages:
+                            self._sync_range.invalidate(max(1, previous_global_time - meta.distribution.pruning.prune_threshold + 1),
+                                                        self._global_time - meta.distribution.pruning.prune_threshold)
+
+    def update_sync_range(self, meta, global_times):
+        """
+        Notify the community that the sync table changed for META at GLOBAL_TIMES, i.e. packets
+        were removed, undone, redone, or replaced.  New packets are reported through dispersy_store.
+        """
+        self._sync_version += 1
+        if meta in self._sync_range.meta_messages:
+            for global_time in global_times:
+                self._sync_range.invalidate(global_time, global_time)
+
+    def _on_database_commit(self, exiting=False):
+        self._committed_sync_version = self._sync_version
+
+    def forget_recent_packets(self, packets):
+        """
+        Remove PACKETS from the recent packets cache.  This must be called when a stored packet is
+        undone since we need to respond to duplicates of undone packets.
+        """
+        for packet in packets:
+            self._recent_packets.pop(sha1(packet).digest(), None)
+
     def dispersy_check_database(self):
         """
         Called each time after the community is loaded and attached to Dispersy.
@@ -1179,67 +1317,19 @@ class Community(object):
     def _iter_category(self, category, strict=True):
         # strict=True will ensure both candidate.lan_address and candidate.wan_address are not
         # 0.0.0.0:0
+        rotation = self._candidates.create_rotation([category])
         while True:
-            index = 0
-            has_result = False
-            keys = self._candidates.keys()
-
-            while index < len(keys):
-                now = time()
-                key = keys[index]
-                candidate = self._candidates.get(key)
-
-                if (candidate and
-                    candidate.get_category(now) == category and
-                        not (strict and (candidate.lan_address == ("0.0.0.0", 0) or candidate.wan_address == ("0.0.0.0", 0)))):
-
-                    yield candidate
-                    has_result = True
-
-                    keys = self._candidates.keys()
-                    try:
-                        if keys[index] != key:
-                            # a key has been removed from self._candidates
-                            index = keys.index(key)
-                    except (IndexError, ValueError):
-                        index -= 1
-
-                index += 1
-
-            if not has_result:
-                yield None
+            yield rotation.next(strict)
 
     def _iter_categories(self, categories, once=False):
-        while True:
-            index = 0
-            has_result = False
-            keys = self._candidates.keys()
-
-            while index < len(keys):
-                now = time()
-                key = keys[index]
-                candidate = self._candidates.get(key)
-
-                if (candidate and
-                        candidate.get_category(now) in categories):
-
-                    yield candidate
-                    has_result = True
-
-                    keys = self._candidates.keys()
-                    try:
-                        if keys[index] != key:
-                            # a key has been removed from self._candidates
-                            index = keys.index(key)
-                    except (IndexError, ValueError):
-                        index -= 1
-
-                index += 1
+        if once:
+            for candidate in self._candidates.get_candidates(categories, time()):
+                yield candidate
+            return
 
-            if once:
-                break
-            elif not has_result:
-                yield None
+        rotation = self._candidates.create_rotation(categories)
+        while True:
+            yield rotation.next()
 
     def _iter_bootstrap(self, once=False):
         while True:
@@ -1266,8 +1356,7 @@ class Community(object):
         """
         assert all(not sock_address in self._candidates for sock_address in self._bootstrap_candidates.iterkeys()), "none of the bootstrap candidates may be in self._candidates"
 
-        now = time()
-        candidates = [candidate for candidate in self._candidates.itervalues() if candidate.get_category(now) in (u"walk", u"stumble", u"intro")]
+        candidates = self._candidates.get_candidates((u"walk", u"stumble", u"intro"), time())
         shuffle(candidates)
         return iter(candidates)
 
@@ -1280,8 +1369,7 @@ class Community(object):
         """
         assert all(not sock_address in self._candidates for sock_address in self._bootstrap_candidates.iterkeys()), "none of the bootstrap candidates may be in self._candidates"
 
-        now = time()
-        candidates = [candidate for candidate in self._candidates.itervalues() if candidate.get_category(now) in (u"walk", u"stumble")]
+        candidates = self._candidates.get_candidates((u"walk", u"stumble"), time())
         shuffle(candidates)
         return iter(candidates)
 
@@ -1349,30 +1437,14 @@ class Community(object):
 
         assert all(not sock_address in self._candidates for sock_address in self._bootstrap_candidates.iterkeys()), "none of the bootstrap candidates may be in self._candidates"
 
-        from sys import maxsize
-
         now = time()
 
         # cleanup obsolete candidates
         self.cleanup_candidates()
 
-        categories = [(maxsize, None), (maxsize, None), (maxsize, None)]
-        category_sizes = [0, 0, 0]
-
-        for candidate in self._candidates.itervalues():
-            if candidate.is_eligible_for_walk(now):
-                category = candidate.get_category(now)
-                if category == u"walk":
-                    categories[0] = min(categories[0], (candidate.last_walk, candidate))
-                    category_sizes[0] += 1
-                elif category == u"stumble":
-                    categories[1] = min(categories[1], (candidate.last_stumble, candidate))
-                    category_sizes[1] += 1
-                elif category == u"intro":
-                    categories[2] = min(categories[2], (candidate.last_intro, candidate))
-                    category_sizes[2] += 1
-
-        walk, stumble, intro = [candidate for _, candidate in categories]
+        # the eligible candidate that was walked to, stumbled upon, or introduced the longest ago
+        walk, stumble, intro = self._candidates.get_walk_candidates(now)
+        category_sizes = [self._candidates.get_category_size(category, now) for category in (u"walk", u"stumble", u"intro")]
         while walk or stumble or intro:
             r = random()
 
@@ -1417,7 +1489,9 @@ class Community(object):
         """
         assert not sock_addr in self._candidates
         assert isinstance(tunnel, bool)
-        candidate = WalkCandidate(sock_addr, tunnel, lan_address, wan_address, connection_type)
+        # the addresses are shared with the candidates for SOCK_ADDR in other communities
+        address = self._dispersy.candidate_registry.get_or_create(sock_addr, lan_address, wan_address, connection_type)
+        candidate = WalkCandidate(sock_addr, tunnel, lan_address, wan_address, connection_type, address)
         self.add_candidate(candidate)
         return candidate
 
@@ -1560,11 +1634,10 @@ class Community(object):
 
         Returns the number of candidates that were removed.
         """
-        now = time()
-        obsolete_candidates = [(key, candidate) for key, candidate in self._candidates.iteritems() if candidate.get_category(now) is None]
-        for key, candidate in obsolete_candidates:
+        obsolete_candidates = self._candidates.get_candidates((None,), time())
+        for candidate in obsolete_candidates:
             logger.debug("removing obsolete candidate %s", candidate)
-            del self._candidates[key]
+            del self._candidates[candidate.sock_addr]
             self._dispersy.wan_address_unvote(candidate)
 
         return len(obsolete_candidates)
@@ -1888,12 +1961,9 @@ class Community(object):
             unwrapped_key = (match_info[0], match_info[1], match_info[2], seq)
 
             # if we find a new key, then we need to send a request
-            if unwrapped_key not in self._delayed_key:
+            if self._delayed.add(unwrapped_key, delay):
                 send_request = True
 
-            self._delayed_key[unwrapped_key].append(delay)
-            self._delayed_value[delay].append(unwrapped_key)
-
         if send_request:
             delay.send_request(self, candidate)
             self._dispersy._statistics.delay_send += 1
@@ -1919,37 +1989,19 @@ class Community(object):
 
         succeeded = set()
         for received_key in received_keys:
-            for key in self._delayed_key.keys():
-                if all(k is None or k == rk for k, rk in zip(key, received_key)):
-                    for delayed in self._delayed_key.pop(key):
-                        delayed_keys = self._delayed_value[delayed]
-                        delayed_keys.remove(key)
-
-                        if len(delayed_keys) == 0 or delayed.resume_immediately:
-                            self.dispersy.statistics.delay_success += 1
-                            self._remove_delayed(delayed)
-                            succeeded.add(delayed)
+            for delayed in self._delayed.resume(received_key):
+                self.dispersy.statistics.delay_success += 1
+                succeeded.add(delayed)
         for delayed in succeeded:
             delayed.on_success()
 
-    def _remove_delayed(self, delayed):
-        for key in self._delayed_value[delayed]:
-            self._delayed_key[key].remove(delayed)
-            if len(self._delayed_key[key]) == 0:
-                del self._delayed_key[key]
-
-        del self._delayed_value[delayed]
-
     def _periodically_clean_delayed(self):
-        now = time()
-        for delayed in self._delayed_value.keys():
-            if now > delayed.timestamp + 10:
-                self._remove_delayed(delayed)
-                delayed.on_timeout()
-                self.dispersy.statistics.delay_timeout += 1
-                self._dispersy._statistics.drop_count += 1
-                self._dispersy._statistics.dict_inc(self._dispersy._statistics.drop,
-                                                    "delay_timeout:%s" % delayed)
+        for delayed in self._delayed.expire(time() - 10):
+            delayed.on_timeout()
+            self.dispersy.statistics.delay_timeout += 1
+            self._dispersy._statistics.drop_count += 1
+            self._dispersy._statistics.dict_inc(self._dispersy._statistics.drop,
+                                                "delay_timeout:%s" % delayed)
 
     def on_incoming_packets(self, packets, cache=True, timestamp=0.0):
         """
@@ -1966,6 +2018,29 @@ class Community(object):
 
         logger.debug("got %d incoming packets", len(packets))
 
+        if self.dispersy_recent_packets_size:
+            # drop exact duplicates of packets that we recently stored, these do not need to be
+            # decoded, verified, or looked up in the database
+            recent_packets = self._recent_packets
+            unique_packets = []
+            for candidate, packet in packets:
+                digest = sha1(packet).digest()
+                if digest in recent_packets:
+                    # move to the end, i.e. most recently used
+                    del recent_packets[digest]
+                    recent_packets[digest] = None
+                else:
+                    unique_packets.append((candidate, packet))
+
+            hits = len(packets) - len(unique_packets)
+            self._statistics.recent_packets_hit += hits
+            self._statistics.recent_packets_miss += len(unique_packets)
+            if hits:
+                logger.debug("dropped %d recently received packets", hits)
+                self._dispersy._statistics.dict_inc(self._dispersy._statistics.drop, "on_incoming_packets:recently received packet", hits)
+                self._dispersy._statistics.drop_count += hits
+                packets = unique_packets
+
         for _, iterator in groupby(packets, key=lambda tup: (tup[1][1], tup[1][22])):
             cur_packets = list(iterator)
             # find associated conversion
@@ -2017,6 +2092,77 @@ class Community(object):
         """
         Start processing a batch of messages.
 
+        When Dispersy has a signature verifier, the signatures in the batch are first verified on
+        its worker processes.  The batch is decoded once the results are available, after all
+        batches that arrived before it.  Otherwise the batch is decoded immediately.
+        """
+        assert isinstance(batch, (list, set))
+        assert len(batch) > 0
+        assert all(isinstance(x, tuple) for x in batch)
+        assert all(len(x) == 3 for x in batch)
+
+        signature_verifier = self._dispersy.signature_verifier
+        if signature_verifier is None and not self._verifying_batches:
+            self._decode_batch(meta, batch)
+            return
+
+        signatures = self._get_unverified_signatures(batch) if signature_verifier and len(batch) >= self.dispersy_verify_batch_size else []
+        if not (signatures or self._verifying_batches):
+            self._decode_batch(meta, batch)
+            return
+
+        entry = [meta, batch, not signatures]
+        self._verifying_batches.append(entry)
+
+        if signatures:
+            logger.debug("verifying %d signatures for %dx %s batched messages", len(signatures), len(batch), meta.name)
+
+            def on_verified(results):
+                for (member, data, signature), valid in zip(signatures, results):
+                    if valid:
+                        member.add_verified_signature(data, signature)
+                entry[2] = True
+                self._decode_verified_batches()
+
+            def on_failure(failure):
+                # the signatures will be verified on the reactor thread instead
+                logger.error("unable to verify signatures: %s", failure.getErrorMessage())
+                entry[2] = True
+                self._decode_verified_batches()
+
+            signature_verifier.verify([(member.public_key, data, signature) for member, data, signature in signatures]).addCallbacks(on_verified, on_failure)
+
+    def _get_unverified_signatures(self, batch):
+        """
+        Returns a list of (member, data, signature) tuples for the signatures in BATCH that are not
+        yet known to be valid.
+
+        Packets whose signatures can not be obtained are ignored here, they are dropped or delayed
+        once the batch is decoded.
+        """
+        signatures = []
+        for candidate, packet, conversion in batch:
+            try:
+                signatures.extend((member, data, signature)
+                                  for member, data, signature in conversion.decode_signatures(candidate, packet)
+                                  if member.public_key and not member.has_verified_signature(data, signature))
+            except (DropPacket, DelayPacket):
+                pass
+        return signatures
+
+    def _decode_verified_batches(self):
+        """
+        Decode the verified batches at the front of the queue, preserving the order in which the
+        batches arrived.
+        """
+        while self._verifying_batches and self._verifying_batches[0][2]:
+            meta, batch, _ = self._verifying_batches.popleft()
+            self._decode_batch(meta, batch)
+
+    def _decode_batch(self, meta, batch):
+        """
+        Process a batch of messages.
+
         The batch is processed in the following steps:
 
          1. All duplicate binary packets are removed.
@@ -2029,11 +2175,6 @@ class Community(object):
         # convert binary packets into Message.Implementation instances
         messages = []
 
-        assert isinstance(batch, (list, set))
-        assert len(batch) > 0
-        assert all(isinstance(x, tuple) for x in batch)
-        assert all(len(x) == 3 for x in batch)
-
         for candidate, packet, conversion in batch:
             assert isinstance(candidate, Candidate)
             assert isinstance(packet, str)
@@ -2448,23 +2589,132 @@ class Community(object):
                 messages_with_sync.append((message, time_low, time_high, offset, modulo))
 
         if messages_with_sync:
-            for message, generator in self._get_packets_for_bloomfilters(messages_with_sync, include_inactive=False):
-                payload = message.payload
+            # the conversion that decoded the request tells us what key the bloom filter uses
+            for key in ("packet", "digest"):
+                requests = [request for request in messages_with_sync if request[0].conversion.bloom_filter_key == key]
+                if not requests:
+                    continue
+
+                lookups = [self._lookup_sync_response(request, key) for request in requests]
+                deferred = self._dispersy._database.run_read_only(self._get_sync_responses, lookups, key)
+                deferred.addCallback(self._send_sync_responses)
+                deferred.addErrback(self._on_read_only_failure, u"sync responses")
+
+    def _lookup_sync_response(self, request, key):
+        """
+        Returns a (request, cache_key, packet_ids) tuple for the bloom filter REQUEST, where
+        PACKET_IDS is None when the response is not cached.
+        """
+        if not self.dispersy_sync_response_cache_size:
+            return request, None, None
+
+        message, time_low, time_high, offset, modulo = request
+        bloom_filter = message.payload.bloom_filter
+        # the global time is included when packets are pruned, inactive packets are not sent.
+        # otherwise a request without time_high is answered with the same packets at any global
+        # time, since the sync version changes whenever packets are stored
+        cache_key = (self._sync_version, self._global_time if self._do_pruning else None, key,
+                     time_low, time_high if message.payload.has_time_high else None, offset, modulo,
+                     bloom_filter.functions, bloom_filter.size, bloom_filter.prefix, sha1(bloom_filter.bytes).digest())
+
+        cache = self._sync_response_cache
+        entry = cache.pop(cache_key, None)
+        if entry and entry[0] + SYNC_RESPONSE_CACHE_TIMEOUT > time():
+            # move to the end, i.e. most recently used
+            cache[cache_key] = entry
+            self._statistics.sync_response_cache_hit += 1
+            return request, cache_key, entry[1]
+
+        self._statistics.sync_response_cache_miss += 1
+        if self._dispersy.database.read_connections and self._committed_sync_version != self._sync_version:
+            # the response is made from the committed packets, it must not be cached under the
+            # current sync version
+            return request, None, None
+        return request, cache_key, None
+
+    def _get_sync_responses(self, execute, lookups, key):
+        """
+        Returns a list with (candidate, packets, cache_key, packet_ids) tuples, the packets that each
+        bloom filter request is missing.  PACKET_IDS is None when the response was cached.
+
+        May run on a worker thread, hence the database must only be accessed through EXECUTE.
+        """
+        # RANDOM meta messages give a different subset of the packets for every request.  a response
+        # that is cut off by the byte limit is not cached, otherwise a peer that reuses its bloom
+        # filter receives the same subset, that it already has, every time
+        random_order = any(isinstance(meta.distribution, SyncDistribution) and meta.distribution.synchronization_direction == u"RANDOM"
+                           for meta in self.get_meta_messages())
+
+        responses = []
+        for request, cache_key, packet_ids in lookups:
+            message = request[0]
+            if packet_ids is None:
+                _, generator = self._stream_packets_for_bloomfilters([request], include_inactive=False, key=key, execute=execute).next()
                 # we limit the response by byte_limit bytes
                 byte_limit = self.dispersy_sync_response_limit
 
-                packets = []
-                for packet, in payload.bloom_filter.not_filter(generator):
-                    packets.append(packet)
-                    byte_limit -= len(packet)
-                    if byte_limit <= 0:
-                        logger.debug("bandwidth throttle")
-                        break
+                if key == "packet":
+                    packets = []
+                    packet_ids = []
+                    for packet, packet_id in message.payload.bloom_filter.not_filter(generator):
+                        packets.append(packet)
+                        packet_ids.append(packet_id)
+                        byte_limit -= len(packet)
+                        if byte_limit <= 0:
+                            logger.debug("bandwidth throttle")
+                            break
 
-                if packets:
-                    logger.debug("syncing %d packets (%d bytes) to %s", len(packets), sum(len(packet) for packet in packets), message.candidate)
-                    self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-sync-", len(packets))
-                    self._dispersy._endpoint.send([message.candidate], packets)
+                else:
+                    # only the packets that will be sent are read from the database
+                    packet_ids = []
+                    for _, packet_id, length in message.payload.bloom_filter.not_filter(generator):
+                        packet_ids.append(packet_id)
+                        byte_limit -= length
+                        if byte_limit <= 0:
+                            logger.debug("bandwidth throttle")
+                            break
+
+                    packets = self._get_packets_by_id(packet_ids, execute)
+
+                if random_order and byte_limit <= 0:
+                    cache_key = None
+                responses.append((message.candidate, packets, cache_key, packet_ids))
+
+            else:
+                responses.append((message.candidate, self._get_packets_by_id(packet_ids, execute) if packet_ids else [], cache_key, None))
+        return responses
+
+    def _send_sync_responses(self, responses):
+        cache = self._sync_response_cache
+        now = time()
+        for candidate, packets, cache_key, packet_ids in responses:
+            if cache_key and packet_ids is not None:
+                cache[cache_key] = (now, packet_ids)
+                while len(cache) > self.dispersy_sync_response_cache_size:
+                    cache.popitem(False)
+
+            if packets:
+                logger.debug("syncing %d packets (%d bytes) to %s", len(packets), sum(len(packet) for packet in packets), candidate)
+                self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-sync-", len(packets))
+                self._dispersy._endpoint.send([candidate], packets)
+
+    def _on_read_only_failure(self, failure, description):
+        """
+        Errback for the Deferreds from Database.run_read_only, logs the FAILURE that prevented the
+        DESCRIPTION from being sent.
+        """
+        logger.error("unable to send %s: %s", description, failure.getTraceback())
+
+    def _get_packets_by_id(self, packet_ids, execute=None):
+        """
+        Returns the packets for PACKET_IDS, in the same order.
+        """
+        if execute is None:
+            execute = self._dispersy._database.execute
+        packets = dict((packet_id, str(packet))
+                       for packet_id, packet
+                       in execute(u"SELECT id, packet FROM sync WHERE id IN (%s)" % u", ".join(u"?" * len(packet_ids)), packet_ids))
+        return [packets[packet_id] for packet_id in packet_ids if packet_id in packets]
 
     def check_undo(self, messages):
         # Note: previously all MESSAGES have been checked to ensure that the sequence numbers are
@@ -2589,6 +2839,15 @@ class Community(object):
         self._dispersy._database.executemany(u"UPDATE sync SET undone = ? "
                                              u"WHERE community = ? AND member = ? AND global_time = ?", parameters)
 
+        # notify that global times have changed
+        for message in messages:
+            if isinstance(message, DispersyDuplicatedUndo):
+                self.update_sync_range(message.high_message.meta, [message.high_message.distribution.global_time])
+                self.forget_recent_packets([message.high_message.packet])
+            elif isinstance(message, Message.Implementation) and message.payload.process_undo:
+                self.update_sync_range(message.payload.packet.meta, [message.payload.global_time])
+                self.forget_recent_packets([message.payload.packet.packet])
+
         for meta, sub_messages in groupby(real_messages, key=lambda x: x.payload.packet.meta):
             meta.undo_callback([(message.payload.member, message.payload.global_time, message.payload.packet) for message in sub_messages])
 
@@ -2746,8 +3005,8 @@ class Community(object):
 
                     # verify that the bloom filter is correct
                     try:
-                        _, packets = self._get_packets_for_bloomfilters([[None, time_low, self.global_time if time_high == 0 else time_high, offset, modulo]], include_inactive=True).next()
-                        packets = [packet for packet, in packets]
+                        _, packets = self._get_packets_for_bloomfilters([[None, time_low, self.global_time if time_high == 0 else time_high, offset, modulo]], include_inactive=True, key=self.dispersy_sync_bloom_filter_key).next()
+                        packets = [tup[0] for tup in packets]
 
                     except OverflowError:
                         logger.error("time_low:  %d", time_low)
@@ -2795,7 +3054,7 @@ class Community(object):
 
         return request
 
-    def _get_packets_for_bloomfilters(self, requests, include_inactive=True):
+    def _get_packets_for_bloomfilters(self, requests, include_inactive=True, key="packet", execute=None):
         """
         Return all packets matching a Bloomfilter request
 
@@ -2806,33 +3065,47 @@ class Community(object):
         @param include_inactive: When False only active packets (due to pruning) are returned
         @type include_inactive: bool
 
+        @param key: The bloom filter key.  When "packet" the generator yields (packet,) tuples, when
+         "digest" it yields (digest, packet_id, packet_length) tuples
+        @type key: str
+
+        @param execute: The function used to query the database, by default Database.execute.  A
+         read-only connection from Database.run_read_only can be given instead.
+        @type execute: callable
+
         @return: An generator yielding the original request and a generator consisting of the packets matching the request
         """
 
         assert isinstance(requests, list)
         assert all(isinstance(request, (list, tuple)) for request in requests)
         assert all(len(request) == 5 for request in requests)
+        assert key in ("packet", "digest"), key
+        if execute is None:
+            execute = self._dispersy._database.execute
+
+        # length(...) of a BLOB does not require SQLite to read the BLOB itself
+        columns = u"sync.packet" if key == "packet" else u"sync.digest, sync.id, length(sync.packet)"
 
         def get_sub_select(meta):
             direction = meta.distribution.synchronization_direction
             if direction == u"ASC":
                 return u"""
  SELECT * FROM
-  (SELECT sync.packet FROM sync    -- """ + meta.name + """
+  (SELECT """ + columns + """ FROM sync    -- """ + meta.name + """
    WHERE sync.meta_message = ? AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0
    ORDER BY sync.global_time ASC)"""
 
             if direction == u"DESC":
                 return u"""
  SELECT * FROM
-  (SELECT sync.packet FROM sync    -- """ + meta.name + """
+  (SELECT """ + columns + """ FROM sync    -- """ + meta.name + """
    WHERE sync.meta_message = ? AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0
    ORDER BY sync.global_time DESC)"""
 
             if direction == u"RANDOM":
                 return u"""
  SELECT * FROM
-  (SELECT sync.packet FROM sync    -- """ + meta.name + """
+  (SELECT """ + columns + """ FROM sync    -- """ + meta.name + """
    WHERE sync.meta_message = ? AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0
    ORDER BY RANDOM())"""
 
@@ -2860,7 +3133,111 @@ class Community(object):
                 sql_arguments.extend((meta.database_id, _time_low, time_high, offset, modulo))
             logger.debug("%s", sql_arguments)
 
-            yield message, ((str(packet),) for packet, in self._dispersy._database.execute(sql, sql_arguments))
+            if key == "packet":
+                yield message, ((str(packet),) for packet, in execute(sql, sql_arguments))
+            else:
+                yield message, ((str(digest), packet_id, length) for digest, packet_id, length in execute(sql, sql_arguments))
+
+    def _stream_packets_for_bloomfilters(self, requests, include_inactive=True, key="packet", execute=None):
+        """
+        Return the packets matching a Bloomfilter request, reading them from the database in small
+        pages.
+
+        This yields the same as _get_packets_for_bloomfilters, except that the "packet" key yields
+        (packet, packet_id) tuples and except for RANDOM meta messages.
+        Those start at a random global time, wrap around, and are shuffled one page at a time
+        instead of ordering the entire range randomly.  Each meta message, in priority order, is
+        read using keyset-paginated queries on the sync_meta_message_undone_global_time_digest_index.
+        Hence the database only does work for the packets that are consumed, i.e. work is bounded
+        by the response size instead of by the size of the requested range.
+        """
+        assert isinstance(requests, list)
+        assert all(isinstance(request, (list, tuple)) for request in requests)
+        assert all(len(request) == 5 for request in requests)
+        assert key in ("packet", "digest"), key
+        if execute is None:
+            execute = self._dispersy._database.execute
+
+        meta_messages = sorted([meta
+                                for meta
+                                in self.get_meta_messages()
+                                if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32],
+                               key=lambda meta: meta.distribution.priority,
+                               reverse=True)
+
+        for message, time_low, time_high, offset, modulo in requests:
+            yield message, self._stream_packets_for_bloomfilter(execute, meta_messages, time_low, time_high, offset, modulo, include_inactive, key)
+
+    def _stream_packets_for_bloomfilter(self, execute, meta_messages, time_low, time_high, offset, modulo, include_inactive, key):
+        for meta in meta_messages:
+            if include_inactive or not isinstance(meta.distribution.pruning, GlobalTimePruning):
+                _time_low = time_low
+            else:
+                _time_low = min(max(time_low, self.global_time - meta.distribution.pruning.inactive_threshold + 1), 2 ** 63 - 1)
+            if _time_low > time_high:
+                continue
+
+            direction = meta.distribution.synchronization_direction
+            if direction == u"ASC":
+                ranges = [(_time_low, time_high, True)]
+            elif direction == u"DESC":
+                ranges = [(_time_low, time_high, False)]
+            elif direction == u"RANDOM":
+                # start at a random global time between the first and the last packet and wrap around
+                first, last = execute(u"SELECT (SELECT MIN(global_time) FROM sync WHERE meta_message = ? AND undone = 0 AND global_time BETWEEN ? AND ?),"
+                                      u" (SELECT MAX(global_time) FROM sync WHERE meta_message = ? AND undone = 0 AND global_time BETWEEN ? AND ?)",
+                                      (meta.database_id, _time_low, time_high) * 2).next()
+                if first is None:
+                    continue
+                pivot = randint(first, last)
+                ranges = [(pivot, last, True), (first, pivot - 1, True)]
+            else:
+                raise RuntimeError("Unknown synchronization_direction [%d]" % direction)
+
+            for range_low, range_high, ascending in ranges:
+                if range_low <= range_high:
+                    for row in self._stream_sync_range(execute, meta, range_low, range_high, offset, modulo, ascending, direction == u"RANDOM", key):
+                        yield row
+
+    def _stream_sync_range(self, execute, meta, time_low, time_high, offset, modulo, ascending, shuffle_pages, key):
+        """
+        Yield the packets of META between TIME_LOW and TIME_HIGH, inclusive, ordered by global time
+        and digest, or shuffled one page at a time when SHUFFLE_PAGES is True.  Every query
+        continues after the (global_time, digest) of the last row that was read.
+        """
+        columns = u"global_time, digest, packet, id" if key == "packet" else u"global_time, digest, id, length(packet)"
+        order = u"ASC" if ascending else u"DESC"
+        sql_first = (u"SELECT " + columns + u" FROM sync"
+                     u" WHERE meta_message = ? AND undone = 0 AND global_time BETWEEN ? AND ? AND (global_time + ?) % ? = 0"
+                     u" ORDER BY global_time " + order + u", digest " + order + u" LIMIT ?")
+        sql_next = (u"SELECT " + columns + u" FROM sync"
+                    u" WHERE meta_message = ? AND undone = 0 AND global_time BETWEEN ? AND ? AND (global_time + ?) % ? = 0"
+                    u" AND NOT (global_time = ? AND digest " + (u"<=" if ascending else u">=") + u" ?)"
+                    u" ORDER BY global_time " + order + u", digest " + order + u" LIMIT ?")
+
+        page_size = SYNC_RESPONSE_PAGE_SIZE
+        rows = list(execute(sql_first, (meta.database_id, time_low, time_high, offset, modulo, page_size)))
+        while rows:
+            last_page = len(rows) < page_size
+            last_global_time, last_digest = rows[-1][0], rows[-1][1]
+
+            if shuffle_pages:
+                shuffle(rows)
+            for row in rows:
+                if key == "packet":
+                    yield (str(row[2]), row[3])
+                else:
+                    yield (str(row[1]), row[2], row[3])
+
+            if last_page:
+                break
+
+            if ascending:
+                time_low = last_global_time
+            else:
+                time_high = last_global_time
+            page_size = min(page_size * 2, SYNC_RESPONSE_MAX_PAGE_SIZE)
+            rows = list(execute(sql_next, (meta.database_id, time_low, time_high, offset, modulo, last_global_time, last_digest, page_size)))
 
     def check_puncture_request(self, messages):
         for message in messages:
@@ -2941,24 +3318,32 @@ class Community(object):
         self._dispersy._forward([request])
 
     def on_missing_message(self, messages):
-        for message in messages:
+        def get_packets(execute):
+            packets = []
+            for message in messages:
+                responses = []
+                member_database_id = message.payload.member.database_id
+                for global_time in message.payload.global_times:
+                    try:
+                        packet, = execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                          (self.database_id, member_database_id, global_time)).next()
+                        responses.append(str(packet))
+                    except StopIteration:
+                        pass
+                packets.append((message, responses))
+            return packets
 
-            responses = []
-            candidate = message.candidate
-            member_database_id = message.payload.member.database_id
-            for global_time in message.payload.global_times:
-                try:
-                    packet, = self._dispersy._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
-                                                              (self.database_id, member_database_id, global_time)).next()
-                    responses.append(str(packet))
-                except StopIteration:
-                    pass
+        def send_packets(packets):
+            for message, responses in packets:
+                if responses:
+                    self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-missing-message", len(responses))
+                    self._dispersy._endpoint.send([message.candidate], responses)
+                else:
+                    logger.warning('could not find missing messages for candidate %s, global_times %s', message.candidate, message.payload.global_times)
 
-            if responses:
-                self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-missing-message", len(responses))
-                self._dispersy._endpoint.send([candidate], responses)
-            else:
-                logger.warning('could not find missing messages for candidate %s, global_times %s', candidate, message.payload.global_times)
+        deferred = self._dispersy._database.run_read_only(get_packets)
+        deferred.addCallback(send_packets)
+        deferred.addErrback(self._on_read_only_failure, u"%s responses" % messages[0].name)
 
     def create_identity(self, sign_with_master=False, store=True, update=True):
         """
@@ -3030,23 +3415,30 @@ class Community(object):
         sql_member = u"SELECT id FROM member WHERE mid = ? LIMIT 10"
         sql_packet = u"SELECT packet FROM sync WHERE community = ? AND member = ? AND meta_message = ? LIMIT 1"
 
-        for message in messages:
-            mid = message.payload.mid
-
-            # we are assuming that no more than 10 members have the same sha1 digest.
-            for member_id in [member_id for member_id, in self._dispersy._database.execute(sql_member, (buffer(mid),))]:
-                packets = [str(packet) for packet, in self._dispersy._database.execute(sql_packet,
-                                                                                       (self.database_id, member_id, meta_id))]
+        def get_packets(execute):
+            responses = []
+            for message in messages:
+                # we are assuming that no more than 10 members have the same sha1 digest.
+                for member_id in [member_id for member_id, in execute(sql_member, (buffer(message.payload.mid),))]:
+                    responses.append((message, [str(packet) for packet, in execute(sql_packet, (self.database_id, member_id, meta_id))]))
+            return responses
 
+        def send_packets(responses):
+            for message, packets in responses:
                 if packets:
                     logger.debug("responding with %d identity messages", len(packets))
                     self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-dispersy-identity", len(packets))
                     self._dispersy._endpoint.send([message.candidate], packets)
 
                 else:
-                    assert not message.payload.mid == self.my_member.mid, "we should always have our own dispersy-identity"
+                    mid = message.payload.mid
+                    assert not mid == self.my_member.mid, "we should always have our own dispersy-identity"
                     logger.warning("could not find any missing members.  no response is sent [%s, mid:%s, cid:%s]", mid.encode("HEX"), self.my_member.mid.encode("HEX"), self.cid.encode("HEX"))
 
+        deferred = self._dispersy._database.run_read_only(get_packets)
+        deferred.addCallback(send_packets)
+        deferred.addErrback(self._on_read_only_failure, u"%s responses" % messages[0].name)
+
     def create_signature_request(self, candidate, message, response_func, response_args=(), timeout=10.0, forward=True):
         """
         Create a dispersy-signature-request message.
@@ -3161,7 +3553,7 @@ class Community(object):
                     cur_low, cur_high = low, high
             yield (cur_low, cur_high)
 
-        def fetch_packets(member_id, message_id, candidate, requests):
+        def fetch_packets(execute, candidate, requests):
             # We limit the response by byte_limit bytes per incoming candidate
             byte_limit = self.dispersy_missing_sequence_response_limit
 
@@ -3173,7 +3565,7 @@ class Community(object):
 
                 logger.debug("fetching member:%d message:%d packets from database for %s", member_id, message_id, candidate)
                 for range_min, range_max in merge_ranges(sequences):
-                    for packet, in self._dispersy._database.execute(
+                    for packet, in execute(
                             u"SELECT packet FROM sync "
                             u"WHERE member = ? AND meta_message = ? AND sequence BETWEEN ? AND ? "
                             u"ORDER BY sequence",
@@ -3195,23 +3587,32 @@ class Community(object):
 
             sources[message.candidate][(member_id, message_id)].append((message.payload.missing_low, message.payload.missing_high))
 
-        for candidate, member_message_requests in sources.iteritems():
-            assert isinstance(candidate, Candidate), type(candidate)
-            packets = fetch_packets(member_id, message_id, candidate, member_message_requests)
-            if __debug__:
-                # ensure we are sending the correct sequence numbers back
-                for packet in packets:
-                    msg = self._dispersy.convert_packet_to_message(packet, self)
-                    assert msg
-                    logger.debug("syncing %d bytes, member:%d message:%d sequence:%d to %s",
-                                 len(packet),
-                                 msg.authentication.member.database_id,
-                                 msg.database_id,
-                                 msg.distribution.sequence_number,
-                                 candidate)
-
-            self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-sequence-", len(packets))
-            self._dispersy._endpoint.send([candidate], packets)
+        def get_packets(execute):
+            return [(candidate, fetch_packets(execute, candidate, member_message_requests))
+                    for candidate, member_message_requests
+                    in sources.iteritems()]
+
+        def send_packets(responses):
+            for candidate, packets in responses:
+                assert isinstance(candidate, Candidate), type(candidate)
+                if __debug__:
+                    # ensure we are sending the correct sequence numbers back
+                    for packet in packets:
+                        msg = self._dispersy.convert_packet_to_message(packet, self)
+                        assert msg
+                        logger.debug("syncing %d bytes, member:%d message:%d sequence:%d to %s",
+                                     len(packet),
+                                     msg.authentication.member.database_id,
+                                     msg.database_id,
+                                     msg.distribution.sequence_number,
+                                     candidate)
+
+                self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-sequence-", len(packets))
+                self._dispersy._endpoint.send([candidate], packets)
+
+        deferred = self._dispersy._database.run_read_only(get_packets)
+        deferred.addCallback(send_packets)
+        deferred.addErrback(self._on_read_only_failure, u"%s responses" % messages[0].name)
 
     def create_missing_proof(self, candidate, message):
         meta = self.get_meta_message(u"dispersy-missing-proof")
@@ -3219,16 +3620,28 @@ class Community(object):
         self._dispersy._forward([request])
 
     def on_missing_proof(self, messages):
-        for message in messages:
-            try:
-                packet, = self._dispersy._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ? LIMIT 1",
-                                                          (self.database_id, message.payload.member.database_id, message.payload.global_time)).next()
+        def get_packets(execute):
+            packets = []
+            for message in messages:
+                try:
+                    packet, = execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ? LIMIT 1",
+                                      (self.database_id, message.payload.member.database_id, message.payload.global_time)).next()
+                    packets.append((message, str(packet)))
 
-            except StopIteration:
+                except StopIteration:
+                    packets.append((message, None))
+            return packets
+
+        deferred = self._dispersy._database.run_read_only(get_packets)
+        deferred.addCallback(self._send_proofs)
+        deferred.addErrback(self._on_read_only_failure, u"%s responses" % messages[0].name)
+
+    def _send_proofs(self, packets):
+        for message, packet in packets:
+            if packet is None:
                 logger.warning("someone asked for proof for a message that we do not have")
 
             else:
-                packet = str(packet)
                 msg = self._dispersy.convert_packet_to_message(packet, self, verify=False)
                 allowed, proofs = self.timeline.check(msg)
                 if allowed and proofs:
@@ -3519,6 +3932,9 @@ class Community(object):
                 # community is no longer available
                 self._dispersy._database.execute(u"DELETE FROM sync WHERE community = ? AND id NOT IN (" + u", ".join(u"?" for _ in packet_ids) + ")", [self.database_id] + list(packet_ids))
 
+                # 3. the removed packets are no longer duplicates
+                self._recent_packets.clear()
+
             self._dispersy.reclassify_community(self, new_classification)
 
     def create_dynamic_settings(self, policies, sign_with_master=False, store=True, update=True, forward=True):
@@ -3580,10 +3996,12 @@ class Community(object):
                     meta.undo_callback([(message.authentication.member, message.distribution.global_time, message) for message in undo])
 
                     # notify that global times have changed
-                    # meta.self.update_sync_range(meta, [message.distribution.global_time for message in undo])
+                    self.update_sync_range(meta, [message.distribution.global_time for message in undo])
+                    self.forget_recent_packets([message.packet for message in undo])
 
                 if redo:
                     executemany(u"UPDATE sync SET undone = 0 WHERE id = ?", ((message.packet_id,) for message in redo))
+                    self.update_sync_range(meta, [message.distribution.global_time for message in redo])
                     meta.handle_callback(redo)
 
     def _claim_master_member_sequence_number(self, meta):
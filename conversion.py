@@ -49,6 +49,10 @@ class Conversion(object):
         # the community that this conversion belongs to.
         self._community = community
 
+        # the key that is added to sync bloom filters in dispersy-introduction-request messages.
+        # either "packet" (the entire packet) or "digest" (the sha1 digest of the packet)
+        self._bloom_filter_key = "packet"
+
         # the messages that this instance can handle, and that this instance produces, is identified
         # by _prefix.
         self._prefix = dispersy_version + community_version + community.cid
@@ -76,6 +80,10 @@ class Conversion(object):
     def prefix(self):
         return self._prefix
 
+    @property
+    def bloom_filter_key(self):
+        return self._bloom_filter_key
+
     @abstractmethod
     def can_decode_message(self, data):
         """
@@ -106,6 +114,18 @@ class Conversion(object):
         assert len(data) >= 22
         assert data[:22] == self._prefix
 
+    def decode_signatures(self, candidate, data):
+        """
+        Returns a list of (member, data, signature) tuples with the signatures that decode_message
+        will verify when DATA is decoded.  The signatures themselves are not verified.
+
+        Raises DropPacket or DelayPacket when the signatures can not be obtained.
+        """
+        assert isinstance(data, str)
+        assert len(data) >= 22
+        assert data[:22] == self._prefix
+        return []
+
     @abstractmethod
     def can_encode_message(self, message):
         """
@@ -170,18 +190,25 @@ class NoDefBinaryConversion(Conversion):
             self.payload = payload
 
     class DecodeFunctions(object):
-        __slots__ = ["meta", "authentication", "resolution", "distribution", "destination", "payload"]
+        __slots__ = ["meta", "authentication", "resolution", "distribution", "destination", "payload", "zero_copy"]
 
-        def __init__(self, meta, authentication, resolution, distribution, destination, payload):
+        def __init__(self, meta, authentication, resolution, distribution, destination, payload, zero_copy):
             self.meta = meta
             self.authentication = authentication
             self.resolution = resolution
             self.distribution = distribution
             self.destination = destination
             self.payload = payload
+            self.zero_copy = zero_copy
 
-    def __init__(self, community, community_version):
+    def __init__(self, community, community_version, bloom_filter_key="packet"):
+        """
+        BLOOM_FILTER_KEY is either "packet" or "digest".  Peers only decode messages from the same
+        COMMUNITY_VERSION, hence a new community version must be used when changing this value.
+        """
+        assert bloom_filter_key in ("packet", "digest"), bloom_filter_key
         Conversion.__init__(self, community, "\x00", community_version)
+        self._bloom_filter_key = bloom_filter_key
 
         self._struct_B = Struct(">B")
         self._struct_BBH = Struct(">BBH")
@@ -215,7 +242,17 @@ class NoDefBinaryConversion(Conversion):
         self._encode_connection_type_map = {u"unknown": int("00000000", 2), u"public": int("10000000", 2), u"symmetric-NAT": int("11000000", 2)}
         self._decode_connection_type_map = dict((value, key) for key, value in self._encode_connection_type_map.iteritems())
 
-    def define_meta_message(self, byte, meta, encode_payload_func, decode_payload_func):
+    def define_meta_message(self, byte, meta, encode_payload_func, decode_payload_func, zero_copy=False):
+        """
+        Use ENCODE_PAYLOAD_FUNC and DECODE_PAYLOAD_FUNC for the payload of META, which is identified
+        by BYTE.
+
+        DECODE_PAYLOAD_FUNC(placeholder, offset, data) is given the packet up to the first
+        signature.  When ZERO_COPY is True this is a read-only buffer on the packet instead of a
+        copy, the decoder must then only use len(), indexing, slicing, and struct.unpack_from on
+        DATA.  Slicing a buffer returns a str, hence values that outlive the packet are still
+        copied.
+        """
         assert isinstance(byte, str)
         assert len(byte) == 1
         assert isinstance(meta, Message)
@@ -224,6 +261,7 @@ class NoDefBinaryConversion(Conversion):
         assert not byte in self._decode_message_map, "This byte has already been defined (%d)" % ord(byte)
         assert callable(encode_payload_func)
         assert callable(decode_payload_func)
+        assert isinstance(zero_copy, bool), type(zero_copy)
 
         mapping = {MemberAuthentication: (self._encode_member_authentication, self._encode_member_authentication_signature),
                    DoubleMemberAuthentication: (self._encode_double_member_authentication, self._encode_double_member_authentication_signature),
@@ -254,7 +292,7 @@ class NoDefBinaryConversion(Conversion):
                    CandidateDestination: self._decode_empty_destination,
                    CommunityDestination: self._decode_empty_destination}
 
-        self._decode_message_map[byte] = self.DecodeFunctions(meta, mapping[type(meta.authentication)], mapping[type(meta.resolution)], mapping[type(meta.distribution)], mapping[type(meta.destination)], decode_payload_func)
+        self._decode_message_map[byte] = self.DecodeFunctions(meta, mapping[type(meta.authentication)], mapping[type(meta.resolution)], mapping[type(meta.distribution)], mapping[type(meta.destination)], decode_payload_func, zero_copy)
 
     def __get_authentication_encoding(self, authentication):
         encoding = authentication.encoding
@@ -1156,7 +1194,10 @@ class NoDefBinaryConversion(Conversion):
         else:
             raise NotImplementedError(encoding)
 
-    def _decode_double_member_authentication(self, placeholder):
+    def _decode_double_members(self, placeholder):
+        """
+        Returns a (offset, members) tuple with the two members of a double signed message.
+        """
         authentication = placeholder.meta.authentication
         offset = placeholder.offset
         data = placeholder.data
@@ -1190,6 +1231,14 @@ class NoDefBinaryConversion(Conversion):
         else:
             raise NotImplementedError(encoding)
 
+        return offset, members
+
+    def _decode_double_member_authentication(self, placeholder):
+        authentication = placeholder.meta.authentication
+        data = placeholder.data
+        offset, members = self._decode_double_members(placeholder)
+        encoding = self.__get_authentication_encoding(authentication)
+
         # TODO(emilon): add a get_signatures method to the message so we can avoid computing offsets all over the place
         second_signature_offset = len(data) - members[1].signature_length
         first_signature_offset = second_signature_offset - members[0].signature_length
@@ -1259,7 +1308,11 @@ class NoDefBinaryConversion(Conversion):
         assert isinstance(placeholder.distribution, Distribution.Implementation)
 
         # payload
-        placeholder.offset, placeholder.payload = decode_functions.payload(placeholder, placeholder.offset, placeholder.data[:placeholder.first_signature_offset])
+        if decode_functions.zero_copy:
+            data = buffer(placeholder.data, 0, placeholder.first_signature_offset)
+        else:
+            data = placeholder.data[:placeholder.first_signature_offset]
+        placeholder.offset, placeholder.payload = decode_functions.payload(placeholder, placeholder.offset, data)
         if placeholder.offset != placeholder.first_signature_offset:
             logger.warning("invalid packet size for %s data:%d; offset:%d", placeholder.meta.name, placeholder.first_signature_offset, placeholder.offset)
             raise DropPacket("Invalid packet size (there are unconverted bytes)")
@@ -1304,6 +1357,32 @@ class NoDefBinaryConversion(Conversion):
         assert isinstance(verify, bool)
         return self._decode_message(candidate, data, verify, False)
 
+    def decode_signatures(self, candidate, data):
+        """
+        Returns a list of (member, data, signature) tuples with the signatures that decode_message
+        will verify when DATA is decoded.  The signatures themselves are not verified.
+        """
+        assert isinstance(candidate, Candidate), candidate
+        assert isinstance(data, str), data
+        decode_functions = self._decode_message_map.get(data[22])
+        if decode_functions is None:
+            raise DropPacket("Unknown message code %d" % ord(data[22]))
+
+        authentication = decode_functions.meta.authentication
+        placeholder = self.Placeholder(candidate, decode_functions.meta, 23, data, False, False)
+        if isinstance(authentication, MemberAuthentication):
+            decode_functions.authentication(placeholder)
+            return [(placeholder.authentication.member, data[:placeholder.first_signature_offset], data[placeholder.first_signature_offset:])]
+
+        if isinstance(authentication, DoubleMemberAuthentication):
+            _, members = self._decode_double_members(placeholder)
+            second_signature_offset = len(data) - members[1].signature_length
+            first_signature_offset = second_signature_offset - members[0].signature_length
+            return [(members[0], data[:first_signature_offset], data[first_signature_offset:second_signature_offset]),
+                    (members[1], data[:first_signature_offset], data[second_signature_offset:])]
+
+        return []
+
     def __str__(self):
         return "<%s %s%s [%s]>" % (self.__class__.__name__, self.dispersy_version.encode("HEX"), self.community_version.encode("HEX"), ", ".join(self._encode_message_map.iterkeys()))
 
@@ -1313,8 +1392,8 @@ class BinaryConversion(NoDefBinaryConversion):
     Extends NoDefBinaryConversion and will define all standard dispersy messages
     """
 
-    def __init__(self, community, community_version):
-        super(BinaryConversion, self).__init__(community, community_version)
+    def __init__(self, community, community_version, bloom_filter_key="packet"):
+        super(BinaryConversion, self).__init__(community, community_version, bloom_filter_key)
 
         def define(value, name, encode, decode):
             try:
@@ -1323,7 +1402,8 @@ class BinaryConversion(NoDefBinaryConversion):
                 if __debug__:
                     debug_non_available.append(name)
             else:
-                self.define_meta_message(chr(value), meta, encode, decode)
+                # all Dispersy payload decoders can parse a buffer
+                self.define_meta_message(chr(value), meta, encode, decode, zero_copy=True)
 
         if __debug__:
             debug_non_available = []
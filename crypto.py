@@ -66,7 +66,7 @@ class DispersyCrypto(object):
         raise NotImplementedError()
 
     def is_valid_signature(self, key, string, signature):
-        "Verify if the signature matches the one generated by key/string pair."
+        "Verify if the signature matches the one generated by key/string pair, string may be a str or a buffer."
         raise NotImplementedError()
 
     def create_signature(self, key, string):
@@ -242,7 +242,7 @@ class ECCrypto(DispersyCrypto):
         """
         Returns True when SIGNATURE matches the DIGEST made using EC.
         """
-        assert isinstance(data, str), type(data)
+        assert isinstance(data, (str, buffer)), type(data)
         assert isinstance(signature, str), type(signature)
         assert len(signature) == self.get_signature_length(ec), [len(signature), self.get_signature_length(ec)]
         length = len(signature) / 2
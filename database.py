@@ -8,8 +8,16 @@ This module provides basic database functionalty and simple version control.
 import logging
 import sys
 import thread
+from Queue import Queue
 from abc import ABCMeta, abstractmethod
 from sqlite3 import Connection
+from threading import Condition, Thread
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
 from .logger import get_logger
 from .util import attach_runtime_statistics
@@ -17,24 +25,46 @@ from .util import attach_runtime_statistics
 
 logger = get_logger(__name__)
 
+# seconds that the durability thread waits for more commits before it makes them durable together
+GROUP_COMMIT_DELAY = 0.05
 
-if "--explain-query-plan" in getattr(sys, "argv", []):
-    _explain_query_plan_logger = get_logger("explain-query-plan")
-    _explain_query_plan = set()
+# the tuning profile that is used when none is given
+DEFAULT_TUNING_PROFILE = u"default"
 
-    def attach_explain_query_plan(func):
-        def attach_explain_query_plan_helper(self, statements, bindings=()):
-            if not statements in _explain_query_plan:
-                _explain_query_plan.add(statements)
 
-                _explain_query_plan_logger.info("Explain query plan for <<<%s>>>", statements)
-                for line in self._cursor.execute(u"EXPLAIN QUERY PLAN %s" % statements, bindings):
-                    _explain_query_plan_logger.info(line)
-                _explain_query_plan_logger.info("--")
+def explain_query_plans(func, plans):
+    """
+    Wraps FUNC, i.e. Database.execute or Database.executemany, such that the query plan of each
+    statement is logged and stored in PLANS, a STATEMENT:[STEP] dictionary, the first time that
+    the statement is executed.
+    """
+    def attach_explain_query_plan_helper(self, statement, *args, **kargs):
+        if not statement in plans:
+            try:
+                # the plan does not depend on the bound values
+                plan = [row[-1] for row in self.explain_query_plan(statement, (None,) * statement.count(u"?"))]
+            except Exception:
+                _explain_query_plan_logger.exception("unable to explain <<<%s>>>", statement)
+                plan = []
+            plans[statement] = plan
+
+            _explain_query_plan_logger.info("Explain query plan for <<<%s>>>", statement)
+            for line in plan:
+                _explain_query_plan_logger.info(line)
+            _explain_query_plan_logger.info("--")
+
+        return func(self, statement, *args, **kargs)
+    attach_explain_query_plan_helper.__name__ = func.__name__
+    return attach_explain_query_plan_helper
+
 
-            return func(self, statements, bindings)
-        attach_explain_query_plan_helper.__name__ = func.__name__
-        return attach_explain_query_plan_helper
+_explain_query_plan_logger = get_logger("explain-query-plan")
+
+if "--explain-query-plan" in getattr(sys, "argv", []):
+    _explain_query_plan = {}
+
+    def attach_explain_query_plan(func):
+        return explain_query_plans(func, _explain_query_plan)
 
 else:
     def attach_explain_query_plan(func):
@@ -57,20 +87,357 @@ class IgnoreCommits(Exception):
         super(IgnoreCommits, self).__init__("Ignore all commits made within __enter__ and __exit__")
 
 
+class IncompleteCheckpoint(Exception):
+
+    """
+    The WAL file could not be checkpointed completely, hence the commits are not durable.
+    """
+    def __init__(self, file_path, log, checkpointed):
+        super(IncompleteCheckpoint, self).__init__("checkpointed %d of %d WAL pages [%s]" % (checkpointed, log, file_path))
+
+
+class TuningProfile(object):
+
+    """
+    The SQLite settings that Database.open applies, settings that are None keep the SQLite default.
+
+    The synchronous and wal_autocheckpoint settings are ignored in write-behind mode.  The other
+    settings are applied to every connection, including the read-only connections.
+    """
+
+    def __init__(self, name, synchronous=u"NORMAL", cache_size=None, mmap_size=None, wal_autocheckpoint=None, temp_store=None, busy_timeout=None):
+        """
+        @param name: The name of this profile, used for logging.
+        @type name: unicode
+
+        @param synchronous: PRAGMA synchronous, one of u"OFF", u"NORMAL", or u"FULL".
+        @type synchronous: unicode
+
+        @param cache_size: The page cache size of each connection in KiB.
+        @type cache_size: int
+
+        @param mmap_size: The maximum number of bytes of the database file that is memory-mapped.
+        @type mmap_size: int
+
+        @param wal_autocheckpoint: The number of WAL pages after which a commit checkpoints.
+        @type wal_autocheckpoint: int
+
+        @param temp_store: PRAGMA temp_store, one of u"DEFAULT", u"FILE", or u"MEMORY".
+        @type temp_store: unicode
+
+        @param busy_timeout: The milliseconds to wait for a lock held by another connection.
+        @type busy_timeout: int
+        """
+        assert isinstance(name, unicode), type(name)
+        assert synchronous in (u"OFF", u"NORMAL", u"FULL"), synchronous
+        assert cache_size is None or isinstance(cache_size, int), type(cache_size)
+        assert cache_size is None or cache_size > 0, cache_size
+        assert mmap_size is None or isinstance(mmap_size, (int, long)), type(mmap_size)
+        assert mmap_size is None or mmap_size >= 0, mmap_size
+        assert wal_autocheckpoint is None or isinstance(wal_autocheckpoint, int), type(wal_autocheckpoint)
+        assert wal_autocheckpoint is None or wal_autocheckpoint >= 0, wal_autocheckpoint
+        assert temp_store in (None, u"DEFAULT", u"FILE", u"MEMORY"), temp_store
+        assert busy_timeout is None or isinstance(busy_timeout, int), type(busy_timeout)
+        assert busy_timeout is None or busy_timeout >= 0, busy_timeout
+        super(TuningProfile, self).__init__()
+        self._name = name
+        self._synchronous = synchronous
+        self._cache_size = cache_size
+        self._mmap_size = mmap_size
+        self._wal_autocheckpoint = wal_autocheckpoint
+        self._temp_store = temp_store
+        self._busy_timeout = busy_timeout
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def synchronous(self):
+        return self._synchronous
+
+    @property
+    def cache_size(self):
+        return self._cache_size
+
+    @property
+    def mmap_size(self):
+        return self._mmap_size
+
+    @property
+    def wal_autocheckpoint(self):
+        return self._wal_autocheckpoint
+
+    @property
+    def temp_store(self):
+        return self._temp_store
+
+    @property
+    def busy_timeout(self):
+        return self._busy_timeout
+
+    def get_connection_statements(self):
+        """
+        Returns the PRAGMA statements that must be executed on every connection.
+        """
+        statements = []
+        if self._cache_size is not None:
+            # a negative cache_size is in KiB instead of pages
+            statements.append(u"PRAGMA cache_size = -%d" % self._cache_size)
+        if self._mmap_size is not None:
+            statements.append(u"PRAGMA mmap_size = %d" % self._mmap_size)
+        if self._temp_store is not None:
+            statements.append(u"PRAGMA temp_store = %s" % self._temp_store)
+        if self._busy_timeout is not None:
+            statements.append(u"PRAGMA busy_timeout = %d" % self._busy_timeout)
+        return statements
+
+    def __str__(self):
+        return "<%s %s>" % (self.__class__.__name__, self._name)
+
+
+TUNING_PROFILES = dict((profile.name, profile) for profile in [
+    # the SQLite defaults, only synchronous is set to NORMAL
+    TuningProfile(u"default"),
+    # trackers do not need durability and keep everything in memory
+    TuningProfile(u"tracker-in-memory", synchronous=u"OFF", cache_size=64 * 1024, temp_store=u"MEMORY"),
+    # desktop nodes share the machine with other applications
+    TuningProfile(u"desktop", cache_size=16 * 1024, mmap_size=64 * 1024 * 1024, wal_autocheckpoint=1000, busy_timeout=5000),
+    # servers with fast disks and plenty of memory can checkpoint less often
+    TuningProfile(u"server-ssd", cache_size=256 * 1024, mmap_size=1024 * 1024 * 1024, wal_autocheckpoint=10000, temp_store=u"MEMORY", busy_timeout=10000)])
+
+
+def get_tuning_profile(tuning):
+    """
+    Returns the TuningProfile for TUNING, which is either a TuningProfile, the name of one of the
+    TUNING_PROFILES, or None for the DEFAULT_TUNING_PROFILE.
+
+    Raises ValueError when TUNING is an unknown name.
+    """
+    if isinstance(tuning, TuningProfile):
+        return tuning
+    if tuning is None:
+        tuning = DEFAULT_TUNING_PROFILE
+    assert isinstance(tuning, unicode), type(tuning)
+    try:
+        return TUNING_PROFILES[tuning]
+    except KeyError:
+        raise ValueError("unknown tuning profile %s, expected one of %s" % (tuning, ", ".join(sorted(TUNING_PROFILES))))
+
+
+class _DurabilityThread(Thread):
+
+    """
+    Makes the commits of a write-behind Database durable.
+
+    The Database commits without waiting for the disk, hence the committed transactions are only
+    in the WAL file.  This thread uses its own connection to checkpoint the WAL file, syncing it to
+    disk, and fires the Deferreds of all the commits that were made before the checkpoint started.
+    Commits that arrive while a checkpoint is running are grouped into the next checkpoint.
+    """
+
+    def __init__(self, file_path):
+        super(_DurabilityThread, self).__init__(name="DurabilityThread")
+        self.daemon = True
+        self._file_path = file_path
+        self._condition = Condition()
+        self._running = True
+        # the number of commits since the last checkpoint
+        self._pending = 0
+        # Deferreds that fire once the commits made before them are durable
+        self._requests = []
+
+        self.checkpoint_count = 0
+        self.commit_count = 0
+
+    def notify_commit(self):
+        with self._condition:
+            self._pending += 1
+            self._condition.notify()
+
+    def request(self, deferred):
+        with self._condition:
+            self._requests.append(deferred)
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self.join()
+
+    def run(self):
+        connection = Connection(self._file_path)
+        connection.execute(u"PRAGMA synchronous = NORMAL")
+        try:
+            while True:
+                with self._condition:
+                    while self._running and not (self._pending or self._requests):
+                        self._condition.wait()
+                    running = self._running
+
+                if running:
+                    # wait a little while to group more commits into this checkpoint
+                    with self._condition:
+                        self._condition.wait(GROUP_COMMIT_DELAY)
+
+                with self._condition:
+                    pending, self._pending = self._pending, 0
+                    requests, self._requests = self._requests, []
+
+                if pending or requests:
+                    try:
+                        # syncs the WAL file before copying it into the database file
+                        busy, log, checkpointed = connection.execute(u"PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                    except Exception:
+                        logger.exception("unable to checkpoint [%s]", self._file_path)
+                        failure = Failure()
+                        for deferred in requests:
+                            reactor.callFromThread(deferred.errback, failure)
+                        continue
+
+                    if busy or checkpointed != log:
+                        # a reader, or a writer, prevents copying the whole WAL file.  the commits
+                        # are retried with the next checkpoint, or fail when the database is closed
+                        if running:
+                            logger.debug("checkpointed %d of %d WAL pages, retrying [%s]", checkpointed, log, self._file_path)
+                            with self._condition:
+                                self._pending += pending
+                                self._requests[:0] = requests
+                        else:
+                            logger.warning("checkpointed %d of %d WAL pages while closing [%s]", checkpointed, log, self._file_path)
+                            failure = Failure(IncompleteCheckpoint(self._file_path, log, checkpointed))
+                            for deferred in requests:
+                                reactor.callFromThread(deferred.errback, failure)
+                        continue
+
+                    self.checkpoint_count += 1
+                    self.commit_count += pending
+                    logger.debug("%d commits and %d requests are durable [%s]", pending, len(requests), self._file_path)
+
+                    for deferred in requests:
+                        reactor.callFromThread(deferred.callback, None)
+
+                elif not running:
+                    break
+        finally:
+            connection.close()
+
+
+class _ReadOnlyPool(object):
+
+    """
+    A fixed number of read-only connections to a WAL database, and a worker thread for each
+    connection.
+
+    In WAL mode readers do not block the writer, and the writer does not block readers.  Each
+    reader sees the database as it was when its query started, hence only committed data is
+    visible.
+
+    The pool has its own worker threads, rather than using the reactor thread pool, such that
+    close() can stop them.
+    """
+
+    def __init__(self, file_path, size, tuning):
+        assert isinstance(file_path, unicode), type(file_path)
+        assert isinstance(size, int), type(size)
+        assert size > 0, size
+        assert isinstance(tuning, TuningProfile), type(tuning)
+        super(_ReadOnlyPool, self).__init__()
+        self._size = size
+        self._connections = Queue()
+        for _ in xrange(size):
+            connection = Connection(file_path, check_same_thread=False)
+            connection.execute(u"PRAGMA query_only = ON")
+            for statement in tuning.get_connection_statements():
+                connection.execute(statement)
+            self._connections.put(connection)
+        self._thread_pool = ThreadPool(size, size, name="Database read-only")
+        self._thread_pool.start()
+
+    @property
+    def size(self):
+        return self._size
+
+    def defer(self, func, *args):
+        """
+        Call run(FUNC, *ARGS) on a worker thread, returns a Deferred that fires with the result on
+        the reactor thread.
+        """
+        return deferToThreadPool(reactor, self._thread_pool, self.run, func, *args)
+
+    def run(self, func, *args):
+        """
+        Call FUNC(execute, *ARGS) with the execute method of a free connection, blocks until a
+        connection is available.
+        """
+        connection = self._connections.get()
+        try:
+            return func(connection.execute, *args)
+        finally:
+            # end the read transaction, otherwise the reader keeps seeing this snapshot
+            connection.rollback()
+            self._connections.put(connection)
+
+    def close(self):
+        """
+        Stop the worker threads and close all connections, waits until the connections that are
+        in use are returned.
+        """
+        self._thread_pool.stop()
+        for _ in xrange(self._size):
+            self._connections.get().close()
+
+
 class Database(object):
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, write_behind=False, read_connections=0, tuning=None):
         """
         Initialize a new Database instance.
 
+        In write-behind mode a commit does not wait until the data is on disk.  A separate thread
+        makes the commits durable in groups, use durable() to wait until this has happened.  The
+        uncommitted and the committed data are always visible on this connection, hence reads are
+        not affected.  Write-behind mode is ignored for :memory: databases.
+
+        With READ_CONNECTIONS > 0 run_read_only(...) runs its queries on worker threads, each using
+        one of READ_CONNECTIONS read-only connections.  These connections only see committed data.
+        The read-only connections are ignored for :memory: databases.
+
+        The SQLite settings from the TUNING profile are applied when the database is opened.
+
         @param file_path: the path to the database file.
         @type file_path: unicode
+
+        @param write_behind: enable write-behind mode.
+        @type write_behind: bool
+
+        @param read_connections: the number of read-only connections.
+        @type read_connections: int
+
+        @param tuning: the TuningProfile or the name of one of the TUNING_PROFILES, by default the
+         DEFAULT_TUNING_PROFILE.
+        @type tuning: TuningProfile or unicode
         """
         assert isinstance(file_path, unicode)
+        assert isinstance(write_behind, bool), type(write_behind)
+        assert isinstance(read_connections, int), type(read_connections)
+        assert read_connections >= 0, read_connections
         logger.debug("loading database [%s]", file_path)
         self._file_path = file_path
+        self._tuning = get_tuning_profile(tuning)
+        self._write_behind = write_behind and file_path != u":memory:"
+
+        # _DURABILITY_THREAD is set during open(...) in write-behind mode
+        self._durability_thread = None
+        # Deferreds from durable() that wait for the next commit because commits are deferred
+        self._durability_requests = []
+
+        # _READ_ONLY_POOL is set during open(...) when READ_CONNECTIONS is given
+        self._read_connections = 0 if file_path == u":memory:" else read_connections
+        self._read_only_pool = None
 
         # _CONNECTION, _CURSOR, AND _DATABASE_VERSION are set during open(...)
         self._connection = None
@@ -98,6 +465,14 @@ class Database(object):
             self._initial_statements()
         if prepare_visioning:
             self._prepare_version()
+        if self._write_behind:
+            self._connection.commit()
+            self._durability_thread = _DurabilityThread(self._file_path)
+            self._durability_thread.start()
+        if self._read_connections:
+            # the read-only connections must see the tables that were just created
+            self._connection.commit()
+            self._read_only_pool = _ReadOnlyPool(self._file_path, self._read_connections, self._tuning)
         return True
 
     def close(self, commit=True):
@@ -105,6 +480,12 @@ class Database(object):
         assert self._connection is not None, "Database.close() has been called or Database.open() has not been called"
         if commit:
             self.commit(exiting=True)
+        if self._durability_thread:
+            self._durability_thread.stop()
+            self._durability_thread = None
+        if self._read_only_pool:
+            self._read_only_pool.close()
+            self._read_only_pool = None
         logger.debug("close database [%s]", self._file_path)
         self._cursor.close()
         self._cursor = None
@@ -152,7 +533,9 @@ class Database(object):
         #
         if not (journal_mode == u"WAL" or self._file_path == u":memory:"):
             logger.debug("PRAGMA journal_mode = WAL (previously: %s) [%s]", journal_mode, self._file_path)
-            self._cursor.execute(u"PRAGMA locking_mode = EXCLUSIVE")
+            # the durability thread and the read-only connections need their own connection
+            if not (self._write_behind or self._read_connections):
+                self._cursor.execute(u"PRAGMA locking_mode = EXCLUSIVE")
             self._cursor.execute(u"PRAGMA journal_mode = WAL")
 
         else:
@@ -162,13 +545,35 @@ class Database(object):
         # PRAGMA synchronous = 0 | OFF | 1 | NORMAL | 2 | FULL;
         # http://www.sqlite.org/pragma.html#pragma_synchronous
         #
-        if not synchronous in (u"NORMAL", u"1"):
-            logger.debug("PRAGMA synchronous = NORMAL (previously: %s) [%s]", synchronous, self._file_path)
-            self._cursor.execute(u"PRAGMA synchronous = NORMAL")
+        if self._write_behind:
+            # the durability thread syncs to disk and checkpoints, commits only write the WAL file
+            logger.debug("PRAGMA synchronous = OFF (write-behind) [%s]", self._file_path)
+            self._cursor.execute(u"PRAGMA synchronous = OFF")
+            self._cursor.execute(u"PRAGMA wal_autocheckpoint = 0")
+
+        elif not synchronous in (self._tuning.synchronous, {u"OFF": u"0", u"NORMAL": u"1", u"FULL": u"2"}[self._tuning.synchronous]):
+            logger.debug("PRAGMA synchronous = %s (previously: %s) [%s]", self._tuning.synchronous, synchronous, self._file_path)
+            self._cursor.execute(u"PRAGMA synchronous = %s" % self._tuning.synchronous)
 
         else:
             logger.debug("PRAGMA synchronous = %s (no change) [%s]", synchronous, self._file_path)
 
+        #
+        # PRAGMA wal_autocheckpoint = N;
+        # http://www.sqlite.org/pragma.html#pragma_wal_autocheckpoint
+        #
+        if not (self._write_behind or self._tuning.wal_autocheckpoint is None):
+            logger.debug("PRAGMA wal_autocheckpoint = %d [%s]", self._tuning.wal_autocheckpoint, self._file_path)
+            self._cursor.execute(u"PRAGMA wal_autocheckpoint = %d" % self._tuning.wal_autocheckpoint)
+
+        #
+        # cache_size, mmap_size, temp_store, and busy_timeout
+        # http://www.sqlite.org/pragma.html
+        #
+        for statement in self._tuning.get_connection_statements():
+            logger.debug("%s (%s) [%s]", statement, self._tuning.name, self._file_path)
+            self._cursor.execute(statement)
+
     def _prepare_version(self):
         assert self._cursor is not None, "Database.close() has been called or Database.open() has not been called"
         assert self._connection is not None, "Database.close() has been called or Database.open() has not been called"
@@ -204,6 +609,62 @@ class Database(object):
         """
         return self._file_path
 
+    @property
+    def tuning(self):
+        """
+        The TuningProfile that is applied when the database is opened.
+        """
+        return self._tuning
+
+    @property
+    def write_behind(self):
+        """
+        True when commits are made durable by a separate thread.
+        """
+        return self._write_behind
+
+    @property
+    def read_connections(self):
+        """
+        The number of read-only connections used by run_read_only, 0 when the queries run on this
+        connection.
+        """
+        return self._read_connections
+
+    def run_read_only(self, func, *args):
+        """
+        Returns a Deferred that fires, on the reactor thread, with the result of FUNC(execute,
+        *ARGS).
+
+        FUNC must only access the database using the EXECUTE function that it is given and must
+        not modify it.  When read-only connections are available FUNC is called on a worker thread
+        using one of these connections, otherwise FUNC is called immediately using self.execute.
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.run_read_only on the wrong thread"
+        if self._read_only_pool:
+            return self._read_only_pool.defer(func, *args)
+        return maybeDeferred(func, self.execute, *args)
+
+    def durable(self):
+        """
+        Returns a Deferred that fires, on the reactor thread, once everything that has been
+        committed is on disk.
+
+        When commits are deferred, i.e. within a 'with database:' clause, the Deferred waits for
+        the commit that is performed when the clause is left.  Without write-behind mode every
+        commit is durable, hence the Deferred has already fired.
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.durable on the wrong thread"
+        if not self._durability_thread:
+            return succeed(None)
+
+        deferred = Deferred()
+        if self._pending_commits:
+            self._durability_requests.append(deferred)
+        else:
+            self._durability_thread.request(deferred)
+        return deferred
+
     def __enter__(self):
         """
         Enters a no-commit state.  The commit will be performed by __exit__.
@@ -295,6 +756,28 @@ class Database(object):
             result = self._cursor.lastrowid
         return result
 
+    def explain_query_plan(self, statement, bindings=()):
+        """
+        Returns the query plan that SQLite will use for STATEMENT.
+
+        Each row in the returned list is a tuple where the last item describes one step of the
+        plan, for example u'SEARCH sync USING INDEX ...' or u'SCAN sync'.  The statement itself is
+        not executed.
+
+        @param statement: the SQL statement that is to be explained.
+        @type statement: unicode
+
+        @param bindings: the values that must be set to the placeholders in statement.
+        @type bindings: list, tuple, dict, or set
+
+        @rtype: [tuple]
+        """
+        assert self._cursor is not None, "Database.close() has been called or Database.open() has not been called"
+        assert self._connection is not None, "Database.close() has been called or Database.open() has not been called"
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.execute on the wrong thread"
+        assert isinstance(statement, unicode), "The SQL statement must be given in unicode"
+        return list(self._cursor.execute(u"EXPLAIN QUERY PLAN %s" % statement, bindings))
+
     @attach_runtime_statistics("{0.__class__.__name__}.{function_name} {1} [{0.file_path}]")
     def executescript(self, statements):
         assert self._cursor is not None, "Database.close() has been called or Database.open() has not been called"
@@ -387,7 +870,13 @@ class Database(object):
                 except Exception as exception:
                     logger.exception("%s [%s]", exception, self._file_path)
 
-            return self._connection.commit()
+            result = self._connection.commit()
+            if self._durability_thread:
+                self._durability_thread.notify_commit()
+                requests, self._durability_requests = self._durability_requests, []
+                for deferred in requests:
+                    self._durability_thread.request(deferred)
+            return result
 
     @abstractmethod
     def check_database(self, database_version):
@@ -0,0 +1,129 @@
+"""
+The DelayIndex holds the packets and messages that a community delayed, keyed by what they are
+waiting for.
+
+A key is a (meta name, mid, global time, sequence number) tuple where None matches anything.  The
+keys are stored as they are, and the index remembers which elements (the mask) are not None for
+the keys in use.  A received message is matched by building, for every mask in use, the key
+that it matches exactly and looking that key up.  Hence resuming costs the number of masks in use,
+which is small, instead of the number of delayed keys.
+
+The delays are also kept in a heap ordered by their timestamp such that expired delays are found
+without looking at the others.
+"""
+
+from heapq import heappop, heappush
+from itertools import count
+
+from .logger import get_logger
+logger = get_logger(__name__)
+
+
+def get_mask(key):
+    """
+    Returns a tuple telling which elements of KEY are not None.
+    """
+    return tuple(element is not None for element in key)
+
+
+class DelayIndex(object):
+
+    def __init__(self):
+        super(DelayIndex, self).__init__()
+        # KEY:[Delay] dictionary
+        self._keys = {}
+        # Delay:[KEY] dictionary
+        self._delays = {}
+        # MASK:COUNT dictionary with the number of keys in self._keys for each mask
+        self._masks = {}
+        # (timestamp, sequence, Delay) heap, entries of delays that are no longer in the index are
+        # dropped once they expire
+        self._timeouts = []
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._delays)
+
+    def __contains__(self, delay):
+        return delay in self._delays
+
+    def add(self, key, delay):
+        """
+        Delay DELAY until a message matching KEY is received.
+
+        Returns True when no other delay is waiting for KEY, i.e. when the missing message still
+        needs to be requested.
+        """
+        assert isinstance(key, tuple), type(key)
+        assert len(key) == 4, key
+        delays = self._keys.get(key)
+        if delays is None:
+            delays = self._keys[key] = []
+            mask = get_mask(key)
+            self._masks[mask] = self._masks.get(mask, 0) + 1
+
+        delays.append(delay)
+        if not delay in self._delays:
+            self._delays[delay] = []
+            heappush(self._timeouts, (delay.timestamp, next(self._sequence), delay))
+        self._delays[delay].append(key)
+        return len(delays) == 1
+
+    def _pop_key(self, key):
+        delays = self._keys.pop(key)
+        mask = get_mask(key)
+        self._masks[mask] -= 1
+        if self._masks[mask] == 0:
+            del self._masks[mask]
+        return delays
+
+    def remove(self, delay):
+        """
+        Remove DELAY and all the keys that it is waiting for.
+        """
+        for key in self._delays.pop(delay):
+            delays = self._keys.get(key)
+            # the key is gone when it was received while DELAY was waiting for it more than once
+            if delays is not None:
+                delays.remove(delay)
+                if not delays:
+                    self._pop_key(key)
+
+    def resume(self, received_key):
+        """
+        Match RECEIVED_KEY, the key of a message that was received, against the delayed keys.
+
+        Returns the delays that are no longer waiting for anything, or that resume immediately,
+        these are removed from the index.
+        """
+        assert isinstance(received_key, tuple), type(received_key)
+        assert len(received_key) == 4, received_key
+        succeeded = []
+        for mask in self._masks.keys():
+            key = tuple(element if present else None for element, present in zip(received_key, mask))
+            if not key in self._keys:
+                continue
+
+            for delay in self._pop_key(key):
+                keys = self._delays.get(delay)
+                if keys is None:
+                    # removed while resuming an earlier key
+                    continue
+
+                keys.remove(key)
+                if not keys or delay.resume_immediately:
+                    self.remove(delay)
+                    succeeded.append(delay)
+        return succeeded
+
+    def expire(self, deadline):
+        """
+        Returns the delays whose timestamp is before DEADLINE, these are removed from the index.
+        """
+        expired = []
+        while self._timeouts and self._timeouts[0][0] < deadline:
+            _, _, delay = heappop(self._timeouts)
+            if delay in self._delays:
+                self.remove(delay)
+                expired.append(delay)
+        return expired
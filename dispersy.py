@@ -44,6 +44,7 @@ from hashlib import sha1
 from itertools import groupby, count
 from pprint import pformat
 from socket import inet_aton, error as socket_error
+from sqlite3 import sqlite_version_info
 from struct import unpack_from
 from time import time
 
@@ -56,9 +57,10 @@ from twisted.python.threadable import isInIOThread
 
 from .authentication import MemberAuthentication, DoubleMemberAuthentication
 from .bootstrap import Bootstrap
-from .candidate import BootstrapCandidate, LoopbackCandidate, WalkCandidate, Candidate
+from .candidate import BootstrapCandidate, LoopbackCandidate, WalkCandidate, Candidate, CandidateRegistry
 from .community import Community
 from .crypto import DispersyCrypto, ECCrypto
+from .database import TuningProfile
 from .destination import CommunityDestination, CandidateDestination
 from .dispersydatabase import DispersyDatabase
 from .distribution import (SyncDistribution, FullSyncDistribution, LastSyncDistribution,
@@ -68,6 +70,7 @@ from .exception import CommunityNotFoundException, ConversionNotFoundException,
 from .member import DummyMember, Member
 from .message import (Message, DropMessage, DelayMessageBySequence,
                       DropPacket, DelayPacket)
+from .signatureverifier import SignatureVerifier
 from .statistics import DispersyStatistics
 from .util import attach_runtime_statistics, get_logger, init_instrumentation
 
@@ -79,6 +82,9 @@ logger = get_logger(__name__)
 
 FLUSH_DATABASE_INTERVAL = 60.0
 STATS_DETAILED_CANDIDATES_INTERVAL = 5.0
+# the maximum number of values in the IN list of a single duplicate query, SQLite allows at most 999
+# bindings per statement
+DUPLICATE_QUERY_SIZE = 400
 
 
 class Dispersy(object):
@@ -88,7 +94,7 @@ class Dispersy(object):
     outgoing data for, possibly, multiple communities.
     """
 
-    def __init__(self, endpoint, working_directory, database_filename=u"dispersy.db", crypto=ECCrypto()):
+    def __init__(self, endpoint, working_directory, database_filename=u"dispersy.db", crypto=ECCrypto(), verify_processes=0, database_write_behind=False, database_read_connections=0, database_tuning=None):
         """
         Initialise a Dispersy instance.
 
@@ -100,11 +106,36 @@ class Dispersy(object):
 
         @param database_filename: The database filename or u":memory:"
         @type database_filename: unicode
+
+        @param verify_processes: The number of worker processes that verify incoming signatures, or 0
+         to verify them on the reactor thread.
+        @type verify_processes: int
+
+        @param database_write_behind: When True database commits do not wait for the disk, a
+         separate thread makes them durable.  Our own messages are only forwarded once they are
+         durable.
+        @type database_write_behind: bool
+
+        @param database_read_connections: The number of read-only database connections that are
+         used to answer sync and missing-* requests on worker threads, or 0 to answer them on the
+         reactor thread.
+        @type database_read_connections: int
+
+        @param database_tuning: The SQLite settings, either a TuningProfile or the name of one of
+         the database.TUNING_PROFILES, such as u"tracker-in-memory", u"desktop", or u"server-ssd".
+         By default only PRAGMA synchronous is changed.
+        @type database_tuning: TuningProfile or unicode
         """
         assert isinstance(endpoint, Endpoint), type(endpoint)
         assert isinstance(working_directory, unicode), type(working_directory)
         assert isinstance(database_filename, unicode), type(database_filename)
         assert isinstance(crypto, DispersyCrypto), type(crypto)
+        assert isinstance(verify_processes, int), type(verify_processes)
+        assert verify_processes >= 0, verify_processes
+        assert isinstance(database_write_behind, bool), type(database_write_behind)
+        assert isinstance(database_read_connections, int), type(database_read_connections)
+        assert database_read_connections >= 0, database_read_connections
+        assert database_tuning is None or isinstance(database_tuning, (TuningProfile, unicode)), type(database_tuning)
         super(Dispersy, self).__init__()
 
         self.running = False
@@ -129,10 +160,18 @@ class Dispersy(object):
             if not os.path.isdir(database_directory):
                 os.makedirs(database_directory)
             database_filename = os.path.join(database_directory, database_filename)
-        self._database = DispersyDatabase(database_filename)
+        self._database = DispersyDatabase(database_filename, write_behind=database_write_behind, read_connections=database_read_connections, tuning=database_tuning)
 
         self._crypto = crypto
 
+        # (mid, sha1(data), signature) triplets with a valid signature in least recently used order,
+        # see Member.verify
+        self._verified_signatures = OrderedDict()
+
+        # the worker processes are started in Dispersy.start
+        self._verify_processes = verify_processes
+        self._signature_verifier = None
+
         # indicates what our connection type is.  currently it can be u"unknown", u"public", or
         # u"symmetric-NAT"
         self._connection_type = u"unknown"
@@ -143,6 +182,8 @@ class Dispersy(object):
         self._lan_address = ((interface.address if interface else "0.0.0.0"), 0)
         self._wan_address = ("0.0.0.0", 0)
         self._wan_address_votes = defaultdict(set)
+        # SOCK_ADDR:ADDRESS dictionary with the vote made by each voter
+        self._wan_address_voters = {}
         logger.debug("my LAN address is %s:%d", self._lan_address[0], self._lan_address[1])
         logger.debug("my WAN address is %s:%d", self._wan_address[0], self._wan_address[1])
         logger.debug("my connection type is %s", self._connection_type)
@@ -150,6 +191,10 @@ class Dispersy(object):
         # bootstrap peers
         self._bootstrap_candidates = dict()
 
+        # the addresses of the candidates in all communities, shared by the WalkCandidates of one
+        # peer
+        self._candidate_registry = CandidateRegistry()
+
         # communities that can be auto loaded.  classification:(cls, args, kargs) pairs.
         self._auto_load_communities = OrderedDict()
 
@@ -400,6 +445,15 @@ class Dispersy(object):
         """
         return self._crypto
 
+    @property
+    def signature_verifier(self):
+        """
+        The SignatureVerifier that verifies incoming signatures on worker processes, or None when
+        signatures are verified on the reactor thread.
+        @rtype: SignatureVerifier or None
+        """
+        return self._signature_verifier
+
     @property
     def statistics(self):
         """
@@ -606,6 +660,9 @@ class Dispersy(object):
         self._communities[community.cid] = community
         community.dispersy_check_database()
 
+        if self._endpoint.rate_limiter:
+            self._endpoint.rate_limiter.set_community_rate(community.cid, community.dispersy_upload_rate)
+
         # count the number of times that a community was attached
         self._statistics.dict_inc(self._statistics.attachment, community.cid)
 
@@ -637,6 +694,9 @@ class Dispersy(object):
         logger.debug("Community %s %s is detached", community.cid.encode("HEX"), community.get_classification())
         del self._communities[community.cid]
 
+        if self._endpoint.rate_limiter:
+            self._endpoint.rate_limiter.set_community_rate(community.cid, None)
+
         # remove any items that are left in the cache
         community.purge_batch_cache()
 
@@ -800,13 +860,14 @@ class Dispersy(object):
         Removes and returns one vote made by VOTER.
         """
         assert isinstance(voter, Candidate)
-        for vote, voters in self._wan_address_votes.iteritems():
-            if voter.sock_addr in voters:
-                logger.debug("removing vote for %s made by %s", vote, voter)
-                voters.remove(voter.sock_addr)
-                if len(voters) == 0:
-                    del self._wan_address_votes[vote]
-                return vote
+        vote = self._wan_address_voters.pop(voter.sock_addr, None)
+        if vote:
+            logger.debug("removing vote for %s made by %s", vote, voter)
+            voters = self._wan_address_votes[vote]
+            voters.remove(voter.sock_addr)
+            if len(voters) == 0:
+                del self._wan_address_votes[vote]
+            return vote
 
     def wan_address_vote(self, address, voter):
         """
@@ -875,6 +936,7 @@ class Dispersy(object):
         # do vote
         logger.debug("add vote for %s from %s", address, voter.sock_addr)
         self._wan_address_votes[address].add(voter.sock_addr)
+        self._wan_address_voters[voter.sock_addr] = address
 
         #
         # check self._lan_address and self._wan_address
@@ -918,10 +980,40 @@ class Dispersy(object):
         else:
             set_connection_type(u"unknown")
 
-    def _is_duplicate_sync_message(self, message):
+    def _fetch_sync_duplicates(self, messages):
+        """
+        Returns a (member_id, global_time):(packet, undone) dictionary containing the packets that we
+        already have with the same community, member, and global time as one of MESSAGES.
+
+        All MESSAGES must be from the same community.  The packets are retrieved using one query
+        for every member and DUPLICATE_QUERY_SIZE global times, the result can be given to
+        _is_duplicate_sync_message to check each message without querying the database again.
+        """
+        assert isinstance(messages, list)
+        assert all(isinstance(message, Message.Implementation) for message in messages)
+        assert all(message.community == messages[0].community for message in messages)
+        global_times = defaultdict(set)
+        for message in messages:
+            global_times[message.authentication.member.database_id].add(message.distribution.global_time)
+
+        duplicates = {}
+        for member_id, member_global_times in global_times.iteritems():
+            member_global_times = list(member_global_times)
+            for index in xrange(0, len(member_global_times), DUPLICATE_QUERY_SIZE):
+                batch = member_global_times[index:index + DUPLICATE_QUERY_SIZE]
+                for global_time, packet, undone in self._database.execute(
+                        u"SELECT global_time, packet, undone FROM sync WHERE community = ? AND member = ? AND global_time IN (%s)" % u", ".join(u"?" * len(batch)),
+                        [messages[0].community.database_id, member_id] + batch):
+                    duplicates[(member_id, global_time)] = (str(packet), undone)
+        return duplicates
+
+    def _is_duplicate_sync_message(self, message, duplicates=None):
         """
         Returns True when this message is a duplicate, otherwise the message must be processed.
 
+        When DUPLICATES, as returned by _fetch_sync_duplicates, is given the packet that we already
+        have is taken from there instead of from the database.
+
         === Problem: duplicate message ===
         The simplest reason to drop an incoming message is when we already have it, based on the
         community, member, and global time.  No further action is performed.
@@ -954,16 +1046,25 @@ class Dispersy(object):
         until the bloom filter is synced with the database again.
         """
         community = message.community
-        # fetch the duplicate binary packet from the database
-        try:
-            have_packet, undone = self._database.execute(u"SELECT packet, undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
-                                                        (community.database_id, message.authentication.member.database_id, message.distribution.global_time)).next()
-        except StopIteration:
+        key = (message.authentication.member.database_id, message.distribution.global_time)
+        if duplicates is None:
+            # fetch the duplicate binary packet from the database
+            try:
+                have_packet, undone = self._database.execute(u"SELECT packet, undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                            (community.database_id,) + key).next()
+            except StopIteration:
+                have_packet = None
+            else:
+                have_packet = str(have_packet)
+
+        else:
+            have_packet, undone = duplicates.get(key, (None, 0))
+
+        if have_packet is None:
             logger.debug("this message is not a duplicate")
             return False
 
         else:
-            have_packet = str(have_packet)
             if have_packet == message.packet:
                 # exact binary duplicate, do NOT process the message
                 logger.warning("received identical message %s %d@%d from %s %s",
@@ -995,11 +1096,13 @@ class Dispersy(object):
 
                     if have_packet < message.packet:
                         # replace our current message with the other one
-                        self._database.execute(u"UPDATE sync SET packet = ? WHERE community = ? AND member = ? AND global_time = ?",
-                                               (buffer(message.packet), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
+                        self._database.execute(u"UPDATE sync SET packet = ?, digest = ? WHERE community = ? AND member = ? AND global_time = ?",
+                                               (buffer(message.packet), buffer(message.packet_digest), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
+                        if duplicates is not None:
+                            duplicates[key] = (message.packet, undone)
 
                         # notify that global times have changed
-                        # community.update_sync_range(message.meta, [message.distribution.global_time])
+                        community.update_sync_range(message.meta, [message.distribution.global_time])
 
                 else:
                     logger.warning("received message with duplicate community/member/global-time triplet from %s.  possibly malicious behaviour", message.candidate)
@@ -1041,14 +1144,18 @@ class Dispersy(object):
         # refuse messages where the global time is unreasonably high
         acceptable_global_time = messages[0].community.acceptable_global_time
 
+        # obtain the packets that we already have, for all messages at once
+        duplicates = self._fetch_sync_duplicates(messages)
+
         if enable_sequence_number:
             # obtain the highest sequence_number from the database
-            highest = {}
-            for message in messages:
-                if not message.authentication.member.database_id in highest:
-                    last_global_time, last_seq, count = execute(u"SELECT MAX(global_time), MAX(sequence), COUNT(*) FROM sync WHERE member = ? AND meta_message = ?",
-                                                    (message.authentication.member.database_id, message.database_id)).next()
-                    highest[message.authentication.member.database_id] = (last_global_time or 0, last_seq or 0)
+            members = list(set(message.authentication.member.database_id for message in messages))
+            highest = dict((member_id, (0, 0)) for member_id in members)
+            for index in xrange(0, len(members), DUPLICATE_QUERY_SIZE):
+                batch = members[index:index + DUPLICATE_QUERY_SIZE]
+                for member_id, last_global_time, last_seq, count in execute(u"SELECT member, MAX(global_time), MAX(sequence), COUNT(*) FROM sync WHERE meta_message = ? AND member IN (%s) GROUP BY member" % u", ".join(u"?" * len(batch)),
+                                                                           [messages[0].database_id] + batch):
+                    highest[member_id] = (last_global_time or 0, last_seq or 0)
                     assert last_seq or 0 == count, [last_seq, count]
 
             # all messages must follow the sequence_number order
@@ -1093,8 +1200,19 @@ class Dispersy(object):
 
                         else:
                             # TODO we should undo the messages that we are about to remove (when applicable)
+                            items = list(execute(u"SELECT global_time, packet FROM sync WHERE member = ? AND meta_message = ? AND global_time >= ?",
+                                                 (message.authentication.member.database_id, message.database_id, global_time)))
+                            global_times = [global_time_ for global_time_, _ in items]
                             execute(u"DELETE FROM sync WHERE member = ? AND meta_message = ? AND global_time >= ?",
                                     (message.authentication.member.database_id, message.database_id, global_time))
+                            for global_time_ in global_times:
+                                duplicates.pop((message.authentication.member.database_id, global_time_), None)
+
+                            # notify that global times have changed
+                            message.community.update_sync_range(message.meta, global_times)
+
+                            # the removed packets must be accepted again when they are resent
+                            message.community.forget_recent_packets([str(packet_) for _, packet_ in items])
 
                             # by deleting messages we changed SEQ and the HIGHEST cache
                             last_global_time, last_seq, count = execute(u"SELECT MAX(global_time), MAX(sequence), COUNT(*) FROM sync WHERE member = ? AND meta_message = ?",
@@ -1110,7 +1228,7 @@ class Dispersy(object):
 
                 # we have the previous message, check for duplicates based on community,
                 # member, and global_time
-                if self._is_duplicate_sync_message(message):
+                if self._is_duplicate_sync_message(message, duplicates):
                     # we have the previous message (drop)
                     yield DropMessage(message, "duplicate message by global_time (1)")
                     continue
@@ -1143,7 +1261,7 @@ class Dispersy(object):
                 unique.add(key)
 
                 # check for duplicates based on community, member, and global_time
-                if self._is_duplicate_sync_message(message):
+                if self._is_duplicate_sync_message(message, duplicates):
                     # we have the previous message (drop)
                     yield DropMessage(message, "duplicate message by global_time (2)")
                     continue
@@ -1210,7 +1328,7 @@ class Dispersy(object):
                     assert len(times[message.authentication.member.database_id]) <= message.distribution.history_size, [message.packet_id, message.distribution.history_size, times[message.authentication.member.database_id]]
                 tim = times[message.authentication.member.database_id]
 
-                if message.distribution.global_time in tim and self._is_duplicate_sync_message(message):
+                if message.distribution.global_time in tim and self._is_duplicate_sync_message(message, duplicates):
                     return DropMessage(message, "duplicate message by member^global_time (3)")
 
                 elif len(tim) >= message.distribution.history_size and min(tim) > message.distribution.global_time:
@@ -1264,7 +1382,7 @@ class Dispersy(object):
                 else:
                     unique.add(key)
 
-                    if self._is_duplicate_sync_message(message):
+                    if self._is_duplicate_sync_message(message, duplicates):
                         # we have the previous message (drop)
                         logger.debug("drop %s %s@%d (_is_duplicate_sync_message)", message.name, members, message.distribution.global_time)
                         return DropMessage(message, "duplicate message by member^global_time (4)")
@@ -1310,8 +1428,11 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
 
                                 if have_packet < message.packet:
                                     # replace our current message with the other one
-                                    self._database.execute(u"UPDATE sync SET member = ?, packet = ? WHERE id = ?",
-                                                           (message.authentication.member.database_id, buffer(message.packet), packet_id))
+                                    self._database.execute(u"UPDATE sync SET member = ?, packet = ?, digest = ? WHERE id = ?",
+                                                           (message.authentication.member.database_id, buffer(message.packet), buffer(message.packet_digest), packet_id))
+
+                                    # notify that global times have changed
+                                    message.community.update_sync_range(message.meta, [message.distribution.global_time])
 
                                     return DropMessage(message, "replaced existing packet with other packet with the same payload")
 
@@ -1353,6 +1474,10 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         # refuse messages that have been pruned (or soon will be)
         messages = [DropMessage(message, "message has been pruned") if isinstance(message, Message.Implementation) and not message.distribution.pruning.is_active() else message for message in messages]
 
+        # obtain the packets that we already have, for all messages at once
+        candidates = [message for message in messages if isinstance(message, Message.Implementation)]
+        duplicates = self._fetch_sync_duplicates(candidates) if candidates else {}
+
         # for meta data messages
         if meta.distribution.custom_callback:
             unique = set()
@@ -1365,7 +1490,12 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
             # distribution.global_time), is unique.  UNIQUE is used in the check_member_and_global_time
             # function
             unique = set()
-            times = {}
+            times = dict((message.authentication.member.database_id, []) for message in candidates)
+            for index in xrange(0, len(times), DUPLICATE_QUERY_SIZE):
+                batch = times.keys()[index:index + DUPLICATE_QUERY_SIZE]
+                for member_id, global_time in self._database.execute(u"SELECT member, global_time FROM sync WHERE community = ? AND meta_message = ? AND member IN (%s)" % u", ".join(u"?" * len(batch)),
+                                                                     [meta.community.database_id, meta.database_id] + batch):
+                    times[member_id].append(global_time)
             messages = [message if isinstance(message, DropMessage) else check_member_and_global_time(unique, times, message) for message in messages]
 
         # instead of storing HISTORY_SIZE messages for each authentication.member, we will store
@@ -1574,7 +1704,9 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         highest_global_time = 0
         highest_sequence_number = defaultdict(int)
 
-        # update_sync_range = set()
+        update_sync_range = set()
+        obsolete_packets = []
+        enable_sequence_number = isinstance(meta.distribution, FullSyncDistribution) and meta.distribution.enable_sequence_number
         for message in messages:
             # the signature must be set
             assert isinstance(message.authentication, (MemberAuthentication.Implementation, DoubleMemberAuthentication.Implementation)), message.authentication
@@ -1585,29 +1717,37 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
 
             logger.debug("%s %d@%d", message.name, message.authentication.member.database_id, message.distribution.global_time)
 
-            # add packet to database
-            message.packet_id = self._database.execute(
-                u"INSERT INTO sync (community, member, global_time, meta_message, packet, sequence) "
-                u"VALUES (?, ?, ?, ?, ?, ?)",
-               (message.community.database_id,
-                message.authentication.member.database_id,
-                message.distribution.global_time,
-                message.database_id,
-                buffer(message.packet),
-                (message.distribution.sequence_number if
-                 isinstance(meta.distribution, FullSyncDistribution)
-                 and message.distribution.enable_sequence_number else None)
-                ), get_lastrowid=True)
-
-            # ensure that we can reference this packet
+        # add packets to database.  the sync.id column is AUTOINCREMENT, hence all rows inserted
+        # below get an id that is higher than the current maximum
+        last_packet_id, = self._database.execute(u"SELECT MAX(id) FROM sync").next()
+        self._database.executemany(
+            u"INSERT INTO sync (community, member, global_time, meta_message, packet, sequence, digest) "
+            u"VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(message.community.database_id,
+              message.authentication.member.database_id,
+              message.distribution.global_time,
+              message.database_id,
+              buffer(message.packet),
+              message.distribution.sequence_number if enable_sequence_number else None,
+              buffer(message.packet_digest))
+             for message in messages])
+
+        # ensure that we can reference these packets
+        packet_ids = dict(((member_id, global_time), packet_id)
+                          for packet_id, member_id, global_time
+                          in self._database.execute(u"SELECT id, member, global_time FROM sync WHERE id > ?", (last_packet_id or 0,)))
+        assert len(packet_ids) == len(messages), [len(packet_ids), len(messages)]
+        for message in messages:
+            message.packet_id = packet_ids[(message.authentication.member.database_id, message.distribution.global_time)]
             logger.debug("stored message %s in database at row %d", message.name, message.packet_id)
 
-            if is_double_member_authentication:
-                member1 = message.authentication.members[0].database_id
-                member2 = message.authentication.members[1].database_id
-                self._database.execute(u"INSERT INTO double_signed_sync (sync, member1, member2) VALUES (?, ?, ?)",
-                                       (message.packet_id, member1, member2) if member1 < member2 else (message.packet_id, member2, member1))
+        if is_double_member_authentication:
+            order = lambda member1, member2: (member1, member2) if member1 < member2 else (member2, member1)
+            self._database.executemany(u"INSERT INTO double_signed_sync (sync, member1, member2) VALUES (?, ?, ?)",
+                                       [(message.packet_id,) + order(message.authentication.members[0].database_id, message.authentication.members[1].database_id)
+                                        for message in messages])
 
+        for message in messages:
             # update global time
             highest_global_time = max(highest_global_time, message.distribution.global_time)
             if isinstance(meta.distribution, FullSyncDistribution) and message.distribution.enable_sequence_number:
@@ -1631,6 +1771,33 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
                 items = meta.distribution.custom_callback[1](messages)
 
             # default behaviour
+            elif sqlite_version_info >= (3, 25, 0):
+                # ROW_NUMBER() numbers the packets of each member (pair) from new to old, everything
+                # beyond history_size has become obsolete.  members that are not in MESSAGES can be
+                # included safely since they will not have more than history_size packets
+                if is_double_member_authentication:
+                    members1 = set(min(member.database_id for member in message.authentication.members) for message in messages)
+                    members2 = set(max(member.database_id for member in message.authentication.members) for message in messages)
+                    items = set(self._database.execute(u"""
+SELECT id, global_time
+FROM (SELECT sync.id, sync.global_time, ROW_NUMBER() OVER (PARTITION BY double_signed_sync.member1, double_signed_sync.member2 ORDER BY sync.global_time DESC, sync.packet DESC) AS position
+      FROM sync
+      JOIN double_signed_sync ON double_signed_sync.sync = sync.id
+      WHERE sync.meta_message = ? AND double_signed_sync.member1 IN (%s) AND double_signed_sync.member2 IN (%s))
+WHERE position > ?""" % (u", ".join(u"?" * len(members1)), u", ".join(u"?" * len(members2))),
+                        [meta.database_id] + list(members1) + list(members2) + [meta.distribution.history_size]))
+
+                else:
+                    members = set(message.authentication.member.database_id for message in messages)
+                    items = set(self._database.execute(u"""
+SELECT id, global_time
+FROM (SELECT id, global_time, ROW_NUMBER() OVER (PARTITION BY member ORDER BY global_time DESC) AS position
+      FROM sync
+      WHERE meta_message = ? AND member IN (%s))
+WHERE position > ?""" % u", ".join(u"?" * len(members)),
+                        [meta.database_id] + list(members) + [meta.distribution.history_size]))
+
+            # SQLite does not support window functions, one query per member (pair)
             else:
                 if is_double_member_authentication:
                     order = lambda member1, member2: (member1, member2) if member1 < member2 else (member2, member1)
@@ -1656,12 +1823,14 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
                             items.update(all_items[:len(all_items) - meta.distribution.history_size])
 
             if items:
+                if meta.community.dispersy_recent_packets_size:
+                    obsolete_packets = [str(packet) for syncid, _ in items for packet, in self._database.execute(u"SELECT packet FROM sync WHERE id = ?", (syncid,))]
                 self._database.executemany(u"DELETE FROM sync WHERE id = ?", [(syncid,) for syncid, _ in items])
 
                 if is_double_member_authentication:
                     self._database.executemany(u"DELETE FROM double_signed_sync WHERE sync = ?", [(syncid,) for syncid, _ in items])
 
-                # update_sync_range.update(global_time for _, _, global_time in items)
+                update_sync_range.update(global_time for _, global_time in items)
 
             # 12/10/11 Boudewijn: verify that we do not have to many packets in the database
             if __debug__:
@@ -1675,14 +1844,26 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
 
         meta.community.dispersy_store(messages)
 
-        # if update_sync_range:
-        # notify that global times have changed
-        #     meta.community.update_sync_range(meta, update_sync_range)
+        if update_sync_range:
+            # notify that global times have changed
+            meta.community.update_sync_range(meta, update_sync_range)
+
+        if obsolete_packets:
+            # the obsolete packets are no longer stored, hence they are not duplicates when they are
+            # received again.  this includes any of MESSAGES that became obsolete immediately
+            meta.community.forget_recent_packets(obsolete_packets)
 
     @property
     def bootstrap_candidates(self):
         return self._bootstrap_candidates.itervalues()
 
+    @property
+    def candidate_registry(self):
+        """
+        The CandidateRegistry with the addresses of the candidates in all communities.
+        """
+        return self._candidate_registry
+
     def estimate_lan_and_wan_addresses(self, sock_addr, lan_address, wan_address):
         """
         We received a message from SOCK_ADDR claiming to have LAN_ADDRESS and WAN_ADDRESS, returns
@@ -1776,15 +1957,30 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
         # 07/10/11 Boudewijn: we will only commit if it the message was create by our self.
         # Otherwise we can safely skip the commit overhead, since, if a crash occurs, we will be
         # able to obtain the data eventually
+        #
+        # The read-only connections only see committed data, when they are used every stored batch
+        # is committed, otherwise received messages are not offered to other nodes until the next
+        # _flush_database
         if store:
             my_messages = sum(message.authentication.member == message.community.my_member for message in messages)
-            if my_messages:
-                logger.debug("commit user generated message")
+            if my_messages or self._database.read_connections:
+                logger.debug("commit stored messages")
                 self._database.commit()
 
+            if my_messages:
                 self._statistics.created_count += my_messages
                 self._statistics.dict_inc(self._statistics.created, messages[0].meta.name, my_messages)
 
+                if forward and self._database.write_behind:
+                    # remote nodes may not obtain data that we have not safely synced ourselves
+                    def forward_when_durable(_):
+                        if self.running:
+                            self._forward(messages)
+                    def not_durable(failure):
+                        logger.error("not forwarding %d messages: %s", len(messages), failure.getErrorMessage())
+                    self._database.durable().addCallbacks(forward_when_durable, not_durable)
+                    return True
+
         if forward:
             return self._forward(messages)
 
@@ -2188,6 +2384,10 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
         logger.info("starting the Dispersy core...")
         results = []
 
+        # the worker processes are forked before the bootstrap, database, and endpoint threads exist
+        if self._verify_processes:
+            self._signature_verifier = SignatureVerifier(self._crypto, self._verify_processes)
+
         assert all(isinstance(result, bool) for _, result in results), [type(result) for _, result in results]
 
         # resolve bootstrap candidates
@@ -2228,6 +2428,7 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
            in reverse define_auto_load order, starting with all undefined communities
         2. closes endpoint
         3. closes database
+        4. waits for the signature verifier processes
 
         Returns False when Dispersy isn't running, or when one of the above steps fails.  Otherwise True is returned.
 
@@ -2293,9 +2494,18 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
         # stop endpoint
         results[u"endpoint"] = self._endpoint.close(timeout)
 
+        # stop the signature verifier, its worker processes stop while the database is closed
+        signature_verifier, self._signature_verifier = self._signature_verifier, None
+        if signature_verifier:
+            signature_verifier.close()
+
         # stop the database
         results[u"database"] = self._database.close()
 
+        # wait for the worker processes of the signature verifier
+        if signature_verifier:
+            results[u"signature verifier"] = signature_verifier.join(timeout)
+
         # log and return the result
         if all(result for result in results.itervalues()):
             logger.info("Dispersy core properly stopped")
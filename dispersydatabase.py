@@ -6,6 +6,7 @@ This module provides an interface to the Dispersy database.
 @contact: dispersy@frayja.com
 """
 
+from hashlib import sha1
 from itertools import groupby
 
 from .database import Database
@@ -13,7 +14,7 @@ from .distribution import FullSyncDistribution
 from .logger import get_logger
 logger = get_logger(__name__)
 
-LATEST_VERSION = 21
+LATEST_VERSION = 23
 
 schema = u"""
 CREATE TABLE member(
@@ -60,9 +61,10 @@ CREATE TABLE sync(
  undone INTEGER DEFAULT 0,
  packet BLOB,
  sequence INTEGER,
+ digest BLOB,                                           -- sha1 of packet
  UNIQUE(community, member, global_time));
-CREATE INDEX sync_meta_message_undone_global_time_index ON sync(meta_message, undone, global_time);
-CREATE INDEX sync_meta_message_member ON sync(meta_message, member);
+CREATE INDEX sync_meta_message_undone_global_time_digest_index ON sync(meta_message, undone, global_time, digest);
+CREATE INDEX sync_meta_message_member_global_time_index ON sync(meta_message, member, global_time);
 
 CREATE TABLE option(key TEXT PRIMARY KEY, value BLOB);
 INSERT INTO option(key, value) VALUES('database_version', '""" + str(LATEST_VERSION) + """');
@@ -478,10 +480,37 @@ UPDATE option SET value = '21' WHERE key = 'database_version';""")
                 logger.debug("upgrade database %d -> %d (done)", database_version, new_db_version)
 
             new_db_version = 22
+            if database_version < new_db_version:
+                # add the sha1 digest of each packet, allowing bloom filters to be made and checked
+                # without reading the entire packet
+                logger.debug("upgrade database %d -> %d", database_version, new_db_version)
+                self.executescript(u"""ALTER TABLE sync ADD COLUMN digest BLOB;""")
+                digests = [(buffer(sha1(str(packet)).digest()), packet_id) for packet_id, packet in self.execute(u"SELECT id, packet FROM sync")]
+                self.executemany(u"UPDATE sync SET digest = ? WHERE id = ?", digests)
+                self.executescript(u"""UPDATE option SET value = '22' WHERE key = 'database_version';""")
+                self.commit()
+                logger.debug("upgrade database %d -> %d (done)", database_version, new_db_version)
+
+            new_db_version = 23
+            if database_version < new_db_version:
+                # extend the sync indexes to cover the hot queries.  the digest allows digest bloom
+                # filters to be made from the index alone, while the global_time allows the per member
+                # history (LastSyncDistribution, sequence numbers) to be read in order without sorting
+                logger.debug("upgrade database %d -> %d", database_version, new_db_version)
+                self.executescript(u"""
+DROP INDEX IF EXISTS sync_meta_message_undone_global_time_index;
+DROP INDEX IF EXISTS sync_meta_message_member;
+CREATE INDEX sync_meta_message_undone_global_time_digest_index ON sync(meta_message, undone, global_time, digest);
+CREATE INDEX sync_meta_message_member_global_time_index ON sync(meta_message, member, global_time);
+UPDATE option SET value = '23' WHERE key = 'database_version';""")
+                self.commit()
+                logger.debug("upgrade database %d -> %d (done)", database_version, new_db_version)
+
+            new_db_version = 24
             if database_version < new_db_version:
                 # there is no version new_db_version yet...
                 # logger.debug("upgrade database %d -> %d", database_version, new_db_version)
-                # self.executescript(u"""UPDATE option SET value = '22' WHERE key = 'database_version';""")
+                # self.executescript(u"""UPDATE option SET value = '24' WHERE key = 'database_version';""")
                 # self.commit()
                 # logger.debug("upgrade database %d -> %d (done)", database_version, new_db_version)
                 pass
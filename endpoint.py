@@ -9,9 +9,15 @@ from select import select
 from time import time
 
 from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python.threadable import isInIOThread
 
 from .candidate import Candidate
 from .logger import get_logger
+from .mmsg import BatchReceiver, BATCH_SIZE, is_available as mmsg_is_available, send_batch
+from .ratelimiter import RateLimiter
+from .sendqueue import SendQueue, PRIORITY_NAMES
 
 
 logger = get_logger(__name__)
@@ -23,6 +29,9 @@ else:
 
 TUNNEL_PREFIX = "ffffffff".decode("HEX")
 
+# seconds before TwistedEndpoint tries to send its sendqueue again after a socket error
+SENDQUEUE_RETRY_DELAY = 0.01
+
 
 class Endpoint(object):
     __metaclass__ = ABCMeta
@@ -33,6 +42,12 @@ class Endpoint(object):
         self._total_down = 0
         self._total_send = 0
         self._cur_sendqueue = 0
+        self._total_sendqueue_drop = 0
+
+        # packets that are deferred by the rate limiter
+        self._rate_limiter = None
+        self._deferred = SendQueue()
+        self._deferred_call = None
 
     @property
     def total_up(self):
@@ -50,11 +65,29 @@ class Endpoint(object):
     def cur_sendqueue(self):
         return self._cur_sendqueue
 
+    @property
+    def total_sendqueue_drop(self):
+        return self._total_sendqueue_drop
+
+    @property
+    def rate_limiter(self):
+        return self._rate_limiter
+
+    def set_rate_limiter(self, rate_limiter):
+        """
+        Limit the upload bandwidth of send(...) using RATE_LIMITER, or remove the limit when
+        RATE_LIMITER is None.  Must be called before open(...).
+        """
+        assert rate_limiter is None or isinstance(rate_limiter, RateLimiter), type(rate_limiter)
+        assert not self._dispersy, "Should be called before open(...)"
+        self._rate_limiter = rate_limiter
+
     def reset_statistics(self):
         self._total_up = 0
         self._total_down = 0
         self._total_send = 0
         self._cur_sendqueue = 0
+        self._total_sendqueue_drop = 0
 
     @abstractmethod
     def get_address(self):
@@ -75,6 +108,9 @@ class Endpoint(object):
     def close(self, timeout=0.0):
         assert self._dispersy, "Should not be called before open(...)"
         assert isinstance(timeout, float), type(timeout)
+        if self._deferred_call and self._deferred_call.active():
+            self._deferred_call.cancel()
+        self._deferred_call = None
         return True
 
     def log_packet(self, sock_addr, packet, outbound=True):
@@ -93,6 +129,77 @@ class Endpoint(object):
         else:
             self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, name)
 
+    def _push_sendqueue(self, sock_addr, data):
+        """
+        Add DATA for SOCK_ADDR to self._sendqueue, counting the packets that are dropped to stay
+        within its byte budget.
+        """
+        dropped = self._sendqueue.push(sock_addr, data)
+        if dropped:
+            self._total_sendqueue_drop += len(dropped)
+            for priority, drop_sock_addr, drop_data in dropped:
+                logger.debug("sendqueue full, dropped %d bytes to %s:%d", len(drop_data), drop_sock_addr[0], drop_sock_addr[1])
+                self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"sendqueue-drop-%s" % PRIORITY_NAMES[priority])
+        self._cur_sendqueue = len(self._sendqueue)
+
+    def _rate_limit(self, candidates, packets):
+        """
+        Returns a list with the (candidate, packet) tuples that may be sent now and the number of
+        packets that are deferred because the rate limiter ran out of tokens.
+
+        Deferred packets are sent using send_packet(...) once there are enough tokens.
+        """
+        if self._rate_limiter is None:
+            return list(product(candidates, packets)), 0
+
+        now = time()
+        admitted = []
+        deferred = 0
+        for candidate, packet in product(candidates, packets):
+            data = TUNNEL_PREFIX + packet if candidate.tunnel else packet
+            delay = self._rate_limiter.admit(candidate.sock_addr, data, now)
+            if delay:
+                self._defer(candidate.sock_addr, data, delay)
+                deferred += 1
+            else:
+                admitted.append((candidate, packet))
+        return admitted, deferred
+
+    def _defer(self, sock_addr, data, delay):
+        self._rate_limiter.deferred_count += 1
+        self._rate_limiter.deferred_bytes += len(data)
+        for priority, drop_sock_addr, drop_data in self._deferred.push(sock_addr, data):
+            logger.debug("too many deferred packets, dropped %d bytes to %s:%d", len(drop_data), drop_sock_addr[0], drop_sock_addr[1])
+            self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"deferred-drop-%s" % PRIORITY_NAMES[priority])
+
+        if self._deferred_call is None:
+            self._deferred_call = reactor.callLater(delay, self._process_deferred)
+
+    def _process_deferred(self):
+        """
+        Send the deferred packets that the rate limiter admits, and schedule a new attempt for the
+        others.
+        """
+        assert self._dispersy, "Should not be called before open(...)"
+        self._deferred_call = None
+        now = time()
+        delay = None
+        blocked = []
+        for _ in xrange(len(self._deferred)):
+            sock_addr, data = self._deferred.pop()
+            wait = self._rate_limiter.admit(sock_addr, data, now)
+            if wait:
+                blocked.append((sock_addr, data))
+                delay = wait if delay is None else min(delay, wait)
+            else:
+                tunnel = data.startswith(TUNNEL_PREFIX)
+                self.send_packet(Candidate(sock_addr, tunnel), data[4:] if tunnel else data)
+
+        self._deferred.requeue_batch(blocked)
+        if self._deferred:
+            logger.debug("%d deferred packets left", len(self._deferred))
+            self._deferred_call = reactor.callLater(delay, self._process_deferred)
+
 
 class NullEndpoint(Endpoint):
 
@@ -130,7 +237,7 @@ class RawserverEndpoint(Endpoint):
         self._ip = ip
         self._add_task = self._rawserver.add_task
         self._sendqueue_lock = threading.RLock()
-        self._sendqueue = []
+        self._sendqueue = SendQueue()
 
         # _SOCKET is set during open(...)
         self._socket = None
@@ -192,8 +299,9 @@ class RawserverEndpoint(Endpoint):
         if any(len(packet) > 2 ** 16 - 60 for packet in packets):
             raise RuntimeError("UDP does not support %d byte packets" % max(len(packet) for packet in packets))
 
-        send_packet = False
-        for candidate, packet in product(candidates, packets):
+        admitted, deferred = self._rate_limit(candidates, packets)
+        send_packet = deferred > 0
+        for candidate, packet in admitted:
             if self.send_packet(candidate, packet):
                 send_packet = True
 
@@ -212,6 +320,12 @@ class RawserverEndpoint(Endpoint):
 
         data = TUNNEL_PREFIX + packet if candidate.tunnel else packet
 
+        with self._sendqueue_lock:
+            if self._sendqueue:
+                # the queued packets go first, unless DATA has a higher priority
+                self._push_sendqueue(candidate.sock_addr, data)
+                return True
+
         try:
             self._socket.sendto(data, candidate.sock_addr)
 
@@ -221,7 +335,7 @@ class RawserverEndpoint(Endpoint):
         except socket.error:
             with self._sendqueue_lock:
                 did_have_senqueue = bool(self._sendqueue)
-                self._sendqueue.append((candidate.sock_addr, data))
+                self._push_sendqueue(candidate.sock_addr, data)
 
             # If we did not have a sendqueue, then we need to call process_sendqueue in order send these messages
             if not did_have_senqueue:
@@ -233,27 +347,25 @@ class RawserverEndpoint(Endpoint):
         assert self._dispersy, "Should not be called before start(...)"
         with self._sendqueue_lock:
             if self._sendqueue:
-                index = 0
                 NUM_PACKETS = min(max(50, len(self._sendqueue) / 10), len(self._sendqueue))
                 logger.debug("%d left in sendqueue, trying to send %d packets", len(self._sendqueue), NUM_PACKETS)
 
-                for i in xrange(NUM_PACKETS):
-                    sock_addr, data = self._sendqueue[i]
+                for _ in xrange(NUM_PACKETS):
+                    sock_addr, data = self._sendqueue.pop()
                     try:
                         self._socket.sendto(data, sock_addr)
-                        index += 1
 
                         if logger.isEnabledFor(logging.DEBUG):
                             self.log_packet(sock_addr, data)
 
                     except socket.error as e:
+                        self._sendqueue.requeue(sock_addr, data)
                         if e[0] != SOCKET_BLOCK_ERRORCODE:
                             logger.warning("could not send %d to %s (%d in sendqueue)", len(data), sock_addr, len(self._sendqueue))
 
                         self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"socket-error")
                         break
 
-                self._sendqueue = self._sendqueue[index:]
                 if self._sendqueue:
                     # And schedule a new attempt
                     self._add_task(self._process_sendqueue, 0.1, "process_sendqueue")
@@ -273,7 +385,7 @@ class StandaloneEndpoint(RawserverEndpoint):
         self._running = False
         self._add_task = lambda task, delay = 0.0, id = "": None
         self._sendqueue_lock = threading.RLock()
-        self._sendqueue = []
+        self._sendqueue = SendQueue()
 
         # _THREAD and _THREAD are set during open(...)
         self._thread = None
@@ -370,6 +482,292 @@ class StandaloneEndpoint(RawserverEndpoint):
                             print >> sys.stderr, "logger object destroyed! (problably during shutdown)"
                         self.data_came_in(packets)
 
+class MmsgEndpoint(StandaloneEndpoint):
+
+    """
+    A StandaloneEndpoint that receives and sends datagrams in batches using the Linux recvmmsg and
+    sendmmsg system calls, reducing the number of system calls per datagram.
+
+    Only available when mmsg.is_available() returns True.
+    """
+
+    def __init__(self, port, ip="0.0.0.0"):
+        if not mmsg_is_available():
+            raise RuntimeError("recvmmsg and sendmmsg are not available on this platform")
+        super(MmsgEndpoint, self).__init__(port, ip)
+
+    def send(self, candidates, packets):
+        assert self._dispersy, "Should not be called before open(...)"
+        assert isinstance(candidates, (tuple, list, set)), type(candidates)
+        assert all(isinstance(candidate, Candidate) for candidate in candidates), [type(candidate) for candidate in candidates]
+        assert isinstance(packets, (tuple, list, set)), type(packets)
+        assert all(isinstance(packet, str) for packet in packets), [type(packet) for packet in packets]
+        assert all(len(packet) > 0 for packet in packets), [len(packet) for packet in packets]
+        if any(len(packet) > 2 ** 16 - 60 for packet in packets):
+            raise RuntimeError("UDP does not support %d byte packets" % max(len(packet) for packet in packets))
+
+        admitted, deferred = self._rate_limit(candidates, packets)
+        batch = [(candidate.sock_addr, TUNNEL_PREFIX + packet if candidate.tunnel else packet)
+                 for candidate, packet in admitted]
+        if not batch:
+            return deferred > 0
+
+        self._total_up += sum(len(packet) for _, packet in admitted)
+        self._total_send += len(batch)
+
+        with self._sendqueue_lock:
+            did_have_sendqueue = bool(self._sendqueue)
+            if did_have_sendqueue:
+                # the queued packets go first, unless the new packets have a higher priority
+                sent = 0
+            else:
+                try:
+                    sent = send_batch(self._socket, batch)
+                except socket.error:
+                    sent = 0
+
+            if logger.isEnabledFor(logging.DEBUG):
+                for sock_addr, data in batch[:sent]:
+                    self.log_packet(sock_addr, data)
+
+            for sock_addr, data in batch[sent:]:
+                self._push_sendqueue(sock_addr, data)
+
+        # If we did not have a sendqueue, then we need to call process_sendqueue in order send these messages
+        if sent < len(batch) and not did_have_sendqueue:
+            self._process_sendqueue()
+
+        return True
+
+    def _process_sendqueue(self):
+        assert self._dispersy, "Should not be called before start(...)"
+        with self._sendqueue_lock:
+            if self._sendqueue:
+                batch = self._sendqueue.pop_batch(max(BATCH_SIZE, len(self._sendqueue) / 10))
+                logger.debug("%d left in sendqueue, trying to send %d packets", len(self._sendqueue) + len(batch), len(batch))
+                try:
+                    sent = send_batch(self._socket, batch)
+
+                except socket.error as e:
+                    if e[0] != SOCKET_BLOCK_ERRORCODE:
+                        logger.warning("could not send %d packets from the sendqueue", len(batch))
+                    self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"socket-error")
+                    sent = 0
+
+                if logger.isEnabledFor(logging.DEBUG):
+                    for sock_addr, data in batch[:sent]:
+                        self.log_packet(sock_addr, data)
+
+                self._sendqueue.requeue_batch(batch[sent:])
+                if self._sendqueue:
+                    # And schedule a new attempt
+                    self._add_task(self._process_sendqueue, 0.1, "process_sendqueue")
+                    logger.debug("%d left in sendqueue", len(self._sendqueue))
+
+                self._cur_sendqueue = len(self._sendqueue)
+
+    def _loop(self):
+        assert self._dispersy, "Should not be called before open(...)"
+        receiver = BatchReceiver(self._socket)
+        socket_list = [self._socket.fileno()]
+
+        prev_sendqueue = 0
+        while self._running:
+            # limit the frequency of trying to write, see StandaloneEndpoint._loop
+            if self._sendqueue and (time() - prev_sendqueue) > 0.1:
+                read_list, write_list, _ = select(socket_list, socket_list, [], 0.1)
+            else:
+                read_list, write_list, _ = select(socket_list, [], [], 0.1)
+
+            if write_list:
+                self._process_sendqueue()
+                prev_sendqueue = time()
+
+            if read_list:
+                packets = []
+                try:
+                    # read until the socket is drained, every recv call returns up to
+                    # receiver.batch_size datagrams
+                    while True:
+                        batch = receiver.recv()
+                        packets.extend(batch)
+                        if len(batch) < receiver.batch_size:
+                            break
+
+                except socket.error as e:
+                    self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"socket-error-'%s'" % str(e))
+
+                finally:
+                    if packets:
+                        logger.debug('%d came in, %d bytes in total', len(packets), sum(len(packet) for _, packet in packets))
+                        self.data_came_in(packets)
+
+
+class _TwistedEndpointProtocol(DatagramProtocol):
+
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+
+    def datagramReceived(self, data, sock_addr):
+        self._endpoint.datagram_received(data, sock_addr)
+
+
+class TwistedEndpoint(Endpoint):
+
+    """
+    TwistedEndpoint listens on a UDP port of the Twisted reactor.
+
+    Unlike the StandaloneEndpoint there is no separate thread: packets are received, coalesced into
+    a single batch, and given to Dispersy on the reactor thread.  Packets that can not be sent
+    immediately are queued and sent from the reactor thread as well.
+    """
+
+    def __init__(self, port, ip="0.0.0.0"):
+        super(TwistedEndpoint, self).__init__()
+
+        self._port = port
+        self._ip = ip
+        self._sendqueue = SendQueue()
+
+        # _LISTENING_PORT is set during open(...)
+        self._listening_port = None
+        # packets that were received since the last dispatch
+        self._incoming = []
+        self._dispatch_call = None
+        self._sendqueue_call = None
+
+    def open(self, dispersy):
+        assert isInIOThread()
+        super(TwistedEndpoint, self).open(dispersy)
+
+        while True:
+            try:
+                self._listening_port = reactor.listenUDP(self._port, _TwistedEndpointProtocol(self), interface=self._ip, maxPacketSize=2 ** 16)
+                self._listening_port.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 870400)
+                self._port = self._listening_port.getHost().port
+
+                logger.debug("Listening at %d", self._port)
+            except CannotListenError:
+                self._port += 1
+                continue
+            break
+        return True
+
+    def close(self, timeout=0.0):
+        assert isInIOThread()
+        for delayed_call in (self._dispatch_call, self._sendqueue_call):
+            if delayed_call and delayed_call.active():
+                delayed_call.cancel()
+        self._dispatch_call = None
+        self._sendqueue_call = None
+        self._listening_port.stopListening()
+        return super(TwistedEndpoint, self).close(timeout)
+
+    def get_address(self):
+        assert self._dispersy, "Should not be called before open(...)"
+        host = self._listening_port.getHost()
+        return (host.host, host.port)
+
+    def datagram_received(self, data, sock_addr):
+        self._total_down += len(data)
+        if logger.isEnabledFor(logging.DEBUG):
+            self.log_packet(sock_addr, data, outbound=False)
+
+        # the reactor reads many datagrams before running delayed calls, all of them are given to
+        # Dispersy at once
+        self._incoming.append((sock_addr, data))
+        if self._dispatch_call is None:
+            self._dispatch_call = reactor.callLater(0, self._dispatch)
+
+    def _dispatch(self):
+        self._dispatch_call = None
+        packets, self._incoming = self._incoming, []
+        logger.debug('%d came in, %d bytes in total', len(packets), sum(len(packet) for _, packet in packets))
+        self.data_came_in(packets)
+
+    def data_came_in(self, packets, cache=True):
+        assert self._dispersy, "Should not be called before open(...)"
+        iterator = ((data.startswith(TUNNEL_PREFIX), sock_addr, data) for sock_addr, data in packets)
+        self._dispersy.on_incoming_packets([(Candidate(sock_addr, tunnel), data[4:] if tunnel else data)
+                                            for tunnel, sock_addr, data
+                                            in iterator],
+                                           cache,
+                                           time())
+
+    def send(self, candidates, packets):
+        assert self._dispersy, "Should not be called before open(...)"
+        assert isinstance(candidates, (tuple, list, set)), type(candidates)
+        assert all(isinstance(candidate, Candidate) for candidate in candidates), [type(candidate) for candidate in candidates]
+        assert isinstance(packets, (tuple, list, set)), type(packets)
+        assert all(isinstance(packet, str) for packet in packets), [type(packet) for packet in packets]
+        assert all(len(packet) > 0 for packet in packets), [len(packet) for packet in packets]
+        if any(len(packet) > 2 ** 16 - 60 for packet in packets):
+            raise RuntimeError("UDP does not support %d byte packets" % max(len(packet) for packet in packets))
+
+        admitted, deferred = self._rate_limit(candidates, packets)
+        send_packet = deferred > 0
+        for candidate, packet in admitted:
+            if self.send_packet(candidate, packet):
+                send_packet = True
+
+        return send_packet
+
+    def send_packet(self, candidate, packet):
+        assert self._dispersy, "Should not be called before open(...)"
+        assert isinstance(candidate, Candidate), type(candidate)
+        assert isinstance(packet, str), type(packet)
+        assert len(packet) > 0
+        if len(packet) > 2 ** 16 - 60:
+            raise RuntimeError("UDP does not support %d byte packets" % len(packet))
+
+        self._total_up += len(packet)
+        self._total_send += 1
+
+        data = TUNNEL_PREFIX + packet if candidate.tunnel else packet
+
+        if self._sendqueue:
+            # the queued packets go first, unless DATA has a higher priority
+            self._push_sendqueue(candidate.sock_addr, data)
+
+        else:
+            try:
+                self._listening_port.write(data, candidate.sock_addr)
+
+                if logger.isEnabledFor(logging.DEBUG):
+                    self.log_packet(candidate.sock_addr, data)
+
+            except socket.error:
+                self._push_sendqueue(candidate.sock_addr, data)
+                self._sendqueue_call = reactor.callLater(SENDQUEUE_RETRY_DELAY, self._process_sendqueue)
+
+        return True
+
+    def _process_sendqueue(self):
+        assert self._dispersy, "Should not be called before start(...)"
+        self._sendqueue_call = None
+        logger.debug("%d left in sendqueue", len(self._sendqueue))
+
+        while self._sendqueue:
+            sock_addr, data = self._sendqueue.pop()
+            try:
+                self._listening_port.write(data, sock_addr)
+
+            except socket.error as e:
+                self._sendqueue.requeue(sock_addr, data)
+                if e[0] != SOCKET_BLOCK_ERRORCODE:
+                    logger.warning("could not send %d to %s (%d in sendqueue)", len(data), sock_addr, len(self._sendqueue))
+
+                self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"socket-error")
+                # and schedule a new attempt
+                self._sendqueue_call = reactor.callLater(SENDQUEUE_RETRY_DELAY, self._process_sendqueue)
+                break
+
+            if logger.isEnabledFor(logging.DEBUG):
+                self.log_packet(sock_addr, data)
+
+        self._cur_sendqueue = len(self._sendqueue)
+
+
 class ManualEnpoint(StandaloneEndpoint):
 
     def __init__(self, *args, **kwargs):
@@ -440,8 +838,9 @@ class TunnelEndpoint(Endpoint):
         if any(len(packet) > 2 ** 16 - 60 for packet in packets):
             raise RuntimeError("UDP does not support %d byte packets" % max(len(packet) for packet in packets))
 
-        send_packet = False
-        for candidate, packet in product(candidates, packets):
+        admitted, deferred = self._rate_limit(candidates, packets)
+        send_packet = deferred > 0
+        for candidate, packet in admitted:
             if self.send_packet(candidate, packet):
                 send_packet = True
 
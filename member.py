@@ -1,8 +1,14 @@
+from hashlib import sha1
+
 from .logger import get_logger
 logger = get_logger(__name__)
 
 from M2Crypto.EC import EC_pub, EC
 
+# the maximum number of valid signatures that are remembered, a signature that is remembered does
+# not need to be verified again
+VERIFIED_SIGNATURES_SIZE = 4096
+
 class DummyMember(object):
 
     def __init__(self, dispersy, database_id, mid):
@@ -90,6 +96,7 @@ class Member(DummyMember):
 
         self._crypto = dispersy.crypto
         self._database = dispersy.database
+        self._verified_signatures = dispersy._verified_signatures
         self._database_id = database_id
         self._mid = mid
         self._public_key = public_key
@@ -165,9 +172,48 @@ class Member(DummyMember):
             # DATA is to small, we expect len(DATA[OFFSET:OFFSET+LENGTH]) to be LENGTH
             return False
 
-        return self._public_key and \
-            self._signature_length == len(signature) \
-            and self._crypto.is_valid_signature(self._ec, data[offset:offset + length], signature)
+        if not (self._public_key and self._signature_length == len(signature)):
+            return False
+
+        # the same packet is often verified more than once, i.e. when it is received repeatedly or
+        # when it is decoded again after being delayed or stored.  the buffer avoids copying the
+        # signed part of the packet
+        data = buffer(data, offset, length)
+        key = (self._mid, sha1(data).digest(), signature)
+        verified_signatures = self._verified_signatures
+        if key in verified_signatures:
+            # move to the end, i.e. most recently used
+            del verified_signatures[key]
+            verified_signatures[key] = None
+            return True
+
+        if self._crypto.is_valid_signature(self._ec, data, signature):
+            verified_signatures[key] = None
+            if len(verified_signatures) > VERIFIED_SIGNATURES_SIZE:
+                verified_signatures.popitem(False)
+            return True
+
+        return False
+
+    def has_verified_signature(self, data, signature):
+        """
+        Returns True when SIGNATURE is known to be a valid signature of this member for DATA.
+        """
+        assert isinstance(data, str), type(data)
+        assert isinstance(signature, str), type(signature)
+        return (self._mid, sha1(data).digest(), signature) in self._verified_signatures
+
+    def add_verified_signature(self, data, signature):
+        """
+        Remember that SIGNATURE is a valid signature of this member for DATA, i.e. because it was
+        verified elsewhere.  Verify will accept this signature without verifying it again.
+        """
+        assert isinstance(data, str), type(data)
+        assert isinstance(signature, str), type(signature)
+        verified_signatures = self._verified_signatures
+        verified_signatures[(self._mid, sha1(data).digest(), signature)] = None
+        if len(verified_signatures) > VERIFIED_SIGNATURES_SIZE:
+            verified_signatures.popitem(False)
 
     def sign(self, data, offset=0, length=0):
         """
@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
+from hashlib import sha1
 from time import time
 
 from .authentication import Authentication
@@ -305,6 +306,13 @@ class Packet(MetaObject.Implementation):
         assert isinstance(packet_id, (int, long))
         self._packet_id = packet_id
 
+    @property
+    def packet_digest(self):
+        """
+        The sha1 digest of the packet, as stored in the digest column of the sync table.
+        """
+        return sha1(self._packet).digest()
+
     def load_message(self):
         message = self._meta.community.dispersy.convert_packet_to_message(self._packet, self._meta.community, verify=False)
         message.packet_id = self._packet_id
@@ -0,0 +1,196 @@
+"""
+Receive and send batches of UDP datagrams using the Linux recvmmsg and sendmmsg system calls.
+
+Calling recvfrom or sendto once per datagram makes the system call overhead a large part of the
+CPU time spent on each packet.  recvmmsg and sendmmsg handle up to BATCH_SIZE datagrams in a
+single call.  The system calls are made through ctypes, hence they are only available on Linux
+(kernel 3.0 or later) and only for IPv4 sockets.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import socket
+import sys
+
+from .logger import get_logger
+logger = get_logger(__name__)
+
+# the maximum number of datagrams that are received or sent in a single system call
+BATCH_SIZE = 64
+
+# the maximum size of a received datagram
+BUFFER_SIZE = 2 ** 16
+
+MSG_DONTWAIT = 0x40
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_ubyte * 4),
+                ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        logger.debug("recvmmsg and sendmmsg are not available")
+        return None
+
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return libc
+
+_libc = _load_libc()
+
+
+def is_available():
+    """
+    Returns True when recvmmsg and sendmmsg can be used on this platform.
+    """
+    return _libc is not None
+
+
+def _raise_errno():
+    error = ctypes.get_errno()
+    raise socket.error(error, errno.errorcode.get(error, "unknown error"))
+
+
+class BatchReceiver(object):
+
+    """
+    Receives datagrams from a non-blocking IPv4 UDP socket in batches.
+
+    The buffers are allocated once and reused for every call to recv, hence recv must not be
+    called from more than one thread at the same time.
+    """
+
+    def __init__(self, sock, batch_size=BATCH_SIZE):
+        assert is_available(), "recvmmsg and sendmmsg are not available"
+        assert isinstance(sock, socket.socket), type(sock)
+        assert sock.family == socket.AF_INET, sock.family
+        assert isinstance(batch_size, int), type(batch_size)
+        assert batch_size > 0, batch_size
+        super(BatchReceiver, self).__init__()
+
+        self._socket = sock
+        self._batch_size = batch_size
+
+        self._buffers = (ctypes.c_char * BUFFER_SIZE * batch_size)()
+        self._addresses = (_SockAddrIn * batch_size)()
+        self._iovecs = (_IOVec * batch_size)()
+        self._headers = (_MMsgHdr * batch_size)()
+        for index in xrange(batch_size):
+            self._iovecs[index].iov_base = ctypes.addressof(self._buffers[index])
+            self._iovecs[index].iov_len = BUFFER_SIZE
+            header = self._headers[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._addresses[index])
+            header.msg_iov = ctypes.pointer(self._iovecs[index])
+            header.msg_iovlen = 1
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def recv(self):
+        """
+        Returns a list with up to BATCH_SIZE (sock_addr, data) tuples.
+
+        Returns an empty list when no datagrams are available.  Raises socket.error on any other
+        error.
+        """
+        headers = self._headers
+        for index in xrange(self._batch_size):
+            # the kernel overwrites the address length of every received datagram
+            headers[index].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+
+        count = _libc.recvmmsg(self._socket.fileno(), headers, self._batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            _raise_errno()
+
+        packets = []
+        for index in xrange(count):
+            address = self._addresses[index]
+            sock_addr = (socket.inet_ntoa(str(bytearray(address.sin_addr))), socket.ntohs(address.sin_port))
+            packets.append((sock_addr, ctypes.string_at(ctypes.addressof(self._buffers[index]), headers[index].msg_len)))
+        return packets
+
+
+def send_batch(sock, packets, batch_size=BATCH_SIZE):
+    """
+    Send (sock_addr, data) PACKETS over the non-blocking IPv4 UDP socket SOCK, at most BATCH_SIZE
+    packets per system call.
+
+    Returns the number of packets that were sent, these are always the first packets in PACKETS.
+    Raises socket.error when not even the first packet could be sent.
+    """
+    assert is_available(), "recvmmsg and sendmmsg are not available"
+    assert isinstance(sock, socket.socket), type(sock)
+    assert isinstance(packets, list), type(packets)
+    sent = 0
+    while sent < len(packets):
+        batch = packets[sent:sent + batch_size]
+        addresses = (_SockAddrIn * len(batch))()
+        iovecs = (_IOVec * len(batch))()
+        headers = (_MMsgHdr * len(batch))()
+        # the iovecs point into these buffers, they must be kept alive until sendmmsg returns
+        buffers = []
+        for index, ((host, port), data) in enumerate(batch):
+            address = addresses[index]
+            address.sin_family = socket.AF_INET
+            address.sin_port = socket.htons(port)
+            address.sin_addr[:] = bytearray(socket.inet_aton(host))
+
+            buffer_ = ctypes.create_string_buffer(data, len(data))
+            buffers.append(buffer_)
+            iovecs[index].iov_base = ctypes.addressof(buffer_)
+            iovecs[index].iov_len = len(data)
+
+            header = headers[index].msg_hdr
+            header.msg_name = ctypes.addressof(address)
+            header.msg_namelen = ctypes.sizeof(_SockAddrIn)
+            header.msg_iov = ctypes.pointer(iovecs[index])
+            header.msg_iovlen = 1
+
+        count = _libc.sendmmsg(sock.fileno(), headers, len(batch), MSG_DONTWAIT)
+        if count < 0:
+            if sent:
+                break
+            _raise_errno()
+
+        sent += count
+        if count < len(batch):
+            break
+
+    return sent
@@ -0,0 +1,199 @@
+"""
+The RateLimiter limits the upload bandwidth using token buckets.
+
+There is an optional global bucket, an optional bucket for each community, and an optional bucket
+for each destination.  A packet may only be sent when every bucket that applies to it contains
+enough tokens (bytes), the Endpoint defers the packet otherwise.  Walker packets (introduction
+requests and responses, puncture requests and punctures) are never deferred since the walker would
+time out, they are only charged to the buckets.
+"""
+
+from collections import OrderedDict
+from time import time
+
+from .logger import get_logger
+from .sendqueue import get_priority, PRIORITY_WALKER, TUNNEL_PREFIX
+logger = get_logger(__name__)
+
+# the number of seconds of traffic that a bucket can save up
+BURST_SECONDS = 1.0
+
+# a bucket can always save up for at least one UDP packet
+MIN_BURST = 2 ** 16
+
+# the maximum number of destination buckets that are kept
+CANDIDATE_BUCKETS_SIZE = 1024
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None, now=None):
+        """
+        Create a full bucket that fills up with RATE tokens per second, up to BURST tokens.
+
+        @param rate: The number of bytes per second.
+        @type rate: int or float
+
+        @param burst: The maximum number of bytes that can be sent at once, by default BURST_SECONDS
+         of traffic but at least MIN_BURST bytes.
+        @type burst: int or float
+        """
+        assert isinstance(rate, (int, long, float)), type(rate)
+        assert rate > 0, rate
+        assert burst is None or isinstance(burst, (int, long, float)), type(burst)
+        assert burst is None or burst >= MIN_BURST, burst
+        super(TokenBucket, self).__init__()
+        self._rate = float(rate)
+        self._burst = float(burst or max(rate * BURST_SECONDS, MIN_BURST))
+        self._tokens = self._burst
+        self._timestamp = time() if now is None else now
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def burst(self):
+        return self._burst
+
+    @property
+    def tokens(self):
+        """
+        The number of tokens at the last update, negative when more was charged than available.
+        @rtype: float
+        """
+        return self._tokens
+
+    def update(self, now):
+        """
+        Add the tokens that were earned since the last update.
+        """
+        if now > self._timestamp:
+            self._tokens = min(self._burst, self._tokens + (now - self._timestamp) * self._rate)
+            self._timestamp = now
+
+    def get_delay(self, size):
+        """
+        Returns the number of seconds, after the last update, before SIZE tokens are available.
+        """
+        return max(0.0, (size - self._tokens) / self._rate)
+
+    def charge(self, size):
+        """
+        Remove SIZE tokens, the bucket may go into debt.
+        """
+        self._tokens -= size
+
+    def get_statistics(self):
+        return {"rate": self._rate, "burst": self._burst, "tokens": self._tokens}
+
+
+class RateLimiter(object):
+
+    def __init__(self, global_rate=None, candidate_rate=None):
+        """
+        Create a RateLimiter that allows GLOBAL_RATE bytes per second in total and CANDIDATE_RATE
+        bytes per second to each destination.  None means unlimited.
+
+        Community rates are given by Community.dispersy_upload_rate and are registered by Dispersy
+        using set_community_rate.
+        """
+        assert global_rate is None or global_rate > 0, global_rate
+        assert candidate_rate is None or candidate_rate > 0, candidate_rate
+        super(RateLimiter, self).__init__()
+        self._global_bucket = TokenBucket(global_rate) if global_rate else None
+        self._candidate_rate = candidate_rate
+        # CID:TokenBucket dictionary
+        self._community_buckets = {}
+        # SOCK_ADDR:RATE dictionary with destination specific rates
+        self._candidate_rates = {}
+        # SOCK_ADDR:TokenBucket dictionary, the least recently used buckets are removed first
+        self._candidate_buckets = OrderedDict()
+
+        # nr of packets and bytes that had to wait
+        self.deferred_count = 0
+        self.deferred_bytes = 0
+
+    @property
+    def global_rate(self):
+        return self._global_bucket.rate if self._global_bucket else None
+
+    @property
+    def candidate_rate(self):
+        return self._candidate_rate
+
+    def set_community_rate(self, cid, rate):
+        """
+        Limit the packets of community CID to RATE bytes per second, or remove the limit when RATE
+        is None.
+        """
+        assert isinstance(cid, str), type(cid)
+        assert len(cid) == 20, len(cid)
+        assert rate is None or rate > 0, rate
+        if rate:
+            self._community_buckets[cid] = TokenBucket(rate)
+        else:
+            self._community_buckets.pop(cid, None)
+
+    def set_candidate_rate(self, sock_addr, rate):
+        """
+        Limit the packets to SOCK_ADDR to RATE bytes per second instead of the default candidate
+        rate.  When RATE is None the default candidate rate applies again.
+        """
+        assert isinstance(sock_addr, tuple), type(sock_addr)
+        assert rate is None or rate > 0, rate
+        if rate:
+            self._candidate_rates[sock_addr] = rate
+        else:
+            self._candidate_rates.pop(sock_addr, None)
+        self._candidate_buckets.pop(sock_addr, None)
+
+    def _get_candidate_bucket(self, sock_addr, now):
+        bucket = self._candidate_buckets.pop(sock_addr, None)
+        if bucket is None:
+            rate = self._candidate_rates.get(sock_addr, self._candidate_rate)
+            if not rate:
+                return None
+            bucket = TokenBucket(rate, now=now)
+            while len(self._candidate_buckets) >= CANDIDATE_BUCKETS_SIZE:
+                self._candidate_buckets.popitem(last=False)
+        self._candidate_buckets[sock_addr] = bucket
+        return bucket
+
+    def admit(self, sock_addr, data, now):
+        """
+        Charge the buckets for sending DATA to SOCK_ADDR at NOW.
+
+        Returns 0.0 when DATA may be sent immediately.  Otherwise the buckets are not charged and
+        the number of seconds is returned before DATA can be sent.
+        """
+        assert isinstance(sock_addr, tuple), type(sock_addr)
+        assert isinstance(data, str), type(data)
+        offset = 6 if data.startswith(TUNNEL_PREFIX) else 2
+        buckets = [bucket
+                   for bucket
+                   in (self._global_bucket, self._community_buckets.get(data[offset:offset + 20]), self._get_candidate_bucket(sock_addr, now))
+                   if bucket]
+        size = len(data)
+        for bucket in buckets:
+            bucket.update(now)
+
+        if get_priority(data) != PRIORITY_WALKER:
+            delay = max([bucket.get_delay(size) for bucket in buckets] or [0.0])
+            if delay > 0.0:
+                return delay
+
+        for bucket in buckets:
+            bucket.charge(size)
+        return 0.0
+
+    def get_statistics(self):
+        """
+        Returns a dictionary with the state of the buckets.
+        """
+        return {"global": self._global_bucket.get_statistics() if self._global_bucket else None,
+                "communities": dict((cid.encode("HEX"), bucket.get_statistics()) for cid, bucket in self._community_buckets.iteritems()),
+                "candidates": len(self._candidate_buckets),
+                "limited_candidates": sum(1 for bucket in self._candidate_buckets.itervalues() if bucket.tokens < MIN_BURST),
+                "deferred_count": self.deferred_count,
+                "deferred_bytes": self.deferred_bytes}
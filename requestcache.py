@@ -1,3 +1,4 @@
+from math import ceil
 from random import random
 
 from twisted.internet import reactor
@@ -8,6 +9,123 @@ from .logger import get_logger
 
 logger = get_logger(__name__)
 
+# the number of slots in a TimeoutWheel, timeouts further than WHEEL_SIZE ticks ahead go around the
+# wheel more than once
+WHEEL_SIZE = 256
+
+
+class TimeoutWheel(object):
+
+    """
+    A hashed timing wheel that calls the timeout callback of many caches from a single delayed call.
+
+    Every RESOLUTION seconds the wheel ticks and calls the callbacks whose timeout has passed.  A
+    callback is never called early, but it can be called up to RESOLUTION seconds late.  Adding and
+    removing a cache takes O(1).  The delayed call is only scheduled while the wheel holds caches.
+
+    The wheels are shared by all RequestCache instances, use get_timeout_wheel to obtain one.
+    """
+
+    def __init__(self, resolution, size=WHEEL_SIZE):
+        assert isinstance(resolution, float), type(resolution)
+        assert resolution > 0.0, resolution
+        assert isinstance(size, int), type(size)
+        assert size > 0, size
+        super(TimeoutWheel, self).__init__()
+        self._resolution = resolution
+        # every slot is a CACHE:(TICK, CALLBACK) dictionary
+        self._slots = [dict() for _ in xrange(size)]
+        # CACHE:SLOT dictionary
+        self._locations = {}
+        # the time of tick 0 and the last tick that was processed
+        self._start = reactor.seconds()
+        self._tick = 0
+        self._delayed_call = None
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, cache):
+        return cache in self._locations
+
+    def add(self, cache, delay, callback):
+        """
+        Call CALLBACK(CACHE) DELAY seconds from now.
+        """
+        assert not cache in self._locations, cache
+        assert isinstance(delay, float), type(delay)
+        assert delay > 0.0, delay
+        assert callable(callback), type(callback)
+        now = reactor.seconds()
+        if not self._locations:
+            # skip the ticks that passed while the wheel was empty
+            self._tick = max(self._tick, int((now - self._start) / self._resolution))
+
+        tick = max(self._tick + 1, int(ceil((now - self._start + delay) / self._resolution)))
+        slot = tick % len(self._slots)
+        self._slots[slot][cache] = (tick, callback)
+        self._locations[cache] = slot
+
+        if self._delayed_call is None:
+            self._schedule(now)
+
+    def remove(self, cache):
+        """
+        Remove CACHE without calling its callback.  Returns True when CACHE was in the wheel.
+        """
+        slot = self._locations.pop(cache, None)
+        if slot is None:
+            return False
+
+        del self._slots[slot][cache]
+        if not self._locations and self._delayed_call:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+        return True
+
+    def _schedule(self, now):
+        self._delayed_call = reactor.callLater(max(0.0, self._start + (self._tick + 1) * self._resolution - now), self._on_tick)
+
+    def _on_tick(self):
+        self._delayed_call = None
+        now = reactor.seconds()
+        try:
+            # process every tick that passed, the reactor may have been busy
+            last = max(self._tick + 1, int((now - self._start) / self._resolution))
+            while self._tick < last and self._locations:
+                self._tick += 1
+                slot = self._slots[self._tick % len(self._slots)]
+                for cache, (tick, callback) in [(cache, value) for cache, value in slot.iteritems() if value[0] <= self._tick]:
+                    # the callback of an earlier cache may have removed this one
+                    if slot.pop(cache, None):
+                        del self._locations[cache]
+                        try:
+                            callback(cache)
+                        except Exception:
+                            logger.exception("timeout callback failed for %s", cache)
+
+        finally:
+            if self._locations and self._delayed_call is None:
+                self._schedule(now)
+
+
+# RESOLUTION:TimeoutWheel dictionary
+_timeout_wheels = {}
+
+
+def get_timeout_wheel(resolution):
+    """
+    Returns the TimeoutWheel that ticks every RESOLUTION seconds.
+    """
+    wheel = _timeout_wheels.get(resolution)
+    if wheel is None:
+        wheel = _timeout_wheels[resolution] = TimeoutWheel(resolution)
+    return wheel
+
 
 class NumberCache(object):
 
@@ -33,6 +151,14 @@ class NumberCache(object):
     def timeout_delay(self):
         return 10.0
 
+    @property
+    def timeout_resolution(self):
+        """
+        The number of seconds that on_timeout may be called after timeout_delay.  Caches with the
+        same resolution share a TimeoutWheel.
+        """
+        return 0.1
+
     def on_timeout(self):
         raise NotImplementedError()
 
@@ -89,6 +215,11 @@ class IntroductionRequestCache(RandomNumberCache):
         # we will accept the response at most 10.5 seconds after our request
         return 10.5
 
+    @property
+    def timeout_resolution(self):
+        # every walker step creates one, a coarse resolution lets many expire on the same tick
+        return 0.5
+
     def __init__(self, community, helper_candidate):
         super(IntroductionRequestCache, self).__init__(community.request_cache, u"introduction-request")
         self.community = community
@@ -131,8 +262,8 @@ class RequestCache(object):
         Creates a new RequestCache instance.
         """
         assert isInIOThread(), "RequestCache must be used on the reactor's thread"
+        # (PREFIX, NUMBER):NumberCache dictionary
         self._identifiers = dict()
-        self._cache_timeout_tasks = dict()
 
     def add(self, cache):
         """
@@ -146,16 +277,18 @@ class RequestCache(object):
         assert isinstance(cache.prefix, unicode), type(cache.prefix)
         assert isinstance(cache.timeout_delay, float), type(cache.timeout_delay)
         assert cache.timeout_delay > 0.0, cache.timeout_delay
+        assert isinstance(cache.timeout_resolution, float), type(cache.timeout_resolution)
+        assert cache.timeout_resolution > 0.0, cache.timeout_resolution
 
         identifier = self._create_identifier(cache.number, cache.prefix)
         if identifier in self._identifiers:
-            logger.error("add with duplicate identifier \"%s\"", identifier)
+            logger.error("add with duplicate identifier \"%s:%d\"", *identifier)
             return None
 
         else:
             logger.debug("add %s", cache)
             self._identifiers[identifier] = cache
-            self._cache_timeout_tasks[cache] = reactor.callLater(cache.timeout_delay, self._on_timeout, cache)
+            get_timeout_wheel(cache.timeout_resolution).add(cache, cache.timeout_delay, self._on_timeout)
             return cache
 
     def has(self, prefix, number):
@@ -212,7 +345,7 @@ class RequestCache(object):
             del self._identifiers[identifier]
 
     def _create_identifier(self, number, prefix):
-        return u"%s:%d" % (prefix, number)
+        return (prefix, number)
 
     def clear(self):
         """
@@ -226,6 +359,4 @@ class RequestCache(object):
 
     def _cancel_timeout(self, cache):
         logger.debug("canceling timeout for %s", cache)
-        dc = self._cache_timeout_tasks.pop(cache)
-        if dc.active():
-            dc.cancel()
+        get_timeout_wheel(cache.timeout_resolution).remove(cache)
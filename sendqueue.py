@@ -0,0 +1,279 @@
+"""
+The SendQueue holds the outgoing packets that could not be sent immediately because the socket
+would block.
+
+Packets are divided into priority classes based on their message byte: walker packets
+(introduction requests and responses, puncture requests and punctures) are always sent before
+other Dispersy packets, which in turn are sent before community packets such as bulk sync
+responses.  Within a priority class the destinations are served round-robin, one packet at a time,
+hence a single large sync response can not starve the packets to other candidates.
+
+The queue is bounded by a byte budget.  When a new packet exceeds the budget, packets are dropped
+from the lowest priority class that contains packets, taking the most recently queued packet of
+the destination that has the most bytes queued.
+
+Both the round-robin order and the largest destination are tracked lazily: moving or removing a
+destination leaves a stale entry behind that is skipped when it is reached, hence pushing,
+popping, requeueing, and dropping a packet do not scan the destinations.
+"""
+
+from collections import deque
+from heapq import heappush, heappop, heapify
+
+from .logger import get_logger
+logger = get_logger(__name__)
+
+# the maximum number of bytes that are queued
+MAX_BYTES = 2 ** 22
+
+PRIORITY_WALKER = 0
+PRIORITY_CONTROL = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = (u"walker", u"control", u"bulk")
+
+# the bytes of the dispersy-introduction-request, dispersy-introduction-response,
+# dispersy-puncture-request, and dispersy-puncture messages
+WALKER_MESSAGE_BYTES = frozenset(chr(value) for value in (246, 245, 250, 249))
+
+# Dispersy messages are numbered downwards from 254, community messages upwards from 1
+LOWEST_DISPERSY_MESSAGE_BYTE = chr(236)
+
+# the tunnel prefix is 4 bytes followed by 2 version bytes and the 20 byte community identifier
+TUNNEL_PREFIX = "ffffffff".decode("HEX")
+
+
+def get_priority(data):
+    """
+    Returns the priority class of the outgoing DATA, lower values are sent first.
+    """
+    offset = 26 if data.startswith(TUNNEL_PREFIX) else 22
+    if len(data) <= offset:
+        return PRIORITY_CONTROL
+
+    byte = data[offset]
+    if byte in WALKER_MESSAGE_BYTES:
+        return PRIORITY_WALKER
+    if byte >= LOWEST_DISPERSY_MESSAGE_BYTE:
+        return PRIORITY_CONTROL
+    return PRIORITY_BULK
+
+
+class _PriorityClass(object):
+
+    """
+    The queued packets of a single priority class, one deque for each destination.
+    """
+
+    def __init__(self):
+        super(_PriorityClass, self).__init__()
+        # (SOCK_ADDR, POSITION) tuples in round-robin order, an entry is stale when POSITION is not
+        # the current position of the destination queue
+        self.destinations = deque()
+        # (-BYTES, SOCK_ADDR) heap, an entry is stale when BYTES is not the current size of the
+        # destination queue
+        self.sizes = []
+        # SOCK_ADDR:[PACKETS, BYTES, POSITION] dictionary
+        self.queues = {}
+        self._positions = 0
+
+    def __nonzero__(self):
+        return bool(self.queues)
+
+    def get_queue(self, sock_addr, front=False):
+        """
+        Returns the queue for SOCK_ADDR, creating it when it does not exist.
+
+        When FRONT is True the destination is moved to the front of the round-robin order,
+        otherwise a new destination is placed at the back.
+        """
+        queue = self.queues.get(sock_addr)
+        if queue is None:
+            queue = self.queues[sock_addr] = [deque(), 0, None]
+            if not front:
+                self._place(sock_addr, queue, front)
+        if front:
+            self._place(sock_addr, queue, front)
+        return queue
+
+    def _place(self, sock_addr, queue, front):
+        # any previous entry for SOCK_ADDR becomes stale
+        self._positions += 1
+        queue[2] = self._positions
+        if front:
+            self.destinations.appendleft((sock_addr, self._positions))
+        else:
+            self.destinations.append((sock_addr, self._positions))
+        # remove the stale entries once they outnumber the destinations
+        if len(self.destinations) > 2 * len(self.queues) + 16:
+            self.destinations = deque((key, position) for key, position in self.destinations
+                                      if key in self.queues and self.queues[key][2] == position)
+
+    def resized(self, sock_addr, queue):
+        """
+        Must be called after the size of the QUEUE for SOCK_ADDR changed.
+        """
+        if queue[0]:
+            heappush(self.sizes, (-queue[1], sock_addr))
+            # remove the stale entries once they outnumber the destinations
+            if len(self.sizes) > 2 * len(self.queues) + 16:
+                self.sizes = [(-value[1], key) for key, value in self.queues.iteritems()]
+                heapify(self.sizes)
+        else:
+            del self.queues[sock_addr]
+
+    def first(self):
+        """
+        Returns the (sock_addr, queue) of the destination that is next in the round-robin order.
+        """
+        destinations = self.destinations
+        while True:
+            sock_addr, position = destinations[0]
+            queue = self.queues.get(sock_addr)
+            if queue is not None and queue[2] == position:
+                return sock_addr, queue
+            destinations.popleft()
+
+    def largest(self):
+        """
+        Returns the (sock_addr, queue) of the destination that has the most bytes queued.
+        """
+        sizes = self.sizes
+        while True:
+            size, sock_addr = sizes[0]
+            queue = self.queues.get(sock_addr)
+            if queue is not None and queue[1] == -size:
+                return sock_addr, queue
+            heappop(sizes)
+
+
+class SendQueue(object):
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        """
+        Create an empty SendQueue that holds at most MAX_BYTES bytes.
+
+        @param max_bytes: The byte budget.
+        @type max_bytes: int
+        """
+        assert isinstance(max_bytes, (int, long)), type(max_bytes)
+        assert max_bytes > 2 ** 16, "the budget must fit at least one UDP packet"
+        super(SendQueue, self).__init__()
+        self._max_bytes = max_bytes
+        self._classes = [_PriorityClass() for _ in PRIORITY_NAMES]
+        self._length = 0
+        self._bytes = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @property
+    def bytes(self):
+        """
+        The number of bytes that are queued.
+        @rtype: int
+        """
+        return self._bytes
+
+    def __len__(self):
+        return self._length
+
+    def __nonzero__(self):
+        return self._length > 0
+
+    def push(self, sock_addr, data):
+        """
+        Queue DATA for SOCK_ADDR.
+
+        Returns a list with the (priority, sock_addr, data) tuples that were dropped to stay within
+        the byte budget, this list may include the packet that was just pushed.
+        """
+        assert isinstance(sock_addr, tuple), type(sock_addr)
+        assert isinstance(data, str), type(data)
+        priority_class = self._classes[get_priority(data)]
+        queue = priority_class.get_queue(sock_addr)
+        queue[0].append(data)
+        queue[1] += len(data)
+        priority_class.resized(sock_addr, queue)
+        self._length += 1
+        self._bytes += len(data)
+
+        dropped = []
+        while self._bytes > self._max_bytes:
+            dropped.append(self._drop())
+        return dropped
+
+    def _drop(self):
+        """
+        Remove and return the newest packet of the largest destination queue in the lowest
+        priority class as a (priority, sock_addr, data) tuple.
+        """
+        for priority in reversed(xrange(len(self._classes))):
+            priority_class = self._classes[priority]
+            if priority_class:
+                sock_addr, queue = priority_class.largest()
+                data = queue[0].pop()
+                queue[1] -= len(data)
+                priority_class.resized(sock_addr, queue)
+                self._length -= 1
+                self._bytes -= len(data)
+                return priority, sock_addr, data
+
+        raise RuntimeError("can not drop from an empty SendQueue")
+
+    def pop(self):
+        """
+        Remove and return the next (sock_addr, data) tuple that should be sent.
+        """
+        for priority_class in self._classes:
+            if priority_class:
+                destinations = priority_class.destinations
+                sock_addr, queue = priority_class.first()
+                data = queue[0].popleft()
+                queue[1] -= len(data)
+                priority_class.resized(sock_addr, queue)
+                if queue[0]:
+                    # the other destinations go first
+                    destinations.rotate(-1)
+                else:
+                    destinations.popleft()
+                self._length -= 1
+                self._bytes -= len(data)
+                return sock_addr, data
+
+        raise IndexError("pop from an empty SendQueue")
+
+    def requeue(self, sock_addr, data):
+        """
+        Put a popped packet back such that it is the next packet to be sent in its priority class.
+
+        This is used when a popped packet could not be sent, it does not count towards the byte
+        budget check since it was already accepted before.
+        """
+        assert isinstance(sock_addr, tuple), type(sock_addr)
+        assert isinstance(data, str), type(data)
+        priority_class = self._classes[get_priority(data)]
+        queue = priority_class.get_queue(sock_addr, front=True)
+        queue[0].appendleft(data)
+        queue[1] += len(data)
+        priority_class.resized(sock_addr, queue)
+        self._length += 1
+        self._bytes += len(data)
+
+    def pop_batch(self, count):
+        """
+        Remove and return a list with up to COUNT (sock_addr, data) tuples in sending order.
+
+        Packets from this batch that can not be sent must be given back using requeue_batch.
+        """
+        batch = []
+        while self._length and len(batch) < count:
+            batch.append(self.pop())
+        return batch
+
+    def requeue_batch(self, batch):
+        """
+        Put the (sock_addr, data) tuples from BATCH, as returned by pop_batch, back at the front.
+        """
+        for sock_addr, data in reversed(batch):
+            self.requeue(sock_addr, data)
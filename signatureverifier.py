@@ -0,0 +1,143 @@
+"""
+The SignatureVerifier verifies signatures on a pool of worker processes.
+
+Verifying ECDSA signatures is by far the most expensive part of decoding an incoming packet.  Since
+the packets are decoded on the reactor thread, only a single core would be used.  When enabled, a
+Community first sends the unverified signatures of an incoming batch to the pool and, once the
+results have come back, decodes the batch as usual.  The valid signatures are remembered by the
+Member instances, hence the normal verification step does not need to verify them again.
+
+The worker processes are forked, hence the SignatureVerifier should be created before the threads
+of the process, such as the database threads, are started.
+"""
+
+from multiprocessing import Pool
+from threading import Thread
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThread
+
+from .crypto import DispersyCrypto
+from .logger import get_logger
+logger = get_logger(__name__)
+
+# the number of signatures that are sent to a worker process at once
+CHUNK_SIZE = 16
+
+# the maximum number of public keys that each worker process keeps in its cache
+KEY_CACHE_SIZE = 1024
+
+# the crypto instance and the public key cache used by the worker processes
+_crypto = None
+_keys = {}
+
+
+def _initialize_worker(crypto):
+    global _crypto
+    _crypto = crypto
+
+
+def _is_valid_signature(signature_tuple):
+    """
+    Returns True when the (public key, data, signature) SIGNATURE_TUPLE contains a valid signature.
+
+    This function is called in the worker processes.
+    """
+    public_key, data, signature = signature_tuple
+    try:
+        key = _keys.get(public_key)
+        if key is None:
+            if len(_keys) >= KEY_CACHE_SIZE:
+                _keys.clear()
+            key = _keys[public_key] = _crypto.key_from_public_bin(public_key)
+
+        return (_crypto.get_signature_length(key) == len(signature) and
+                _crypto.is_valid_signature(key, data, signature))
+
+    except Exception:
+        logger.exception("unable to verify signature")
+        return False
+
+
+class SignatureVerifier(object):
+
+    def __init__(self, crypto, processes):
+        """
+        Create a pool of PROCESSES worker processes that verify signatures using CRYPTO.
+
+        @param crypto: The crypto instance used to verify the signatures.
+        @type crypto: DispersyCrypto
+
+        @param processes: The number of worker processes.
+        @type processes: int
+        """
+        assert isinstance(crypto, DispersyCrypto), type(crypto)
+        assert isinstance(processes, int), type(processes)
+        assert processes > 0, processes
+        super(SignatureVerifier, self).__init__()
+        self._processes = processes
+        self._pool = Pool(processes, _initialize_worker, (crypto,))
+        # the thread that joins the worker processes after close()
+        self._thread = None
+
+    @property
+    def processes(self):
+        """
+        The number of worker processes.
+        @rtype: int
+        """
+        return self._processes
+
+    def verify(self, signature_tuples):
+        """
+        Verify a list of (public key, data, signature) SIGNATURE_TUPLES on the worker processes.
+
+        Returns a Deferred that fires, on the reactor thread, with a list of booleans in the same
+        order as SIGNATURE_TUPLES.
+        """
+        assert isinstance(signature_tuples, list), type(signature_tuples)
+        assert all(isinstance(signature_tuple, tuple) and len(signature_tuple) == 3 for signature_tuple in signature_tuples), signature_tuples
+        assert self._pool, "the SignatureVerifier is closed"
+        chunk_size = min(CHUNK_SIZE, max(1, len(signature_tuples) // self._processes))
+        return deferToThread(self._pool.map, _is_valid_signature, signature_tuples, chunk_size)
+
+    def close(self):
+        """
+        Stop the worker processes once they have verified the pending signatures.
+
+        The worker processes are joined on a separate thread.  Returns a Deferred that fires, on the
+        reactor thread, once they have stopped.  Use join(...) to wait for them instead.
+        """
+        if not self._pool:
+            return succeed(None)
+
+        pool, self._pool = self._pool, None
+        pool.close()
+
+        deferred = Deferred()
+
+        def join():
+            pool.join()
+            reactor.callFromThread(deferred.callback, None)
+        self._thread = Thread(target=join, name="SignatureVerifier")
+        self._thread.daemon = True
+        self._thread.start()
+        return deferred
+
+    def join(self, timeout):
+        """
+        Wait at most TIMEOUT seconds for the worker processes to stop after close() was called.
+
+        Returns True when the worker processes have stopped, otherwise False.
+        """
+        assert isinstance(timeout, float), type(timeout)
+        assert not self._pool, "call SignatureVerifier.close() first"
+        if self._thread:
+            if timeout > 0.0:
+                self._thread.join(timeout)
+
+            if self._thread.is_alive():
+                logger.error("the signature verifier processes are still running (after waiting %f seconds)", timeout)
+                return False
+        return True
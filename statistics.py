@@ -87,8 +87,12 @@ class DispersyStatistics(Statistics):
         self.total_up = 0
         self.total_send = 0
 
-        # size of the sendqueue
+        # size of the sendqueue and nr packets dropped because the sendqueue was full
         self.cur_sendqueue = 0
+        self.total_sendqueue_drop = 0
+
+        # state of the upload token buckets, None when the endpoint has no rate limiter
+        self.rate_limiter = None
 
         # nr of candidates introduced/stumbled upon
         self.total_candidates_discovered = 0
@@ -173,6 +177,9 @@ class DispersyStatistics(Statistics):
         self.total_up = self._dispersy.endpoint.total_up
         self.total_send = self._dispersy.endpoint.total_send
         self.cur_sendqueue = self._dispersy.endpoint.cur_sendqueue
+        self.total_sendqueue_drop = self._dispersy.endpoint.total_sendqueue_drop
+        rate_limiter = self._dispersy.endpoint.rate_limiter
+        self.rate_limiter = rate_limiter.get_statistics() if rate_limiter else None
 
         self.communities = [community.statistics for community in self._dispersy.get_communities()]
         for community in self.communities:
@@ -197,6 +204,7 @@ class DispersyStatistics(Statistics):
         self.total_up = self._dispersy.endpoint.total_up
         self.total_send = self._dispersy.endpoint.total_send
         self.cur_sendqueue = self._dispersy.endpoint.cur_sendqueue
+        self.total_sendqueue_drop = self._dispersy.endpoint.total_sendqueue_drop
         self.start = self.timestamp = time()
 
         self.walk_attempt = 0
@@ -240,6 +248,10 @@ class CommunityStatistics(Statistics):
         self.hex_cid = community.cid.encode("HEX")
         self.hex_mid = community.my_member.mid.encode("HEX")
         self.mid = community.my_member.mid
+        self.recent_packets_hit = 0
+        self.recent_packets_miss = 0
+        self.sync_response_cache_hit = 0
+        self.sync_response_cache_miss = 0
         self.sync_bloom_new = 0
         self.sync_bloom_reuse = 0
         self.sync_bloom_send = 0
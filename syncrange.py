@@ -0,0 +1,278 @@
+"""
+The SyncRangeIndex keeps track of the packets that are included in the sync bloom filters of a
+community, allowing new bloom filters to be claimed without reading (and hashing) all packets in
+the selected sync range from the database.
+
+The syncable packets are grouped into buckets of consecutive global times.  For each bucket the
+index knows how many packets it contains, and it caches small bloom filters that contain only the
+packets of that bucket.  A bloom filter for a range of buckets is made by OR-ing the cached bucket
+bloom filters, hence only buckets that are not yet cached need to be read from the database.
+
+Because the bloom filter hash functions depend on the prefix, the index uses a small fixed set of
+prefixes instead of choosing a new random prefix for every bloom filter.  Likewise, the index is
+reset when the community changes its bloom filter key (the packet or its digest).
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+from random import choice, sample
+
+from .bloomfilter import BloomFilter
+from .distribution import SyncDistribution
+from .logger import get_logger
+logger = get_logger(__name__)
+
+# the number of different bloom filter prefixes that are used
+PREFIX_COUNT = 4
+
+# the maximum number of bucket bloom filters that are cached
+BUCKET_BLOOM_FILTER_CACHE_SIZE = 1024
+
+# buckets are made larger when there are more than MIN_BUCKETS buckets that contain, on average,
+# less than CAPACITY / BUCKET_FILL_DIVISOR packets
+MIN_BUCKETS = 64
+BUCKET_FILL_DIVISOR = 16
+
+
+class SyncRangeIndex(object):
+
+    def __init__(self, community):
+        from .community import Community
+        assert isinstance(community, Community)
+
+        self._community = community
+        self._database = community.dispersy.database
+
+        # the meta messages that are included in the sync bloom filters
+        self._meta_messages = set(meta for meta in community.get_meta_messages() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
+        self._syncable_messages = u", ".join(unicode(meta.database_id) for meta in self._meta_messages)
+
+        self._bits = community.dispersy_sync_bloom_filter_bits
+        self._error_rate = community.dispersy_sync_bloom_filter_error_rate
+        self._capacity = BloomFilter(self._bits, self._error_rate).get_capacity(self._error_rate)
+        self._prefixes = [chr(i) for i in sample(xrange(256), PREFIX_COUNT)]
+
+        # the index is loaded from the database when it is first used
+        self._loaded = False
+        self._key = None
+        self._bucket_size = 1
+        self._total = 0
+        # BUCKET:COUNT dictionary, only contains buckets with one or more packets
+        self._counts = {}
+        # buckets whose count must be read from the database
+        self._dirty = set()
+        # (BUCKET, PREFIX):BLOOM_FILTER dictionary in least recently used order
+        self._bloom_filters = OrderedDict()
+
+    @property
+    def meta_messages(self):
+        """
+        The meta messages whose packets are included in the index.
+        """
+        return self._meta_messages
+
+    @property
+    def capacity(self):
+        """
+        The number of packets that fit in one sync bloom filter.
+        @rtype: int
+        """
+        return self._capacity
+
+    @property
+    def total(self):
+        """
+        The number of packets in the index.
+        @rtype: int
+        """
+        self._refresh()
+        return self._total
+
+    def add(self, global_time, packet):
+        """
+        Add PACKET, that was just stored in the database at GLOBAL_TIME, to the index.
+        """
+        assert isinstance(global_time, (int, long)), type(global_time)
+        assert isinstance(packet, str), type(packet)
+        if self._loaded:
+            bucket = global_time // self._bucket_size
+            if not bucket in self._dirty:
+                self._counts[bucket] = self._counts.get(bucket, 0) + 1
+                self._total += 1
+
+                key = packet if self._key == "packet" else sha1(packet).digest()
+                for prefix in self._prefixes:
+                    bloom_filter = self._bloom_filters.get((bucket, prefix))
+                    if bloom_filter:
+                        bloom_filter.add(key)
+
+                self._merge_buckets()
+
+    def invalidate(self, global_time_low, global_time_high):
+        """
+        Notify the index that packets between GLOBAL_TIME_LOW and GLOBAL_TIME_HIGH (inclusive) were
+        removed, undone, redone, or replaced.
+        """
+        assert isinstance(global_time_low, (int, long)), type(global_time_low)
+        assert isinstance(global_time_high, (int, long)), type(global_time_high)
+        if self._loaded and global_time_low <= global_time_high:
+            low = global_time_low // self._bucket_size
+            high = global_time_high // self._bucket_size
+            if high - low > len(self._counts):
+                # cheaper to reload everything
+                self.reset()
+
+            else:
+                for bucket in xrange(low, high + 1):
+                    self._dirty.add(bucket)
+                    for prefix in self._prefixes:
+                        self._bloom_filters.pop((bucket, prefix), None)
+
+    def reset(self):
+        """
+        Discard the index, it will be reloaded from the database when it is used again.
+        """
+        self._loaded = False
+        self._total = 0
+        self._counts = {}
+        self._dirty = set()
+        self._bloom_filters = OrderedDict()
+
+    def claim_sync_bloom_filter(self, pivot, acceptable_global_time):
+        """
+        Returns a (time_low, time_high, modulo, offset, bloom_filter) tuple containing at most
+        CAPACITY packets around PIVOT, or None when this can not be done using whole buckets.
+        """
+        assert isinstance(pivot, (int, long)), type(pivot)
+        assert isinstance(acceptable_global_time, (int, long)), type(acceptable_global_time)
+        self._refresh()
+
+        if not self._total:
+            return None
+
+        buckets = sorted(self._counts)
+        if self._total <= self._capacity:
+            time_low, time_high, selected = 1, acceptable_global_time, buckets
+
+        else:
+            right = self._select_buckets(buckets, pivot // self._bucket_size, True, acceptable_global_time)
+            left = self._select_buckets(buckets, pivot // self._bucket_size, False, acceptable_global_time)
+            if not (right or left):
+                return None
+            # use the range that covers the most global times
+            _, time_low, time_high, selected = max(range_ for range_ in (right, left) if range_)
+
+        prefix = choice(self._prefixes)
+        bloom_filter = BloomFilter(self._bits, self._error_rate, prefix=prefix)
+        for bucket in selected:
+            bloom_filter.add_bloom_filter(self._get_bucket_bloom_filter(bucket, prefix))
+
+        logger.debug("%s syncing %d-%d using %d buckets", self._community.cid.encode("HEX"), time_low, time_high, len(selected))
+        return (min(time_low, acceptable_global_time), min(time_high, acceptable_global_time), 1, 0, bloom_filter)
+
+    def _select_buckets(self, buckets, pivot_bucket, higher, acceptable_global_time):
+        """
+        Select whole buckets, starting at PIVOT_BUCKET and moving up when HIGHER is True or down
+        otherwise, until CAPACITY packets are selected.  When all buckets in that direction are
+        selected, buckets on the other side of PIVOT_BUCKET are added.
+
+        Returns a (global_time_range, time_low, time_high, buckets) tuple or None when not even
+        a single bucket fits.
+        """
+        size = self._bucket_size
+        counts = self._counts
+        ahead = [bucket for bucket in buckets if bucket >= pivot_bucket] if higher else [bucket for bucket in reversed(buckets) if bucket <= pivot_bucket]
+        behind = [bucket for bucket in reversed(buckets) if bucket < pivot_bucket] if higher else [bucket for bucket in buckets if bucket > pivot_bucket]
+
+        selected = []
+        total = 0
+        for bucket in ahead:
+            if total + counts[bucket] > self._capacity:
+                if not selected:
+                    return None
+                # BUCKET does not fit, the range ends just before it
+                time_far = bucket * size - 1 if higher else (bucket + 1) * size
+                time_near = pivot_bucket * size if higher else (pivot_bucket + 1) * size - 1
+                break
+            selected.append(bucket)
+            total += counts[bucket]
+
+        else:
+            # all buckets in this direction fit, the range is open ended
+            time_far = acceptable_global_time if higher else 1
+            time_near = pivot_bucket * size if higher else (pivot_bucket + 1) * size - 1
+
+            for bucket in behind:
+                if total + counts[bucket] > self._capacity:
+                    time_near = (bucket + 1) * size if higher else bucket * size - 1
+                    break
+                selected.append(bucket)
+                total += counts[bucket]
+
+            else:
+                time_near = 1 if higher else acceptable_global_time
+
+            if not selected:
+                return None
+
+        time_low, time_high = (time_near, time_far) if higher else (time_far, time_near)
+        time_low = max(1, time_low)
+        return (time_high - time_low, time_low, time_high, selected)
+
+    def _get_bucket_bloom_filter(self, bucket, prefix):
+        key = (bucket, prefix)
+        bloom_filter = self._bloom_filters.pop(key, None)
+        if bloom_filter is None:
+            bloom_filter = BloomFilter(self._bits, self._error_rate, prefix=prefix)
+            bloom_filter.add_keys(str(value) for value, in self._database.execute(u"SELECT %s FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time BETWEEN ? AND ?" % (self._key, self._syncable_messages),
+                                                                                  (bucket * self._bucket_size, (bucket + 1) * self._bucket_size - 1)))
+
+            if len(self._bloom_filters) >= BUCKET_BLOOM_FILTER_CACHE_SIZE:
+                self._bloom_filters.popitem(False)
+
+        self._bloom_filters[key] = bloom_filter
+        return bloom_filter
+
+    def _refresh(self):
+        if self._loaded and self._key != self._community.dispersy_sync_bloom_filter_key:
+            self.reset()
+
+        if not self._loaded:
+            self._load()
+
+        elif self._dirty:
+            for bucket in self._dirty:
+                count, = self._database.execute(u"SELECT COUNT(*) FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time BETWEEN ? AND ?" % self._syncable_messages,
+                                                (bucket * self._bucket_size, (bucket + 1) * self._bucket_size - 1)).next()
+                self._total += count - self._counts.pop(bucket, 0)
+                if count:
+                    self._counts[bucket] = count
+            self._dirty.clear()
+
+    def _load(self):
+        total, global_time = self._database.execute(u"SELECT COUNT(*), MAX(global_time) FROM sync WHERE meta_message IN (%s) AND undone = 0" % self._syncable_messages).next()
+
+        # choose the bucket size such that a bucket contains, on average, CAPACITY / BUCKET_FILL_DIVISOR packets
+        self._bucket_size = max(1, int(global_time * self._capacity / (BUCKET_FILL_DIVISOR * total))) if total else 1
+        self._counts = dict(self._database.execute(u"SELECT global_time / ?, COUNT(*) FROM sync WHERE meta_message IN (%s) AND undone = 0 GROUP BY 1" % self._syncable_messages,
+                                                   (self._bucket_size,)))
+        self._total = total
+        self._dirty = set()
+        self._bloom_filters = OrderedDict()
+        self._key = self._community.dispersy_sync_bloom_filter_key
+        self._loaded = True
+        logger.debug("%s loaded sync range index with %d packets in %d buckets of %d global times",
+                     self._community.cid.encode("HEX"), self._total, len(self._counts), self._bucket_size)
+
+    def _merge_buckets(self):
+        """
+        Double the bucket size while there are many buckets with only a few packets.
+        """
+        while len(self._counts) > MIN_BUCKETS and self._total * BUCKET_FILL_DIVISOR < len(self._counts) * self._capacity:
+            counts = {}
+            for bucket, count in self._counts.iteritems():
+                counts[bucket // 2] = counts.get(bucket // 2, 0) + count
+            self._counts = counts
+            self._dirty = set(bucket // 2 for bucket in self._dirty)
+            self._bloom_filters = OrderedDict()
+            self._bucket_size *= 2
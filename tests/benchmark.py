@@ -0,0 +1,349 @@
+"""
+Ingest throughput and database tuning benchmarks.
+
+IngestBenchmark measures how fast incoming packets are processed by Dispersy.on_incoming_packets,
+i.e. decoding, signature verification, storing, and calling the handle callback, for several
+message types, batch sizes, and database sizes.  The results are written as JSON to the file named
+in the DISPERSY_BENCHMARK_OUTPUT environment variable (default: dispersy-benchmark.json) such that
+they can be compared between releases.
+
+TuningBenchmark measures Dispersy._store, Database.commit, and Community._select_and_fix for each
+database tuning profile.  The results are written as JSON to the file named in the
+DISPERSY_TUNING_BENCHMARK_OUTPUT environment variable (default: dispersy-tuning-benchmark.json).
+
+CandidateBenchmark measures the memory used by WalkCandidate instances and the time it takes to look
+them up in a set.  The results are written as JSON to the file named in the
+DISPERSY_CANDIDATE_BENCHMARK_OUTPUT environment variable (default:
+dispersy-candidate-benchmark.json).
+
+These benchmarks are not part of the unit tests, run them explicitly using:
+
+    nosetests --nologcapture dispersy.tests.benchmark
+"""
+
+import gc
+import json
+import os
+import platform
+import sys
+from random import Random
+from socket import inet_ntoa
+from sqlite3 import sqlite_version
+from struct import pack
+from time import time
+
+from ..bloomfilter import BloomFilter
+from ..candidate import CandidateRegistry, WalkCandidate
+from ..distribution import SyncDistribution
+from ..member import Member
+from ..logger import get_logger
+from ..util import blocking_call_on_reactor_thread
+from .dispersytestclass import DispersyTestFunc
+
+
+logger = get_logger(__name__)
+
+# the number of packets that are given to each node
+PACKET_COUNT = 500
+
+# the number of packets that are given to on_incoming_packets at once
+BATCH_SIZES = (1, 10, 100)
+
+# the number of packets that are stored in the database before the benchmark starts
+DATABASE_SIZES = (0, 2500)
+
+# the global times used by the packets that fill the database and by the benchmarked packets
+FILL_GLOBAL_TIME = 10
+BENCHMARK_GLOBAL_TIME = FILL_GLOBAL_TIME + max(DATABASE_SIZES) + 10
+
+# the tuning profiles that are compared, with the database that each profile is meant for
+TUNING_PROFILES = ((u"default", u"dispersy.db"),
+                   (u"tracker-in-memory", u":memory:"),
+                   (u"desktop", u"dispersy.db"),
+                   (u"server-ssd", u"dispersy.db"))
+
+# the number of packets that are stored for each tuning profile, followed by a commit every
+# TUNING_BATCH_SIZE packets
+TUNING_PACKET_COUNT = 5000
+TUNING_BATCH_SIZE = 100
+
+# the number of times _select_and_fix is called for each tuning profile
+SELECT_AND_FIX_COUNT = 500
+
+# the number of candidates that are created, every peer is a candidate in CANDIDATE_COMMUNITIES
+# communities, like on a tracker
+CANDIDATE_COUNT = 100000
+CANDIDATE_COMMUNITIES = 10
+
+# the number of members that the candidates are associated with
+CANDIDATE_MEMBERS = 100
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the value at FRACTION (0.0 to 1.0) of the SORTED_VALUES, using the nearest rank method.
+    """
+    assert sorted_values
+    assert 0.0 <= fraction <= 1.0, fraction
+    return sorted_values[max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def get_deep_size(objects):
+    """
+    Returns the number of bytes used by OBJECTS and everything they refer to, counting shared
+    objects once.  Classes and Member instances are not counted.
+    """
+    seen = set()
+    size = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, Member)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def write_results(filename, results):
+    """
+    Write RESULTS, together with a description of the environment, as JSON to FILENAME.
+    """
+    with open(filename, "w") as handle:
+        json.dump({"timestamp": time(),
+                   "python": sys.version.split()[0],
+                   "sqlite": sqlite_version,
+                   "platform": platform.platform(),
+                   "results": results},
+                  handle, indent=2, sort_keys=True)
+    logger.info("wrote %d benchmark results to %s", len(results), filename)
+
+
+class IngestBenchmark(DispersyTestFunc):
+
+    def setUp(self):
+        super(IngestBenchmark, self).setUp()
+        self._results = []
+
+    def _create_double_signed_packet(self, node, cosigner, text, global_time):
+        """
+        Returns a last-1-doublemember-text packet signed by both NODE and COSIGNER.
+        """
+        packet = node.create_last_1_doublemember_text(cosigner.my_member, text, False, global_time).packet
+        data = packet[:len(packet) - node.my_member.signature_length - cosigner.my_member.signature_length]
+        return data + node.my_member.sign(data) + cosigner.my_member.sign(data)
+
+    def _create_messages(self, node, cosigner):
+        """
+        Returns a (message name, packets) list with PACKET_COUNT packets for each benchmarked
+        message type, all created by NODE.
+        """
+        global_times = range(BENCHMARK_GLOBAL_TIME, BENCHMARK_GLOBAL_TIME + PACKET_COUNT)
+        return [(u"full-sync-text", [node.create_full_sync_text("full-sync %d" % global_time, global_time).packet
+                                     for global_time in global_times]),
+                (u"last-9-test", [node.create_last_9_test("last-sync %d" % global_time, global_time).packet
+                                  for global_time in global_times]),
+                (u"last-1-doublemember-text", [self._create_double_signed_packet(node, cosigner, "double-signed %d" % global_time, global_time)
+                                               for global_time in global_times]),
+                (u"sequence-text", [node.create_sequence_text("sequence %d" % sequence_number, global_time, sequence_number).packet
+                                    for sequence_number, global_time in enumerate(global_times, 1)])]
+
+    @blocking_call_on_reactor_thread
+    def _give_packets(self, node, source, packets):
+        """
+        Give PACKETS from SOURCE to NODE on the reactor thread and return the time this took.
+        """
+        begin = time()
+        node._dispersy.endpoint.dispersythread_data_came_in([(source.lan_address, packet) for packet in packets], begin, cache=False)
+        return time() - begin
+
+    @blocking_call_on_reactor_thread
+    def _count_packets(self, node, message_name):
+        count, = node._dispersy.database.execute(u"SELECT COUNT(*) FROM sync WHERE meta_message = ?",
+                                                 (node.community.get_meta_message(message_name).database_id,)).next()
+        return count
+
+    def _benchmark(self, message_name, packets, batch_size, database_size, node, cosigner, fill_packets):
+        other, = self.create_nodes(1)
+        node.send_identity(other)
+        cosigner.send_identity(other)
+
+        # fill the database
+        for index in xrange(0, database_size, 1000):
+            self._give_packets(other, node, fill_packets[index:min(index + 1000, database_size)])
+        self.assertEqual(self._count_packets(other, u"full-sync-text"), database_size)
+
+        # all packets in a batch are processed together, hence they share the latency of the batch
+        elapsed = 0.0
+        latencies = []
+        for index in xrange(0, len(packets), batch_size):
+            batch = packets[index:index + batch_size]
+            took = self._give_packets(other, node, batch)
+            elapsed += took
+            latencies.extend([took] * len(batch))
+
+        # every packet must have been processed
+        self.assertEqual(other.fetch_packets([message_name], node.my_member.mid)[-1], packets[-1])
+
+        latencies.sort()
+        result = {"message": message_name,
+                  "batch_size": batch_size,
+                  "database_size": database_size,
+                  "packets": len(packets),
+                  "packets_per_second": len(packets) / elapsed,
+                  "latency_p50": percentile(latencies, 0.5),
+                  "latency_p99": percentile(latencies, 0.99)}
+        logger.info("%(message)s batch_size:%(batch_size)d database_size:%(database_size)d %(packets_per_second).1f packets/s p50:%(latency_p50).6fs p99:%(latency_p99).6fs", result)
+        self._results.append(result)
+
+    def test_ingest(self):
+        """
+        Process PACKET_COUNT packets of each message type for all BATCH_SIZES and DATABASE_SIZES.
+        """
+        node, cosigner = self.create_nodes(2)
+        cosigner.send_identity(node)
+        fill_packets = [node.create_full_sync_text("fill %d" % global_time, global_time).packet
+                        for global_time in xrange(FILL_GLOBAL_TIME, FILL_GLOBAL_TIME + max(DATABASE_SIZES))]
+        messages = self._create_messages(node, cosigner)
+
+        for database_size in DATABASE_SIZES:
+            for batch_size in BATCH_SIZES:
+                for message_name, packets in messages:
+                    self._benchmark(message_name, packets, batch_size, database_size, node, cosigner, fill_packets)
+
+        write_results(os.environ.get("DISPERSY_BENCHMARK_OUTPUT", "dispersy-benchmark.json"), self._results)
+
+
+class TuningBenchmark(DispersyTestFunc):
+
+    @blocking_call_on_reactor_thread
+    def _store(self, node, source, packets):
+        """
+        Give PACKETS from SOURCE to NODE, committing after every TUNING_BATCH_SIZE packets.
+
+        Returns the durations of the Dispersy._store and Database.commit calls.
+        """
+        dispersy = node._dispersy
+        store = dispersy._store
+        store_durations = []
+        commit_durations = []
+
+        def timed_store(messages):
+            begin = time()
+            try:
+                return store(messages)
+            finally:
+                store_durations.append(time() - begin)
+
+        dispersy._store = timed_store
+        try:
+            for index in xrange(0, len(packets), TUNING_BATCH_SIZE):
+                dispersy.endpoint.dispersythread_data_came_in([(source.lan_address, packet) for packet in packets[index:index + TUNING_BATCH_SIZE]], time(), cache=False)
+                begin = time()
+                dispersy.database.commit()
+                commit_durations.append(time() - begin)
+        finally:
+            del dispersy._store
+        return store_durations, commit_durations
+
+    @blocking_call_on_reactor_thread
+    def _select_and_fix(self, node, global_times):
+        """
+        Call Community._select_and_fix for every pivot in GLOBAL_TIMES, alternating between
+        selecting higher and lower global times.
+
+        Returns the durations of the calls.
+        """
+        community = node.community
+        syncable_messages = u", ".join(unicode(meta.database_id)
+                                       for meta
+                                       in community.get_meta_messages()
+                                       if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
+        capacity = BloomFilter(community.dispersy_sync_bloom_filter_bits, community.dispersy_sync_bloom_filter_error_rate).get_capacity(community.dispersy_sync_bloom_filter_error_rate)
+
+        durations = []
+        for index, global_time in enumerate(global_times):
+            begin = time()
+            community._select_and_fix(None, syncable_messages, global_time, capacity, index % 2 == 0)
+            durations.append(time() - begin)
+        return durations
+
+    def test_tuning(self):
+        """
+        Store TUNING_PACKET_COUNT packets and call _select_and_fix SELECT_AND_FIX_COUNT times for
+        each of the TUNING_PROFILES.
+        """
+        source, = self.create_nodes(1)
+        global_times = range(FILL_GLOBAL_TIME, FILL_GLOBAL_TIME + TUNING_PACKET_COUNT)
+        packets = [source.create_full_sync_text("tuning %d" % global_time, global_time).packet for global_time in global_times]
+        # every profile uses the same pivots
+        pivots = Random(42).sample(global_times, SELECT_AND_FIX_COUNT)
+
+        results = []
+        for profile, database_filename in TUNING_PROFILES:
+            node, = self.create_nodes(1, database_filename=database_filename, database_tuning=profile)
+            source.send_identity(node)
+
+            store_durations, commit_durations = self._store(node, source, packets)
+            self.assertEqual(node.fetch_packets([u"full-sync-text"], source.my_member.mid)[-1], packets[-1])
+            select_durations = sorted(self._select_and_fix(node, pivots))
+
+            result = {"profile": profile,
+                      "database": database_filename,
+                      "packets": len(packets),
+                      "store_seconds_per_packet": sum(store_durations) / len(packets),
+                      "commit_seconds": sum(commit_durations) / len(commit_durations),
+                      "select_and_fix_p50": percentile(select_durations, 0.5),
+                      "select_and_fix_p99": percentile(select_durations, 0.99)}
+            logger.info("%(profile)s [%(database)s] _store:%(store_seconds_per_packet).6fs/packet commit:%(commit_seconds).6fs _select_and_fix p50:%(select_and_fix_p50).6fs p99:%(select_and_fix_p99).6fs", result)
+            results.append(result)
+
+        write_results(os.environ.get("DISPERSY_TUNING_BENCHMARK_OUTPUT", "dispersy-tuning-benchmark.json"), results)
+
+
+class CandidateBenchmark(DispersyTestFunc):
+
+    @blocking_call_on_reactor_thread
+    def _create_members(self):
+        return [self._dispersy.get_new_member(u"very-low") for _ in xrange(CANDIDATE_MEMBERS)]
+
+    def test_candidates(self):
+        """
+        Create CANDIDATE_COUNT candidates and measure their memory and lookup time.
+        """
+        members = self._create_members()
+        now = time()
+
+        # addresses are decoded from packets, hence every candidate receives its own strings and
+        # tuples
+        def get_address(peer):
+            return (inet_ntoa(pack("!L", 0x0A000000 + peer)), 1024 + peer % 60000)
+
+        # the candidates of one peer share their addresses through the registry, like they do in
+        # Community.create_candidate
+        registry = CandidateRegistry()
+        candidates = []
+        for index in xrange(CANDIDATE_COUNT):
+            peer = index / CANDIDATE_COMMUNITIES
+            address = registry.get_or_create(get_address(peer), get_address(peer), get_address(peer), u"unknown")
+            candidate = WalkCandidate(get_address(peer), False, get_address(peer), get_address(peer), u"unknown", address)
+            candidate.associate(members[peer % CANDIDATE_MEMBERS])
+            candidate.stumble(now)
+            candidates.append(candidate)
+
+        size = get_deep_size(candidates)
+
+        lookup = set(candidates[::CANDIDATE_COMMUNITIES])
+        begin = time()
+        for candidate in candidates:
+            self.assertIn(candidate, lookup)
+        lookup_seconds = time() - begin
+
+        result = {"candidates": CANDIDATE_COUNT,
+                  "communities": CANDIDATE_COMMUNITIES,
+                  "bytes": size,
+                  "bytes_per_candidate": float(size) / CANDIDATE_COUNT,
+                  "set_lookup_seconds": lookup_seconds}
+        logger.info("%(candidates)d candidates: %(bytes)d bytes, %(bytes_per_candidate).1f bytes/candidate, set lookups:%(set_lookup_seconds).6fs", result)
+        write_results(os.environ.get("DISPERSY_CANDIDATE_BENCHMARK_OUTPUT", "dispersy-candidate-benchmark.json"), [result])
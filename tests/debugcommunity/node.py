@@ -1,4 +1,5 @@
 import sys
+from hashlib import sha1
 from time import time, sleep
 
 from twisted.internet import reactor
@@ -604,6 +605,8 @@ class DebugNode(object):
             assert isinstance(bloom_packets, list)
             assert all(isinstance(packet, str) for packet in bloom_packets)
             bloom_filter = BloomFilter(512 * 8, 0.001, prefix="x")
+            if self._community.dispersy_sync_bloom_filter_key == "digest":
+                bloom_packets = [sha1(packet).digest() for packet in bloom_packets]
             for packet in bloom_packets:
                 bloom_filter.add(packet)
             sync = (time_low, time_high, modulo, offset, bloom_filter)
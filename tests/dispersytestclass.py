@@ -1,3 +1,5 @@
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest import TestCase
 
 # Do not (re)move the reactor import, even if we aren't using it
@@ -30,6 +32,8 @@ class DispersyTestFunc(TestCase):
         super(DispersyTestFunc, self).setUp()
 
         self.dispersy_objects = []
+        # working directories of the nodes with a database file
+        self._working_directories = []
 
         self.assertFalse(reactor.getDelayedCalls())
         self._mm = None
@@ -44,6 +48,9 @@ class DispersyTestFunc(TestCase):
         for dispersy in self.dispersy_objects:
             blockingCallFromThread(reactor, dispersy.stop)
 
+        for working_directory in self._working_directories:
+            rmtree(working_directory, ignore_errors=True)
+
         pending = reactor.getDelayedCalls()
         if pending:
             logger.warning("Found delayed calls in reactor:")
@@ -53,15 +60,29 @@ class DispersyTestFunc(TestCase):
             logger.warning("Failing")
         assert not pending, "The reactor was not clean after shutting down all dispersy instances."
 
-    def create_nodes(self, amount=1, store_identity=True, tunnel=False, communityclass=DebugCommunity):
+    def create_nodes(self, amount=1, store_identity=True, tunnel=False, communityclass=DebugCommunity, verify_processes=0, database_write_behind=False, database_read_connections=0,
+                     database_filename=u":memory:", database_tuning=None):
         @inlineCallbacks
-        def _create_nodes(amount, store_identity, tunnel, communityclass):
+        def _create_nodes(amount, store_identity, tunnel, communityclass, verify_processes, database_write_behind, database_read_connections,
+                          database_filename, database_tuning):
             nodes = []
             for _ in range(amount):
                 # TODO(emilon): do the log observer stuff instead
                 # callback.attach_exception_handler(self.on_callback_exception)
 
-                dispersy = Dispersy(ManualEnpoint(0), u".", u":memory:")
+                if (database_write_behind or database_read_connections) and database_filename == u":memory:":
+                    # write-behind mode and read-only connections require a database file
+                    database_filename = u"dispersy.db"
+
+                if database_filename == u":memory:":
+                    working_directory = u"."
+                else:
+                    working_directory = unicode(mkdtemp(prefix="dispersy-test-"))
+                    self._working_directories.append(working_directory)
+
+                dispersy = Dispersy(ManualEnpoint(0), working_directory, database_filename, verify_processes=verify_processes,
+                                    database_write_behind=database_write_behind, database_read_connections=database_read_connections,
+                                    database_tuning=database_tuning)
                 dispersy.start()
 
                 self.dispersy_objects.append(dispersy)
@@ -73,4 +94,5 @@ class DispersyTestFunc(TestCase):
             logger.debug("create_nodes, nodes created: %s", nodes)
             returnValue(nodes)
 
-        return blockingCallFromThread(reactor, _create_nodes, amount, store_identity, tunnel, communityclass)
+        return blockingCallFromThread(reactor, _create_nodes, amount, store_identity, tunnel, communityclass, verify_processes, database_write_behind, database_read_connections,
+                                      database_filename, database_tuning)
@@ -89,3 +89,90 @@ class TestBatch(DispersyTestFunc):
 
         if self._big_batch_took and self._small_batches_took:
             self.assertSmaller(self._big_batch_took, self._small_batches_took * 1.1)
+
+    def test_big_batch_packet_ids(self, length=100):
+        """
+        A batch is stored using a single INSERT statement, every message must still be given the
+        row id of its own packet.
+        """
+        node, other = self.create_nodes(2)
+        other.send_identity(node)
+
+        messages = [node.create_full_sync_text("Dprint=False, big batch #%d" % global_time, global_time) for global_time in xrange(10, 10 + length)]
+        other.call(other.store, messages)
+
+        packets = dict(other.call(lambda: list(other.community.dispersy.database.execute(u"SELECT id, packet FROM sync"))))
+        for message in messages:
+            self.assertEqual(str(packets[message.packet_id]), message.packet)
+
+    def test_big_batch_history(self):
+        """
+        A batch of last-9-test messages from two members must trim the history of both members.
+        """
+        node, other, another = self.create_nodes(3)
+        node.send_identity(other)
+        another.send_identity(other)
+
+        messages = [node.create_last_9_test("Dprint=False, node #%d" % global_time, global_time) for global_time in xrange(10, 30)]
+        messages.extend(another.create_last_9_test("Dprint=False, another #%d" % global_time, global_time) for global_time in xrange(10, 25))
+        other.give_messages(messages, node)
+
+        other.assert_count(messages[0], 9)
+        other.assert_count(messages[-1], 9)
+        other.assert_is_stored(messages=messages[11:20] + messages[-9:])
+
+    def test_big_batch_duplicates(self, length=500):
+        """
+        A batch where half of the messages are already stored must only store the other half.
+        """
+        node, other = self.create_nodes(2)
+        other.send_identity(node)
+
+        messages = [node.create_full_sync_text("Dprint=False, big batch #%d" % global_time, global_time) for global_time in xrange(10, 10 + length)]
+        other.give_messages(messages[::2], node)
+        other.assert_count(messages[0], len(messages[::2]))
+
+        other.give_messages(messages, node)
+        other.assert_count(messages[0], len(messages))
+        other.assert_is_stored(messages=messages)
+
+    def test_big_batch_sequence_duplicates(self, length=50):
+        """
+        A batch of sequence-text messages where some are already stored must store the remaining
+        messages in sequence.
+        """
+        node, other = self.create_nodes(2)
+        other.send_identity(node)
+
+        messages = [node.create_sequence_text("Dprint=False, sequence #%d" % global_time, global_time, sequence_number) for sequence_number, global_time in enumerate(xrange(10, 10 + length), 1)]
+        other.give_messages(messages[:length // 2], node)
+        other.assert_count(messages[0], length // 2)
+
+        other.give_messages(messages, node)
+        other.assert_count(messages[0], length)
+        other.assert_is_stored(messages=messages)
+
+    def test_fetch_sync_duplicates(self):
+        """
+        Only the stored packets with the member and global time of a message in the batch are
+        fetched, not those of other members at the same global times.
+        """
+        node, other, third = self.create_nodes(3)
+        other.send_identity(node)
+        other.send_identity(third)
+
+        stored = [node.create_full_sync_text("node #%d" % global_time, global_time) for global_time in xrange(10, 15)]
+        stored += [third.create_full_sync_text("third #%d" % global_time, global_time) for global_time in xrange(15, 20)]
+        other.give_messages(stored, node)
+        other.assert_is_stored(messages=stored)
+
+        # node at the global times of third, and third at the global times of node
+        batch = [node.create_full_sync_text("node #%d" % global_time, global_time) for global_time in xrange(13, 18)]
+        batch += [third.create_full_sync_text("third #%d" % global_time, global_time) for global_time in xrange(12, 17)]
+        messages = [other.decode_message(node.my_candidate, message.packet) for message in batch]
+
+        duplicates = other.call(other._dispersy._fetch_sync_duplicates, messages)
+        node_id = other.call(other.community.get_member, mid=node.my_member.mid).database_id
+        third_id = other.call(other.community.get_member, mid=third.my_member.mid).database_id
+        self.assertEqual(sorted(duplicates), [(node_id, 13), (node_id, 14), (third_id, 15), (third_id, 16)])
+        self.assertEqual(duplicates[(node_id, 13)], (stored[3].packet, 0))
@@ -120,3 +120,59 @@ class TestBloomFilter(TestCase):
             self.assertTrue(all(str(i) in bloom for i in xrange(n_capacity)))
             false_positives = sum(str(i) in bloom for i in xrange(n_capacity, n_capacity + 10000))
             self.assertAlmostEqual(1.0 * false_positives / 10000, f_error_rate, delta=0.05)
+
+    def test_bits_checked(self):
+        """
+        Testing BloomFilter.bits_checked against the individual bits in BloomFilter.bytes.
+        """
+        bloom = BloomFilter(128 * 8, 0.25)
+        bloom.add_keys(str(i) for i in xrange(100))
+        self.assertEqual(bloom.bits_checked, sum(1 if ord(byte) & (1 << i) else 0 for byte in bloom.bytes for i in xrange(8)))
+
+    def test_add_bloom_filter(self):
+        """
+        Testing BloomFilter.add_bloom_filter()
+        """
+        bloom = BloomFilter(128 * 8, 0.25, "p")
+        bloom.add_keys(str(i) for i in xrange(50))
+        other = BloomFilter(128 * 8, 0.25, "p")
+        other.add_keys(str(i) for i in xrange(50, 100))
+        expected = BloomFilter(128 * 8, 0.25, "p")
+        expected.add_keys(str(i) for i in xrange(100))
+
+        bloom.add_bloom_filter(other)
+        self.assertEqual(bloom.bytes, expected.bytes)
+
+    def _test_bulk(self):
+        keys = [str(i) for i in xrange(1000)]
+        others = [str(i) for i in xrange(1000, 2000)]
+
+        for args in [(0.01, 1000, "p"), (128 * 8, 0.25, "p"), (8, 0.1, "\x00")]:
+            single = BloomFilter(*args)
+            single.add_keys(keys)
+
+            bulk = BloomFilter(*args)
+            bulk.add_positions(bulk.get_positions(keys))
+            self.assertEqual(bulk.bytes, single.bytes)
+
+            # the positions do not depend on the content, only on the size, functions, and prefix
+            self.assertEqual(single.contains_positions(bulk.get_positions(keys)), [True] * len(keys))
+            self.assertEqual(single.contains_positions(bulk.get_positions(others)), [key in single for key in others])
+            self.assertEqual(single.contains_positions(bulk.get_positions([])), [])
+
+    def test_bulk(self):
+        """
+        Testing BloomFilter.get_positions, add_positions, and contains_positions.
+        """
+        self._test_bulk()
+
+    def test_bulk_without_numpy(self):
+        """
+        Testing BloomFilter.get_positions, add_positions, and contains_positions without NumPy.
+        """
+        from .. import bloomfilter
+        numpy, bloomfilter.numpy = bloomfilter.numpy, None
+        try:
+            self._test_bulk()
+        finally:
+            bloomfilter.numpy = numpy
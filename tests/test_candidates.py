@@ -10,7 +10,7 @@
 from itertools import combinations, islice
 from time import time
 
-from ..candidate import CANDIDATE_ELIGIBLE_DELAY
+from ..candidate import CANDIDATE_ELIGIBLE_DELAY, WalkCandidate
 from ..logger import get_logger
 from ..tool.tracker import TrackerCommunity
 from ..util import call_on_reactor_thread
@@ -502,3 +502,94 @@ class TestCandidates(DispersyTestFunc):
             got.append(candidate.wan_address)
 
         self.assertEquals(expected, got)
+
+    @call_on_reactor_thread
+    def test_candidate_index(self):
+        """
+        The candidate index moves candidates between categories when their timestamps change or
+        expire.
+        """
+        community = NoBootstrapDebugCommunity.create_community(self._dispersy, self._mm._my_member)
+        candidates = self.create_candidates(community, ["wr", "s", "i", ""])
+        self.set_timestamps(candidates, ["wr", "s", "i", ""])
+        walk, stumble, intro, none = candidates
+        index = community.candidates
+        now = time()
+
+        def get_candidates(category, now):
+            return sorted(candidate.sock_addr for candidate in index.get_candidates([category], now))
+
+        self.assertEqual(get_candidates(u"walk", now), [walk.sock_addr])
+        self.assertEqual(get_candidates(u"stumble", now), [stumble.sock_addr])
+        self.assertEqual(get_candidates(u"intro", now), [intro.sock_addr])
+        self.assertEqual(get_candidates(None, now), [none.sock_addr])
+        # the walked candidate is only eligible CANDIDATE_ELIGIBLE_DELAY seconds after the walk
+        self.assertEqual(index.get_walk_candidates(now), [None, stumble, intro])
+
+        # the intro category expires first
+        now += CANDIDATE_ELIGIBLE_DELAY
+        self.assertEqual(index.get_walk_candidates(now), [walk, stumble, None])
+        self.assertEqual(get_candidates(None, now), sorted([intro.sock_addr, none.sock_addr]))
+
+        # walking to a candidate makes it ineligible again
+        walk.walk(now)
+        self.assertEqual(index.get_walk_candidates(now), [None, stumble, None])
+
+        # stumbling upon a candidate moves it into the stumble category
+        intro.associate(self._dispersy.get_new_member(u"very-low"))
+        intro.stumble(now)
+        self.assertEqual(get_candidates(u"stumble", now), sorted([stumble.sock_addr, intro.sock_addr]))
+        self.assertEqual(index.get_category_size(u"intro", now), 0)
+
+        # removed candidates are no longer returned
+        del index[stumble.sock_addr]
+        self.assertEqual(get_candidates(u"stumble", now), [intro.sock_addr])
+        self.assertEqual(index.get_walk_candidates(now), [None, intro, None])
+
+    @call_on_reactor_thread
+    def test_compact_candidate(self):
+        """
+        Candidates have no __dict__, share equal address tuples, and keep their associations in a
+        tuple.
+        """
+        sock_addr = ("127.0.0.1", 1)
+        candidate = WalkCandidate(sock_addr, False, ("127.0.0.1", 1), ("127.0.0.1", 1), u"unknown")
+        self.assertFalse(hasattr(candidate, "__dict__"))
+        self.assertIs(candidate.lan_address, candidate.sock_addr)
+        self.assertIs(candidate.wan_address, candidate.sock_addr)
+        self.assertEqual(hash(candidate), hash(WalkCandidate(("127.0.0.1", 1), False, sock_addr, sock_addr, u"unknown")))
+
+        member, other = self._dispersy.get_new_member(u"very-low"), self._dispersy.get_new_member(u"very-low")
+        candidate.associate(member)
+        candidate.associate(member)
+        candidate.associate(other)
+        self.assertEqual(candidate.get_members(), (member, other))
+        candidate.disassociate(member)
+        self.assertFalse(candidate.is_associated(member))
+        self.assertTrue(candidate.is_associated(other))
+        self.assertRaises(KeyError, candidate.disassociate, member)
+
+    @call_on_reactor_thread
+    def test_shared_candidate_address(self):
+        """
+        The candidates for one peer in different communities share their addresses.
+        """
+        communities = [NoBootstrapDebugCommunity.create_community(self._dispersy, self._mm._my_member) for _ in xrange(2)]
+        sock_addr = ("1.1.1.1", 1)
+        candidates = [community.create_candidate(sock_addr, False, ("192.168.0.1", 1), sock_addr, u"unknown") for community in communities]
+        self.assertIsNot(candidates[0], candidates[1])
+        self.assertIs(candidates[0].address, candidates[1].address)
+        self.assertIs(self._dispersy.candidate_registry.get(sock_addr), candidates[0].address)
+
+        # an update in one community is seen in the others, timestamps are not shared
+        communities[0].create_or_update_walkcandidate(sock_addr, ("192.168.0.2", 1), sock_addr, False, u"symmetric-NAT")
+        candidates[0].stumble(time())
+        self.assertEqual(candidates[1].lan_address, ("192.168.0.2", 1))
+        self.assertEqual(candidates[1].connection_type, u"symmetric-NAT")
+        self.assertEqual(candidates[1].last_stumble, 0.0)
+
+        # the address is forgotten once no community has the candidate
+        for community in communities:
+            community.remove_candidate(sock_addr)
+        del candidates
+        self.assertNotIn(sock_addr, self._dispersy.candidate_registry)
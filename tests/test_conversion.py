@@ -0,0 +1,50 @@
+from .dispersytestclass import DispersyTestFunc
+from ..candidate import Candidate
+
+
+class TestConversion(DispersyTestFunc):
+
+    def test_zero_copy(self):
+        """
+        Payload decoders defined with zero_copy=True are given a buffer on the packet, the decoded
+        message is the same as when the decoder is given a copy.
+        """
+        node, other = self.create_nodes(2)
+        node.send_identity(other)
+
+        messages = [node.create_full_sync_text("Hello World", 10),
+                    node.create_introduction_request(other.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, []), 42)]
+
+        def decode(packet, zero_copy):
+            conversion = other.community.get_conversion_for_packet(packet)
+            decode_functions = conversion._decode_message_map[packet[22]]
+            original = (decode_functions.payload, decode_functions.zero_copy)
+            types = []
+
+            def decode_payload(placeholder, offset, data):
+                types.append(type(data))
+                return original[0](placeholder, offset, data)
+
+            decode_functions.payload, decode_functions.zero_copy = decode_payload, zero_copy
+            try:
+                message = conversion.decode_message(Candidate(node.lan_address, False), packet)
+            finally:
+                decode_functions.payload, decode_functions.zero_copy = original
+            return message, types
+
+        for message in messages:
+            copied, types = other.call(decode, message.packet, False)
+            self.assertEqual(types, [str])
+            shared, types = other.call(decode, message.packet, True)
+            self.assertEqual(types, [buffer])
+
+            self.assertEqual(shared.packet, message.packet)
+            self.assertEqual(shared.distribution.global_time, copied.distribution.global_time)
+            self.assertEqual(shared.authentication.member, copied.authentication.member)
+
+        # values that outlive the packet are still copied
+        text, introduction_request = [other.call(decode, message.packet, True)[0].payload for message in messages]
+        self.assertIsInstance(text.text, str)
+        self.assertEqual(text.text, "Hello World")
+        self.assertIsInstance(introduction_request.bloom_filter.bytes, str)
+        self.assertEqual(introduction_request.bloom_filter.bytes, messages[1].payload.bloom_filter.bytes)
@@ -0,0 +1,509 @@
+import re
+import thread
+from os import close, remove
+from os.path import exists
+from sqlite3 import Connection, sqlite_version_info
+from tempfile import mkstemp
+from threading import Event
+from time import time
+from types import MethodType
+from unittest import TestCase
+
+from nose.twistedtools import reactor
+
+from ..conversion import DefaultConversion
+from ..database import DEFAULT_TUNING_PROFILE, TUNING_PROFILES, TuningProfile, explain_query_plans, get_tuning_profile
+from ..dispersydatabase import DispersyDatabase, LATEST_VERSION
+from ..distribution import SyncDistribution
+from ..logger import get_logger
+from ..util import blocking_call_on_reactor_thread
+from .debugcommunity.community import DebugCommunity
+from .debugcommunity.conversion import DebugCommunityConversion
+from .dispersytestclass import DispersyTestFunc
+
+
+logger = get_logger(__name__)
+
+
+# the queries on the hot paths that must be answered from an index alone, see TestQueryPlans.  the
+# statements are compared with their whitespace collapsed and their IN lists written as IN (...)
+COVERED_QUERIES = [
+    # Community._select_and_fix
+    u"SELECT global_time, digest FROM sync WHERE meta_message IN (...) AND undone = 0 AND global_time < ? ORDER BY global_time DESC LIMIT ?",
+    # Community._dispersy_claim_sync_bloom_filter_modulo
+    u"SELECT sync.digest FROM sync WHERE meta_message IN (...) AND sync.undone = 0 AND (sync.global_time + ?) % ? = 0",
+    # SyncRangeIndex
+    u"SELECT COUNT(*) FROM sync WHERE meta_message IN (...) AND undone = 0 AND global_time BETWEEN ? AND ?",
+    # Dispersy._store, SQLite 3.25 added the window functions
+    u"SELECT id, global_time FROM (SELECT id, global_time, ROW_NUMBER() OVER (PARTITION BY member ORDER BY global_time DESC) AS position FROM sync WHERE meta_message = ? AND member IN (...)) WHERE position > ?"
+    if sqlite_version_info >= (3, 25, 0) else
+    u"SELECT id, global_time FROM sync WHERE meta_message = ? AND member = ? ORDER BY global_time",
+    # Community.get_member
+    u"SELECT 1 FROM sync WHERE member = ? AND meta_message = ? LIMIT 1",
+]
+
+
+class TestDatabase(TestCase):
+
+    def setUp(self):
+        super(TestDatabase, self).setUp()
+        self._database = DispersyDatabase(u":memory:")
+        self._database.open()
+
+    def tearDown(self):
+        super(TestDatabase, self).tearDown()
+        self._database.close()
+
+    def test_upgrade(self):
+        """
+        Upgrading from database version 22 replaces the sync indexes.
+        """
+        handle, file_path = mkstemp(suffix=".db")
+        close(handle)
+        file_path = unicode(file_path)
+        try:
+            database = DispersyDatabase(file_path)
+            database.open()
+            database.executescript(u"""
+DROP INDEX sync_meta_message_undone_global_time_digest_index;
+DROP INDEX sync_meta_message_member_global_time_index;
+CREATE INDEX sync_meta_message_undone_global_time_index ON sync(meta_message, undone, global_time);
+CREATE INDEX sync_meta_message_member ON sync(meta_message, member);
+UPDATE option SET value = '22' WHERE key = 'database_version';""")
+            database.close()
+
+            database = DispersyDatabase(file_path)
+            database.open()
+            indexes = set(name for name, in database.execute(u"SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'sync' AND sql IS NOT NULL"))
+            version, = database.execute(u"SELECT value FROM option WHERE key = 'database_version'").next()
+            database.close()
+
+            self.assertEqual(indexes, set([u"sync_meta_message_undone_global_time_digest_index", u"sync_meta_message_member_global_time_index"]))
+            self.assertEqual(int(version), LATEST_VERSION)
+
+        finally:
+            remove(file_path)
+
+
+class SmallBloomFilterCommunity(DebugCommunity):
+
+    """
+    A DebugCommunity whose bloom filters are full after a few packets and contain digests, such
+    that its sync strategies select ranges and modulo subsets of the sync table.
+    """
+
+    def initiate_conversions(self):
+        return [DefaultConversion(self), DebugCommunityConversion(self, bloom_filter_key="digest")]
+
+    @property
+    def dispersy_sync_bloom_filter_bits(self):
+        return 8 * 8
+
+
+class TestQueryPlans(DispersyTestFunc):
+
+    """
+    The query plans of the statements that are executed on the hot paths, i.e. for (nearly) every
+    incoming or outgoing packet.  The statements are captured while the code runs, hence the plans
+    follow any change to the statements.
+    """
+
+    @blocking_call_on_reactor_thread
+    def _explain_query_plans(self, node):
+        """
+        Returns a STATEMENT:PLAN dictionary that is filled with the statements that NODE executes.
+        """
+        plans = {}
+        database = node._dispersy.database
+        for name in ("execute", "executemany"):
+            setattr(database, name, MethodType(explain_query_plans(getattr(type(database), name).im_func, plans), database))
+        return plans
+
+    @blocking_call_on_reactor_thread
+    def _claim_sync_bloom_filters(self, node, count):
+        community = node.community
+        syncable_messages = u", ".join(unicode(meta.database_id) for meta in community.get_meta_messages()
+                                       if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
+        for _ in xrange(count):
+            community._dispersy_claim_sync_bloom_filter_largest(None)
+            community._dispersy_claim_sync_bloom_filter_modulo(None)
+        # the largest strategy falls back to these when the sync range index can not select whole
+        # buckets
+        community._select_and_fix(None, syncable_messages, 20, 5, True)
+        community._select_and_fix(None, syncable_messages, 20, 5, False)
+
+    def _run_hot_paths(self):
+        """
+        NODE gives OTHER messages and requests, returns the plans of the statements that OTHER
+        executes.
+        """
+        node, other = self.create_nodes(2, communityclass=SmallBloomFilterCommunity)
+        other.send_identity(node)
+        plans = self._explain_query_plans(other)
+
+        # storing incoming messages, including duplicates, conflicts, and obsolete messages
+        messages = [node.create_full_sync_text("Message #%d" % i, i + 10) for i in xrange(30)]
+        other.give_messages(messages, node)
+        other.give_messages(messages[:5], node)
+        sequence = [node.create_sequence_text("Sequence #%d" % i, i + 50, i) for i in xrange(1, 11)]
+        other.give_messages(sequence, node)
+        other.give_message(node.create_sequence_text("Conflict", 49, 5), node)
+        other.give_messages([node.create_last_9_test("Last #%d" % i, i + 70) for i in xrange(12)], node)
+
+        # answering requests
+        for sync in [(1, 0, 1, 0, []), (1, 0, 2, 1, []), (20, 40, 1, 0, [])]:
+            other.give_message(node.create_introduction_request(other.my_candidate, node.lan_address, node.wan_address, False, u"unknown", sync, 42), node)
+        other.give_message(node.create_missing_message(node.my_member, [10, 11, 12]), node)
+        other.give_message(node.create_missing_sequence(node.my_member, sequence[0].meta, 1, 4), node)
+        other.give_message(node.create_missing_identity(node.my_member), node)
+        other.give_message(node.create_missing_proof(node.my_member, 10), node)
+        node.drop_packets()
+
+        # creating our own sync requests, before and after more messages are stored
+        self._claim_sync_bloom_filters(other, 10)
+        other.give_messages([node.create_full_sync_text("More #%d" % i, i + 100) for i in xrange(5)], node)
+        self._claim_sync_bloom_filters(other, 10)
+        return plans
+
+    def test_hot_queries_use_index(self):
+        """
+        None of the statements on the hot paths may fall back to a full table scan.
+        """
+        plans = self._run_hot_paths()
+        self.assertTrue([statement for statement in plans if u"FROM sync" in statement])
+        for statement, plan in plans.iteritems():
+            logger.debug("%s\n  %s", statement, u"\n  ".join(plan))
+            self.assertFalse([line for line in plan if line.startswith((u"SCAN sync", u"SCAN TABLE sync"))], (statement, plan))
+
+    def test_covering_index(self):
+        """
+        The bloom filter and history queries must not read the sync table itself.
+        """
+        plans = dict((re.sub(u"IN \\([0-9?, ]+\\)", u"IN (...)", u" ".join(statement.split())), plan)
+                     for statement, plan in self._run_hot_paths().iteritems())
+        for statement in COVERED_QUERIES:
+            self.assertIn(statement, plans)
+            self.assertTrue(any(u"USING COVERING INDEX" in line for line in plans[statement]), (statement, plans[statement]))
+
+
+class TestWriteBehindDatabase(TestCase):
+
+    def setUp(self):
+        super(TestWriteBehindDatabase, self).setUp()
+        handle, file_path = mkstemp(suffix=".db")
+        close(handle)
+        remove(file_path)
+        self._file_path = unicode(file_path)
+        self._database = DispersyDatabase(self._file_path, write_behind=True)
+        self._database.open()
+
+    def tearDown(self):
+        super(TestWriteBehindDatabase, self).tearDown()
+        if self._database.write_behind:
+            self._database.close()
+        for suffix in (u"", u"-wal", u"-shm"):
+            if exists(self._file_path + suffix):
+                remove(self._file_path + suffix)
+
+    def _durable(self):
+        event = Event()
+        self._database.durable().addCallback(lambda _: event.set())
+        return event
+
+    def _read_option(self, key):
+        # a separate connection only sees the committed data
+        connection = Connection(self._file_path)
+        try:
+            return [value for value, in connection.execute(u"SELECT value FROM option WHERE key = ?", (key,))]
+        finally:
+            connection.close()
+
+    def test_durable(self):
+        """
+        A commit is followed by a checkpoint on the durability thread.
+        """
+        self._database.execute(u"INSERT INTO option (key, value) VALUES ('test', 'durable')")
+        # the uncommitted data is visible on the database connection
+        self.assertEqual(list(self._database.execute(u"SELECT value FROM option WHERE key = 'test'")), [(u"durable",)])
+        self._database.commit()
+
+        self.assertTrue(self._durable().wait(5.0))
+        self.assertEqual(self._read_option(u"test"), [u"durable"])
+
+    def test_deferred_commit(self):
+        """
+        Within a 'with database:' clause durable() waits for the commit that ends the clause.
+        """
+        with self._database:
+            self._database.execute(u"INSERT INTO option (key, value) VALUES ('test', 'deferred')")
+            self._database.commit()
+            event = self._durable()
+            self.assertFalse(event.wait(0.5))
+            self.assertEqual(self._read_option(u"test"), [])
+
+        self.assertTrue(event.wait(5.0))
+        self.assertEqual(self._read_option(u"test"), [u"deferred"])
+
+    def test_open_reader(self):
+        """
+        A reader that holds an older snapshot prevents a complete checkpoint, the commit only becomes
+        durable once the reader is done.
+        """
+        connection = Connection(self._file_path, isolation_level=None)
+        try:
+            connection.execute(u"BEGIN")
+            connection.execute(u"SELECT COUNT(*) FROM option").fetchall()
+
+            self._database.execute(u"INSERT INTO option (key, value) VALUES ('test', 'reader')")
+            self._database.commit()
+            event = self._durable()
+            self.assertFalse(event.wait(0.5))
+
+            connection.execute(u"COMMIT")
+            self.assertTrue(event.wait(5.0))
+        finally:
+            connection.close()
+
+    def test_memory(self):
+        """
+        Write-behind mode is ignored for :memory: databases, everything is always durable.
+        """
+        database = DispersyDatabase(u":memory:", write_behind=True)
+        database.open()
+        try:
+            self.assertFalse(database.write_behind)
+            self.assertTrue(database.durable().called)
+        finally:
+            database.close()
+
+
+class TestWriteBehindForward(DispersyTestFunc):
+
+    @blocking_call_on_reactor_thread
+    def _create_and_forward(self, node, other):
+        candidate = node.community.create_candidate(other.lan_address, False, other.lan_address, other.lan_address, u"unknown")
+        candidate.associate(node.community.get_member(public_key=other.my_member.public_key))
+        candidate.stumble(time())
+        message = node.create_full_sync_text("durable", 42)
+        self.assertTrue(node._dispersy.store_update_forward([message], True, True, True))
+        return message
+
+    def test_forward_when_durable(self):
+        """
+        Our own messages are stored immediately and forwarded once they are durable.
+        """
+        node, = self.create_nodes(1, database_write_behind=True)
+        other, = self.create_nodes(1)
+        self.assertTrue(node._dispersy.database.write_behind)
+        node.send_identity(other)
+
+        message = self._create_and_forward(node, other)
+        node.assert_is_stored(message)
+        _, received = other.receive_message(names=[u"full-sync-text"], timeout=5.0).next()
+        self.assertEqual(received.packet, message.packet)
+
+
+class TestReadOnlyDatabase(TestCase):
+
+    def setUp(self):
+        super(TestReadOnlyDatabase, self).setUp()
+        handle, file_path = mkstemp(suffix=".db")
+        close(handle)
+        remove(file_path)
+        self._file_path = unicode(file_path)
+        self._database = DispersyDatabase(self._file_path, read_connections=2)
+        self._database.open()
+
+    def tearDown(self):
+        super(TestReadOnlyDatabase, self).tearDown()
+        self._database.close()
+        for suffix in (u"", u"-wal", u"-shm"):
+            if exists(self._file_path + suffix):
+                remove(self._file_path + suffix)
+
+    def _read_option(self, key):
+        event = Event()
+        result = []
+
+        def read(execute, key):
+            result.append(thread.get_ident())
+            return [value for value, in execute(u"SELECT value FROM option WHERE key = ?", (key,))]
+
+        def on_result(values):
+            result.append(values)
+            event.set()
+
+        self._database.run_read_only(read, key).addCallback(on_result)
+        self.assertTrue(event.wait(5.0))
+        return result
+
+    def test_committed_only(self):
+        """
+        The read-only connections run on worker threads and only see committed data.
+        """
+        self.assertEqual(self._database.read_connections, 2)
+        self._database.execute(u"INSERT INTO option (key, value) VALUES ('test', 'committed')")
+        ident, values = self._read_option(u"test")
+        self.assertNotEqual(ident, thread.get_ident())
+        self.assertEqual(values, [])
+
+        self._database.commit()
+        _, values = self._read_option(u"test")
+        self.assertEqual(values, [u"committed"])
+
+    def test_memory(self):
+        """
+        The read-only connections are ignored for :memory: databases, FUNC is called immediately.
+        """
+        database = DispersyDatabase(u":memory:", read_connections=2)
+        database.open()
+        try:
+            self.assertEqual(database.read_connections, 0)
+            database.execute(u"INSERT INTO option (key, value) VALUES ('test', 'memory')")
+            deferred = database.run_read_only(lambda execute: list(execute(u"SELECT value FROM option WHERE key = 'test'")))
+            self.assertTrue(deferred.called)
+            self.assertEqual(deferred.result, [(u"memory",)])
+        finally:
+            database.close()
+
+    def test_memory_failure(self):
+        """
+        Without read-only connections an exception raised by FUNC fails the Deferred.
+        """
+        database = DispersyDatabase(u":memory:", read_connections=2)
+        database.open()
+        try:
+            failures = []
+            deferred = database.run_read_only(lambda execute: list(execute(u"SELECT missing FROM option")))
+            deferred.addErrback(failures.append)
+            self.assertEqual(len(failures), 1)
+            self.assertTrue(failures[0].check(Exception))
+        finally:
+            database.close()
+
+
+class TestReadOnlyResponses(DispersyTestFunc):
+
+    def test_missing_message(self):
+        """
+        NODE answers a missing-message request using its read-only connections.
+        """
+        node, = self.create_nodes(1, database_read_connections=2)
+        other, = self.create_nodes(1)
+        node.send_identity(other)
+
+        # our own messages are committed immediately
+        messages = [node.create_full_sync_text("Message #%d" % i, i + 10) for i in xrange(5)]
+        node.give_messages(messages, node)
+
+        global_times = [message.distribution.global_time for message in messages]
+        node.give_message(other.create_missing_message(node.my_member, global_times), other)
+        responses = [response for _, response in other.receive_messages(names=[u"full-sync-text"], timeout=5.0)]
+        self.assertEqual(sorted(response.distribution.global_time for response in responses), global_times)
+
+    def test_received_message(self):
+        """
+        NODE answers a missing-message request for messages that it received from OTHER, these
+        are committed when they are stored hence the read-only connections see them immediately.
+        """
+        node, = self.create_nodes(1, database_read_connections=2)
+        other, third = self.create_nodes(2)
+        node.send_identity(other)
+        node.send_identity(third)
+        other.send_identity(third)
+
+        messages = [other.create_full_sync_text("Message #%d" % i, i + 10) for i in xrange(5)]
+        node.give_messages(messages, other)
+
+        global_times = [message.distribution.global_time for message in messages]
+        node.give_message(third.create_missing_message(other.my_member, global_times), third)
+        responses = [response for _, response in third.receive_messages(names=[u"full-sync-text"], timeout=5.0)]
+        self.assertEqual(sorted(response.distribution.global_time for response in responses), global_times)
+
+    def test_sync_response_cache(self):
+        """
+        A sync response that is made while packets are not yet committed is not cached, otherwise
+        the uncommitted packets are missing from the cached response.
+        """
+        node, = self.create_nodes(1, database_read_connections=2)
+        other, = self.create_nodes(1)
+        other.send_identity(node)
+        statistics = node.community.statistics
+
+        def request(count, timeout=5.0):
+            node.give_message(other.create_introduction_request(node.my_candidate, other.lan_address, other.wan_address, False, u"unknown", (1, 0, 1, 0, []), 42), other)
+            responses = other.receive_messages(names=[u"full-sync-text"], return_after=count, timeout=timeout)
+            return sorted(message.packet for _, message in responses)
+
+        messages = [node.create_full_sync_text("Message #%d" % i, i + 10) for i in xrange(5)]
+        node.store(messages)
+        packets = sorted(message.packet for message in messages)
+        # the read-only connections do not see the uncommitted messages
+        self.assertEqual(request(len(packets), 0.1), [])
+        node.call(node._dispersy.database.commit)
+        self.assertEqual(request(len(packets)), packets)
+        self.assertEqual((statistics.sync_response_cache_hit, statistics.sync_response_cache_miss), (0, 2))
+        self.assertEqual(request(len(packets)), packets)
+        self.assertEqual((statistics.sync_response_cache_hit, statistics.sync_response_cache_miss), (1, 2))
+
+
+class TestTuningProfile(TestCase):
+
+    def setUp(self):
+        super(TestTuningProfile, self).setUp()
+        handle, file_path = mkstemp(suffix=".db")
+        close(handle)
+        remove(file_path)
+        self._file_path = unicode(file_path)
+
+    def tearDown(self):
+        super(TestTuningProfile, self).tearDown()
+        for suffix in (u"", u"-wal", u"-shm"):
+            if exists(self._file_path + suffix):
+                remove(self._file_path + suffix)
+
+    def _get_pragmas(self, database):
+        return dict((pragma, database.execute(u"PRAGMA %s" % pragma).next()[0])
+                    for pragma in (u"synchronous", u"cache_size", u"mmap_size", u"wal_autocheckpoint", u"temp_store", u"busy_timeout"))
+
+    def test_presets(self):
+        """
+        The presets can be given by name, unknown names are refused.
+        """
+        self.assertEqual(get_tuning_profile(None).name, DEFAULT_TUNING_PROFILE)
+        for name in (u"tracker-in-memory", u"desktop", u"server-ssd"):
+            self.assertIs(get_tuning_profile(name), TUNING_PROFILES[name])
+        profile = TuningProfile(u"custom", cache_size=1024)
+        self.assertIs(get_tuning_profile(profile), profile)
+        self.assertRaises(ValueError, get_tuning_profile, u"unknown")
+
+    def test_apply(self):
+        """
+        Database.open applies the settings from the profile.
+        """
+        database = DispersyDatabase(self._file_path, tuning=u"server-ssd")
+        database.open()
+        try:
+            profile = database.tuning
+            self.assertEqual(self._get_pragmas(database), {u"synchronous": 1,
+                                                           u"cache_size": -profile.cache_size,
+                                                           u"mmap_size": profile.mmap_size,
+                                                           u"wal_autocheckpoint": profile.wal_autocheckpoint,
+                                                           u"temp_store": 2,
+                                                           u"busy_timeout": profile.busy_timeout})
+        finally:
+            database.close()
+
+    def test_write_behind(self):
+        """
+        In write-behind mode the profile does not change synchronous and wal_autocheckpoint.
+        """
+        database = DispersyDatabase(self._file_path, write_behind=True, tuning=u"desktop")
+        database.open()
+        try:
+            pragmas = self._get_pragmas(database)
+            self.assertEqual(pragmas[u"synchronous"], 0)
+            self.assertEqual(pragmas[u"wal_autocheckpoint"], 0)
+            self.assertEqual(pragmas[u"cache_size"], -database.tuning.cache_size)
+        finally:
+            database.close()
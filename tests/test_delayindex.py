@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+from ..delayindex import DelayIndex
+
+
+class Delay(object):
+
+    """
+    Stands in for a DelayPacket, the index only uses the timestamp and resume_immediately.
+    """
+
+    def __init__(self, timestamp, resume_immediately=False):
+        self.timestamp = timestamp
+        self.resume_immediately = resume_immediately
+
+
+class TestDelayIndex(TestCase):
+
+    def test_resume(self):
+        """
+        Delayed keys match received keys on their elements that are not None.
+        """
+        index = DelayIndex()
+        by_member = Delay(1.0)
+        by_message = Delay(2.0)
+        by_sequence = Delay(3.0)
+        other = Delay(4.0)
+        self.assertTrue(index.add((None, "m" * 20, None, None), by_member))
+        self.assertTrue(index.add((None, "m" * 20, 10, None), by_message))
+        # a second delay for the same key does not need a new request
+        self.assertFalse(index.add((None, "m" * 20, 10, None), other))
+        self.assertTrue(index.add((u"text", "m" * 20, None, 1), by_sequence))
+        self.assertTrue(index.add((u"text", "m" * 20, None, 2), by_sequence))
+        self.assertEqual(len(index), 4)
+
+        # other members, global times, and sequence numbers do not match
+        self.assertEqual(index.resume((u"text", "o" * 20, 10, 1)), [])
+        self.assertEqual(index.resume((u"other", "m" * 20, 11, None)), [by_member])
+        self.assertNotIn(by_member, index)
+
+        # BY_SEQUENCE waits for both sequence numbers
+        self.assertEqual(index.resume((u"text", "m" * 20, 12, 1)), [])
+        self.assertItemsEqual(index.resume((u"text", "m" * 20, 10, 2)), [by_sequence, by_message, other])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index._masks, {})
+
+    def test_resume_immediately(self):
+        """
+        A delay that resumes immediately does not wait for its other keys.
+        """
+        index = DelayIndex()
+        delay = Delay(1.0, resume_immediately=True)
+        index.add((None, "m" * 20, 10, None), delay)
+        index.add((None, "m" * 20, 11, None), delay)
+        self.assertEqual(index.resume((u"text", "m" * 20, 11, None)), [delay])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.resume((u"text", "m" * 20, 10, None)), [])
+
+    def test_expire(self):
+        """
+        Delays expire in the order of their timestamp, resumed delays do not expire.
+        """
+        index = DelayIndex()
+        delays = [Delay(float(timestamp)) for timestamp in (3, 1, 4, 2)]
+        for global_time, delay in enumerate(delays, 1):
+            index.add((None, "m" * 20, global_time, None), delay)
+        self.assertEqual(index.resume((u"text", "m" * 20, 4, None)), [delays[3]])
+
+        self.assertEqual(index.expire(1.0), [])
+        self.assertEqual(index.expire(3.5), [delays[1], delays[0]])
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.expire(10.0), [delays[2]])
+        self.assertEqual(len(index), 0)
@@ -0,0 +1,167 @@
+from time import sleep, time
+from unittest import TestCase, skipUnless
+
+from nose.twistedtools import reactor
+from twisted.internet.task import deferLater
+from twisted.internet.threads import blockingCallFromThread
+from twisted.python.threadable import isInIOThread
+
+from ..candidate import Candidate
+from ..dispersy import Dispersy
+from ..endpoint import MmsgEndpoint, TwistedEndpoint, TUNNEL_PREFIX
+from ..logger import get_logger
+from ..mmsg import is_available
+from ..ratelimiter import RateLimiter
+
+
+logger = get_logger(__name__)
+
+
+class RecordingMmsgEndpoint(MmsgEndpoint):
+
+    """
+    Records the incoming packets instead of passing them to Dispersy.
+    """
+
+    def __init__(self, *args, **kargs):
+        super(RecordingMmsgEndpoint, self).__init__(*args, **kargs)
+        self.received = []
+
+    def data_came_in(self, packets, cache=True):
+        self._total_down += sum(len(data) for _, data in packets)
+        self.received.extend(packets)
+
+
+@skipUnless(is_available(), "recvmmsg and sendmmsg are not available")
+class TestMmsgEndpoint(TestCase):
+
+    def setUp(self):
+        super(TestMmsgEndpoint, self).setUp()
+        self._dispersy = Dispersy(RecordingMmsgEndpoint(0, "127.0.0.1"), u".", u":memory:")
+        self._sender = self._dispersy.endpoint
+        self._receiver = RecordingMmsgEndpoint(0, "127.0.0.1")
+        self._sender.open(self._dispersy)
+        self._receiver.open(self._dispersy)
+
+    def tearDown(self):
+        super(TestMmsgEndpoint, self).tearDown()
+        self._sender.close()
+        self._receiver.close()
+
+    def _wait_for_packets(self, count, timeout=5.0):
+        for _ in xrange(int(timeout * 10)):
+            if len(self._receiver.received) >= count:
+                break
+            sleep(0.1)
+        return self._receiver.received
+
+    def test_send_receive(self):
+        """
+        Many packets are sent and received in batches, in order and with the sender address.
+        """
+        packets = ["packet %d" % i for i in xrange(500)]
+        self.assertTrue(self._sender.send([Candidate(self._receiver.get_address(), False)], packets))
+
+        received = self._wait_for_packets(len(packets))
+        self.assertEqual([data for _, data in received], packets)
+        self.assertEqual(set(sock_addr for sock_addr, _ in received), set([self._sender.get_address()]))
+        self.assertEqual(self._sender.total_send, len(packets))
+        self.assertEqual(self._sender.total_up, sum(len(packet) for packet in packets))
+        self.assertEqual(self._receiver.total_down, sum(len(packet) for packet in packets))
+
+    def test_send_multiple_candidates(self):
+        """
+        Every packet is sent to every candidate, tunnelled candidates receive the tunnel prefix.
+        """
+        address = self._receiver.get_address()
+        self._sender.send([Candidate(address, False), Candidate(address, True)], ["a", "b"])
+
+        received = self._wait_for_packets(4)
+        self.assertEqual(sorted(data for _, data in received), sorted(["a", "b", TUNNEL_PREFIX + "a", TUNNEL_PREFIX + "b"]))
+
+
+class RecordingTwistedEndpoint(TwistedEndpoint):
+
+    """
+    Records the incoming batches instead of passing them to Dispersy.
+    """
+
+    def __init__(self, *args, **kargs):
+        super(RecordingTwistedEndpoint, self).__init__(*args, **kargs)
+        self.batches = []
+
+    def data_came_in(self, packets, cache=True):
+        assert isInIOThread()
+        self.batches.append(packets)
+
+
+class TestTwistedEndpoint(TestCase):
+
+    def setUp(self):
+        super(TestTwistedEndpoint, self).setUp()
+        self._dispersy = Dispersy(RecordingTwistedEndpoint(0, "127.0.0.1"), u".", u":memory:")
+        self._sender = self._dispersy.endpoint
+        self._receiver = RecordingTwistedEndpoint(0, "127.0.0.1")
+        blockingCallFromThread(reactor, self._sender.open, self._dispersy)
+        blockingCallFromThread(reactor, self._receiver.open, self._dispersy)
+
+    def tearDown(self):
+        super(TestTwistedEndpoint, self).tearDown()
+        blockingCallFromThread(reactor, self._sender.close)
+        blockingCallFromThread(reactor, self._receiver.close)
+        # the ports are closed in a delayed call, the next test requires a clean reactor
+        blockingCallFromThread(reactor, deferLater, reactor, 0, lambda: None)
+
+    def _wait_for_packets(self, count, timeout=5.0):
+        for _ in xrange(int(timeout * 10)):
+            if sum(len(batch) for batch in self._receiver.batches) >= count:
+                break
+            sleep(0.1)
+        return [packet for batch in self._receiver.batches for packet in batch]
+
+    def test_send_receive(self):
+        """
+        Packets are received on the reactor thread and given to Dispersy in coalesced batches.
+        """
+        packets = ["packet %d" % i for i in xrange(100)]
+        self.assertTrue(blockingCallFromThread(reactor, self._sender.send, [Candidate(self._receiver.get_address(), False)], packets))
+
+        received = self._wait_for_packets(len(packets))
+        self.assertEqual([data for _, data in received], packets)
+        self.assertEqual(set(sock_addr for sock_addr, _ in received), set([self._sender.get_address()]))
+        # packets that arrive together are dispatched together
+        self.assertLess(len(self._receiver.batches), len(packets))
+        self.assertEqual(self._sender.total_send, len(packets))
+        self.assertEqual(self._receiver.total_down, sum(len(packet) for packet in packets))
+
+    def test_tunnel(self):
+        """
+        Tunnelled candidates receive the tunnel prefix.
+        """
+        address = self._receiver.get_address()
+        blockingCallFromThread(reactor, self._sender.send, [Candidate(address, False), Candidate(address, True)], ["a"])
+
+        received = self._wait_for_packets(2)
+        self.assertEqual(sorted(data for _, data in received), sorted(["a", TUNNEL_PREFIX + "a"]))
+
+    def test_rate_limit(self):
+        """
+        Packets that exceed the upload rate are deferred, not dropped.
+        """
+        sender = RecordingTwistedEndpoint(0, "127.0.0.1")
+        sender.set_rate_limiter(RateLimiter(candidate_rate=100000))
+        blockingCallFromThread(reactor, sender.open, self._dispersy)
+        try:
+            packets = ["%05d" % i + "x" * 9995 for i in xrange(30)]
+            begin = time()
+            self.assertTrue(blockingCallFromThread(reactor, sender.send, [Candidate(self._receiver.get_address(), False)], packets))
+            self.assertGreater(sender.rate_limiter.deferred_count, 0)
+
+            received = self._wait_for_packets(len(packets))
+            self.assertEqual([data for _, data in received], packets)
+            # the first 100000 bytes are sent immediately, the remaining 200000 take two seconds
+            self.assertGreater(time() - begin, 1.5)
+            self.assertEqual(sender.total_up, sum(len(packet) for packet in packets))
+
+        finally:
+            blockingCallFromThread(reactor, sender.close)
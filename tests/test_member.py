@@ -1,5 +1,5 @@
 from .dispersytestclass import DispersyTestFunc
-from ..util import call_on_reactor_thread
+from ..util import blocking_call_on_reactor_thread, call_on_reactor_thread
 
 class TestMember(DispersyTestFunc):
 
@@ -122,3 +122,25 @@ class TestMember(DispersyTestFunc):
         self.assertFalse(self._dispersy.crypto.is_valid_signature(ec, "12345678", member.sign("0123456789E", offset=1, length=9)))
         with self.assertRaises(ValueError): self._dispersy.crypto.is_valid_signature(ec, "12345678", member.sign("0123456789", offset=1, length=666))
         with self.assertRaises(ValueError): self._dispersy.crypto.is_valid_signature(ec, "12345678", member.sign("0123456789E", offset=1, length=666))
+
+    @blocking_call_on_reactor_thread
+    def test_verify_cache(self):
+        """
+        Valid signatures are remembered, invalid signatures are not.
+        """
+        ec = self._dispersy.crypto.generate_key(u"medium")
+        member = self._dispersy.get_member(private_key=self._dispersy.crypto.key_to_bin(ec))
+        signature = self._dispersy.crypto.create_signature(ec, "0123456789")
+        verified_signatures = self._dispersy._verified_signatures
+
+        self.assertFalse(member.verify("0123456789E", signature))
+        self.assertFalse(any(key[0] == member.mid for key in verified_signatures))
+
+        self.assertTrue(member.verify("0123456789E", signature, length=10))
+        self.assertEqual(len([key for key in verified_signatures if key[0] == member.mid]), 1)
+
+        # the remembered signature is only valid for the same data
+        self.assertTrue(member.verify("0123456789", signature))
+        self.assertFalse(member.verify("012345678E", signature))
+        self.assertFalse(member.verify("0123456789", signature[::-1]))
+        self.assertEqual(len([key for key in verified_signatures if key[0] == member.mid]), 1)
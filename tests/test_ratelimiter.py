@@ -0,0 +1,93 @@
+from unittest import TestCase
+
+from ..ratelimiter import RateLimiter, TokenBucket, MIN_BURST
+
+
+def create_packet(cid, byte, size):
+    """
+    Returns a SIZE byte packet for community CID with message byte BYTE.
+    """
+    return "\x00\x01" + cid + chr(byte) + "p" * (size - 23)
+
+
+class TestTokenBucket(TestCase):
+
+    def test_refill(self):
+        """
+        A bucket refills at its rate, up to its burst size.
+        """
+        bucket = TokenBucket(2 ** 17, now=0.0)
+        self.assertEqual(bucket.tokens, 2 ** 17)
+        bucket.charge(2 ** 17 + 100)
+        self.assertEqual(bucket.tokens, -100)
+        self.assertAlmostEqual(bucket.get_delay(1000), 1100.0 / 2 ** 17)
+
+        bucket.update(0.5)
+        self.assertEqual(bucket.tokens, 2 ** 16 - 100)
+        bucket.update(10.0)
+        self.assertEqual(bucket.tokens, 2 ** 17)
+        self.assertEqual(bucket.get_delay(1000), 0.0)
+
+    def test_min_burst(self):
+        """
+        Slow buckets can still save up for the largest UDP packet.
+        """
+        self.assertEqual(TokenBucket(10).burst, MIN_BURST)
+
+
+class TestRateLimiter(TestCase):
+
+    def test_candidate_rate(self):
+        """
+        Each destination has its own bucket.
+        """
+        limiter = RateLimiter(candidate_rate=MIN_BURST)
+        cid = "c" * 20
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        packet = create_packet(cid, 1, 2 ** 14)
+
+        for _ in xrange(4):
+            self.assertEqual(limiter.admit(a, packet, 100.0), 0.0)
+        self.assertAlmostEqual(limiter.admit(a, packet, 100.0), 0.25)
+        self.assertEqual(limiter.admit(b, packet, 100.0), 0.0)
+        self.assertEqual(limiter.admit(a, packet, 100.25), 0.0)
+
+        # a destination specific rate replaces the default rate
+        limiter.set_candidate_rate(a, 2 * MIN_BURST)
+        for _ in xrange(8):
+            self.assertEqual(limiter.admit(a, packet, 101.0), 0.0)
+        self.assertGreater(limiter.admit(a, packet, 101.0), 0.0)
+
+    def test_global_and_community_rate(self):
+        """
+        A packet is only admitted when all buckets that apply to it have enough tokens.
+        """
+        limiter = RateLimiter(global_rate=2 * MIN_BURST)
+        limited, other = "l" * 20, "o" * 20
+        limiter.set_community_rate(limited, MIN_BURST)
+        sock_addr = ("127.0.0.1", 1)
+
+        for _ in xrange(4):
+            self.assertEqual(limiter.admit(sock_addr, create_packet(limited, 1, 2 ** 14), 0.0), 0.0)
+        self.assertGreater(limiter.admit(sock_addr, create_packet(limited, 1, 2 ** 14), 0.0), 0.0)
+        for _ in xrange(4):
+            self.assertEqual(limiter.admit(sock_addr, create_packet(other, 1, 2 ** 14), 0.0), 0.0)
+        self.assertGreater(limiter.admit(sock_addr, create_packet(other, 1, 2 ** 14), 0.0), 0.0)
+
+        statistics = limiter.get_statistics()
+        self.assertEqual(statistics["global"]["tokens"], 0)
+        self.assertEqual(statistics["communities"], {limited.encode("HEX"): {"rate": MIN_BURST, "burst": MIN_BURST, "tokens": 0}})
+
+        limiter.set_community_rate(limited, None)
+        self.assertEqual(limiter.get_statistics()["communities"], {})
+
+    def test_walker_packets(self):
+        """
+        Walker packets are never deferred, they are only charged.
+        """
+        limiter = RateLimiter(candidate_rate=MIN_BURST)
+        sock_addr = ("127.0.0.1", 1)
+        cid = "c" * 20
+        for _ in xrange(8):
+            self.assertEqual(limiter.admit(sock_addr, create_packet(cid, 246, 2 ** 14), 0.0), 0.0)
+        self.assertAlmostEqual(limiter.admit(sock_addr, create_packet(cid, 1, 2 ** 14), 0.0), 1.25)
@@ -1,8 +1,26 @@
+from time import sleep, time
+
+from twisted.internet import reactor
+
 from ..requestcache import RequestCache, NumberCache, RandomNumberCache
-from ..util import call_on_reactor_thread
+from ..util import call_on_reactor_thread, blocking_call_on_reactor_thread
 from .dispersytestclass import DispersyTestFunc
 
 
+class TimeoutCache(NumberCache):
+
+    def __init__(self, request_cache, prefix, number, timeouts):
+        super(TimeoutCache, self).__init__(request_cache, prefix, number)
+        self._timeouts = timeouts
+
+    @property
+    def timeout_delay(self):
+        return 0.5
+
+    def on_timeout(self):
+        self._timeouts.append((self.number, time()))
+
+
 class TestRequestCache(DispersyTestFunc):
 
     @call_on_reactor_thread
@@ -94,3 +112,28 @@ class TestRequestCache(DispersyTestFunc):
 
         # request_cache is not bound to any Community so we need to clean up ourselves
         request_cache.clear()
+
+    def test_timeout(self):
+        """
+        Caches that are not popped time out after their timeout delay, but not before.  All caches
+        share a single delayed call.
+        """
+        timeouts = []
+
+        @blocking_call_on_reactor_thread
+        def add_caches():
+            request_cache = RequestCache()
+            delayed_calls = len(reactor.getDelayedCalls())
+            begin = time()
+            for number in xrange(100):
+                self.assertIsNotNone(request_cache.add(TimeoutCache(request_cache, u"test", number, timeouts)))
+            self.assertLessEqual(len(reactor.getDelayedCalls()), delayed_calls + 1)
+            request_cache.pop(u"test", 0)
+            return request_cache, begin
+
+        request_cache, begin = add_caches()
+        sleep(1.0)
+
+        self.assertEqual(sorted(number for number, _ in timeouts), range(1, 100))
+        self.assertTrue(all(timestamp >= begin + 0.5 for _, timestamp in timeouts), [timestamp - begin for _, timestamp in timeouts])
+        self.assertFalse(blocking_call_on_reactor_thread(request_cache.has)(u"test", 1))
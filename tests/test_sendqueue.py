@@ -0,0 +1,151 @@
+from random import Random
+from unittest import TestCase
+
+from ..endpoint import TUNNEL_PREFIX
+from ..sendqueue import SendQueue, get_priority, PRIORITY_WALKER, PRIORITY_CONTROL, PRIORITY_BULK
+
+
+def create_packet(byte, size=100):
+    """
+    Returns a SIZE byte packet with message byte BYTE.
+    """
+    assert size > 23
+    return "\x00\x01" + "c" * 20 + chr(byte) + "p" * (size - 23)
+
+
+class TestSendQueue(TestCase):
+
+    def test_priority(self):
+        """
+        Walker packets outrank other Dispersy packets, which outrank community packets.
+        """
+        self.assertEqual(get_priority(create_packet(246)), PRIORITY_WALKER)
+        self.assertEqual(get_priority(create_packet(245)), PRIORITY_WALKER)
+        self.assertEqual(get_priority(create_packet(250)), PRIORITY_WALKER)
+        self.assertEqual(get_priority(create_packet(249)), PRIORITY_WALKER)
+        self.assertEqual(get_priority(TUNNEL_PREFIX + create_packet(246)), PRIORITY_WALKER)
+        self.assertEqual(get_priority(create_packet(254)), PRIORITY_CONTROL)
+        self.assertEqual(get_priority(create_packet(248)), PRIORITY_CONTROL)
+        self.assertEqual(get_priority(create_packet(1)), PRIORITY_BULK)
+        self.assertEqual(get_priority(TUNNEL_PREFIX + create_packet(1)), PRIORITY_BULK)
+
+    def test_pop_order(self):
+        """
+        Higher priority packets are popped first, destinations are served round-robin.
+        """
+        queue = SendQueue()
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        bulk = [create_packet(1, 100 + i) for i in xrange(4)]
+        walker = create_packet(246)
+
+        for packet in bulk[:3]:
+            self.assertEqual(queue.push(a, packet), [])
+        self.assertEqual(queue.push(b, bulk[3]), [])
+        self.assertEqual(queue.push(b, walker), [])
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(queue.bytes, sum(len(packet) for packet in bulk) + len(walker))
+
+        self.assertEqual([queue.pop() for _ in xrange(5)],
+                         [(b, walker), (a, bulk[0]), (b, bulk[3]), (a, bulk[1]), (a, bulk[2])])
+        self.assertFalse(queue)
+        self.assertEqual(queue.bytes, 0)
+        self.assertRaises(IndexError, queue.pop)
+
+    def test_requeue(self):
+        """
+        Packets that could not be sent are sent first on the next attempt.
+        """
+        queue = SendQueue()
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        packets = [(a, create_packet(1, 100)), (b, create_packet(1, 101)), (a, create_packet(1, 102)), (b, create_packet(1, 103))]
+        for sock_addr, packet in packets:
+            queue.push(sock_addr, packet)
+
+        self.assertEqual(queue.pop(), packets[0])
+        batch = queue.pop_batch(2)
+        self.assertEqual(batch, packets[1:3])
+        queue.requeue_batch(batch)
+        self.assertEqual(queue.pop_batch(10), packets[1:])
+
+    def test_byte_budget(self):
+        """
+        When the byte budget is exceeded the newest bulk packets of the largest destination are
+        dropped first.
+        """
+        queue = SendQueue(2 ** 17)
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        size = 2 ** 14
+        for i in xrange(5):
+            self.assertEqual(queue.push(a, create_packet(1, size + i)), [])
+        for i in xrange(2):
+            self.assertEqual(queue.push(b, create_packet(1, size + i)), [])
+        walker = create_packet(246, size)
+
+        # the budget fits 7 packets, the eighth causes the newest packet to A to be dropped
+        self.assertEqual(queue.push(b, walker), [(PRIORITY_BULK, a, create_packet(1, size + 4))])
+        self.assertLessEqual(queue.bytes, queue.max_bytes)
+        self.assertEqual(len(queue), 7)
+        self.assertEqual(queue.pop(), (b, walker))
+
+        # when only walker packets are queued, walker packets are dropped
+        queue = SendQueue(2 ** 17)
+        dropped = []
+        for i in xrange(10):
+            dropped.extend(queue.push(a, create_packet(246, size)))
+        self.assertEqual(len(dropped), 2)
+        self.assertEqual(len(queue), 8)
+
+    def test_requeue_bounded(self):
+        """
+        Repeatedly popping and requeueing the same packets, as happens while the socket blocks,
+        keeps the order and does not grow the bookkeeping.
+        """
+        queue = SendQueue()
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        packets = [(a, create_packet(1, 100)), (b, create_packet(1, 101)), (a, create_packet(1, 102))]
+        for sock_addr, packet in packets:
+            queue.push(sock_addr, packet)
+
+        for _ in xrange(1000):
+            sock_addr, packet = queue.pop()
+            self.assertEqual((sock_addr, packet), packets[0])
+            queue.requeue(sock_addr, packet)
+
+        priority_class = queue._classes[PRIORITY_BULK]
+        self.assertLess(len(priority_class.destinations), 100)
+        self.assertLess(len(priority_class.sizes), 100)
+        self.assertEqual(queue.pop_batch(10), packets)
+
+    def test_drop_largest(self):
+        """
+        Packets are always dropped from the destination that has the most bytes queued, also after
+        many pushes, pops, and requeues.
+        """
+        rng = Random(42)
+        queue = SendQueue(2 ** 17)
+        destinations = [("127.0.0.1", port) for port in xrange(1, 50)]
+        queued = dict((sock_addr, 0) for sock_addr in destinations)
+
+        for _ in xrange(5000):
+            if rng.random() < 0.3 and queue:
+                sock_addr, packet = queue.pop()
+                queued[sock_addr] -= len(packet)
+                if rng.random() < 0.5:
+                    queue.requeue(sock_addr, packet)
+                    queued[sock_addr] += len(packet)
+                continue
+
+            sock_addr = rng.choice(destinations)
+            packet = create_packet(1, rng.randint(100, 4000))
+            queued[sock_addr] += len(packet)
+            largest = max(queued.itervalues())
+            for priority, dropped_addr, dropped in queue.push(sock_addr, packet):
+                self.assertEqual(queued[dropped_addr], largest)
+                queued[dropped_addr] -= len(dropped)
+                largest = max(queued.itervalues())
+
+        self.assertEqual(queue.bytes, sum(queued.itervalues()))
+        while queue:
+            sock_addr, packet = queue.pop()
+            queued[sock_addr] -= len(packet)
+        self.assertEqual(set(queued.itervalues()), set([0]))
@@ -84,6 +84,31 @@ class TestIncomingMissingSequence(DispersyTestFunc):
         other.assert_is_stored(get_message(6, 2))
         other.assert_is_stored(get_message(7, 3))
 
+    def test_conflict_resend(self):
+        """
+        A conflicting sequence number replaces the packets that OTHER stored, these must be
+        processed again, rather than dropped as recently received packets, when NODE resends them.
+        """
+        node, other = self.create_nodes(2)
+        other.send_identity(node)
+
+        first = node.create_sequence_text("M@6#1", 6, 1)
+        second = node.create_sequence_text("M@8#2", 8, 2)
+        other.give_messages([first, second], node)
+        other.assert_is_stored(first)
+        other.assert_is_stored(second)
+
+        # M@5#1 is preferred, it replaces both M@6#1 and M@8#2
+        other.give_message(node.create_sequence_text("M@5#1", 5, 1), node)
+        other.assert_not_stored(first)
+        other.assert_not_stored(second)
+
+        # M@8#2 follows M@5#1
+        hit = other.call(lambda: other.community.statistics.recent_packets_hit)
+        other.give_message(second, node)
+        other.assert_is_stored(second)
+        self.assertEqual(other.call(lambda: other.community.statistics.recent_packets_hit), hit)
+
     def test_requests_1_1(self):
         self.requests(1, [1], (1, 1))
 
@@ -0,0 +1,128 @@
+from time import sleep
+
+from nose.twistedtools import reactor
+from twisted.internet.threads import blockingCallFromThread
+
+from ..logger import get_logger
+from ..signatureverifier import SignatureVerifier
+from .dispersytestclass import DispersyTestFunc
+
+
+logger = get_logger(__name__)
+
+
+class TestSignatureVerifier(DispersyTestFunc):
+
+    def _wait_for_count(self, node, message, count, timeout=10.0):
+        for _ in xrange(int(timeout * 10)):
+            if node.count_messages(message) == count:
+                break
+            sleep(0.1)
+        node.assert_count(message, count)
+
+    def test_verify(self):
+        """
+        The worker processes return whether each signature is valid, in the original order.
+        """
+        crypto = self._dispersy.crypto
+        ec = crypto.generate_key(u"medium")
+        public_key = crypto.key_to_bin(ec.pub())
+        signature = crypto.create_signature(ec, "0123456789")
+
+        verifier = SignatureVerifier(crypto, 2)
+        try:
+            results = blockingCallFromThread(reactor, verifier.verify, [(public_key, "0123456789", signature),
+                                                                        (public_key, "0123456789E", signature),
+                                                                        (public_key, "0123456789", signature[:-1]),
+                                                                        ("invalid key", "0123456789", signature),
+                                                                        (public_key, "0123456789", signature)])
+        finally:
+            verifier.close()
+
+        self.assertEqual(results, [True, False, False, False, True])
+
+    def test_close(self):
+        """
+        Closing does not block the reactor thread, the Deferred fires once the worker processes
+        have stopped.
+        """
+        verifier = SignatureVerifier(self._dispersy.crypto, 2)
+        processes = list(verifier._pool._pool)
+        self.assertTrue(all(process.is_alive() for process in processes))
+
+        blockingCallFromThread(reactor, verifier.close)
+        self.assertFalse(any(process.is_alive() for process in processes))
+        # closing again does nothing
+        self.assertIsNone(blockingCallFromThread(reactor, verifier.close))
+
+    def test_stop(self):
+        """
+        Dispersy.stop returns once the worker processes have stopped.
+        """
+        node, = self.create_nodes(1, verify_processes=2)
+        dispersy = node._dispersy
+        processes = list(dispersy._signature_verifier._pool._pool)
+        self.assertTrue(all(process.is_alive() for process in processes))
+
+        self.dispersy_objects.remove(dispersy)
+        self.assertTrue(blockingCallFromThread(reactor, dispersy.stop))
+        self.assertFalse(any(process.is_alive() for process in processes))
+
+    def test_batch(self):
+        """
+        Signatures in an incoming batch are verified by the worker processes before the batch is
+        decoded, invalid signatures are still dropped.
+        """
+        node, other = self.create_nodes(2, verify_processes=2)
+        other.send_identity(node)
+
+        messages = [node.create_full_sync_text("verified #%d" % global_time, global_time) for global_time in xrange(10, 30)]
+        packets = [message.packet for message in messages]
+        # corrupt the signature of the last message
+        packets[-1] = packets[-1][:-1] + chr((ord(packets[-1][-1]) + 1) % 256)
+        other.give_packets(packets, node)
+
+        self._wait_for_count(other, messages[0], len(messages) - 1)
+        other.assert_is_stored(messages=messages[:-1])
+        other.assert_not_stored(messages[-1])
+
+        # the valid signatures were remembered, hence they were not verified on the reactor thread
+        member = other.call(other.community.get_member, mid=node.my_member.mid)
+        for message in messages[:-1]:
+            self.assertTrue(member.has_verified_signature(message.packet[:-member.signature_length], message.packet[-member.signature_length:]))
+
+    def test_batch_order(self):
+        """
+        Batches are decoded in the order in which they arrive, also when an earlier batch waits for
+        the worker processes.
+        """
+        node, other = self.create_nodes(2, verify_processes=2)
+        other.send_identity(node)
+
+        # the small second batch may only be decoded after the first batch
+        messages = [node.create_sequence_text("sequence %d" % sequence_number, sequence_number + 10, sequence_number) for sequence_number in xrange(1, 31)]
+        other.give_messages(messages[:-2], node)
+        other.give_messages(messages[-2:], node)
+
+        self._wait_for_count(other, messages[0], len(messages))
+        other.assert_is_stored(messages=messages)
+        # none of the messages arrived out of sequence
+        self.assertEqual(other._dispersy._statistics.delay_count, 0)
+
+    def test_decode_double_signatures(self):
+        """
+        Both signatures of a double signed message are obtained without verifying them.
+        """
+        node, other = self.create_nodes(2)
+        other.send_identity(node)
+
+        message = node.create_double_signed_text(other.my_pub_member, "Allow=True", True)
+        packet = message.packet
+
+        signatures = other.call(other.community.get_conversion_for_packet(packet).decode_signatures, node.my_candidate, packet)
+        self.assertEqual([member.mid for member, _, _ in signatures], [node.my_member.mid, other.my_member.mid])
+        data = signatures[0][1]
+        self.assertEqual(signatures[1][1], data)
+        self.assertEqual(data + signatures[0][2] + signatures[1][2], packet)
+        self.assertEqual(len(signatures[0][2]), node.my_member.signature_length)
+        self.assertEqual(len(signatures[1][2]), other.my_member.signature_length)
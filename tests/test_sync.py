@@ -1,14 +1,28 @@
+from hashlib import sha1
+from itertools import islice
 from unittest.case import skip
 
+from .debugcommunity.community import DebugCommunity
+from .debugcommunity.conversion import DebugCommunityConversion
 from .dispersytestclass import DispersyTestFunc
+from ..community import SYNC_RESPONSE_PAGE_SIZE
+from ..conversion import DefaultConversion
 from ..logger import get_logger
 
 logger = get_logger(__name__)
 
+
+class DigestDebugCommunity(DebugCommunity):
+
+    def initiate_conversions(self):
+        # all nodes in these tests use this community, hence there is no need for a new community version
+        return [DefaultConversion(self), DebugCommunityConversion(self, bloom_filter_key="digest")]
+
+
 class TestSync(DispersyTestFunc):
 
-    def _create_nodes_messages(self, messagetype="create_full_sync_text"):
-        node, other = self.create_nodes(2)
+    def _create_nodes_messages(self, messagetype="create_full_sync_text", communityclass=DebugCommunity):
+        node, other = self.create_nodes(2, communityclass=communityclass)
         other.send_identity(node)
 
         # other creates messages
@@ -55,6 +69,99 @@ class TestSync(DispersyTestFunc):
                 self.assertEqual(sorted(global_times), sorted(response_times))
 
 
+    def test_digest(self):
+        """
+        OTHER creates several messages, NODE uses a bloom filter containing the digests of half of
+        them, only the other half may be sent back.
+        """
+        # the master member must use the same bloom filter key
+        self._mm = None
+        self._mm, = self.create_nodes(communityclass=DigestDebugCommunity)
+        node, other, messages = self._create_nodes_messages(communityclass=DigestDebugCommunity)
+        self.assertEqual(node.call(lambda: node.community.dispersy_sync_bloom_filter_key), "digest")
+
+        # every stored packet has its digest
+        for packet, digest in other.call(lambda: list(other.community.dispersy.database.execute(u"SELECT packet, digest FROM sync"))):
+            self.assertEqual(str(digest), sha1(str(packet)).digest())
+
+        global_times = [message.distribution.global_time for message in messages[1::2]]
+
+        sync = (1, 0, 1, 0, [message.packet for message in messages[::2]])
+        other.give_message(node.create_introduction_request(other.my_candidate, node.lan_address, node.wan_address, False, u"unknown", sync, 42), node)
+
+        responses = node.receive_messages(names=[u"full-sync-text"], return_after=len(global_times))
+        response_times = [message.distribution.global_time for _, message in responses]
+
+        self.assertEqual(sorted(global_times), sorted(response_times))
+
+    def test_streaming_responder(self):
+        """
+        The sync responder returns the same packets as _get_packets_for_bloomfilters, also when
+        several packets have the same global time, while only reading the rows that are consumed.
+        """
+        node, other = self.create_nodes(2)
+        node.send_identity(other)
+        other.send_identity(node)
+
+        # both members create messages with the same global times
+        messages = [other.create_full_sync_text("Message %d" % i, i + 10) for i in xrange(100)]
+        other.store(messages)
+        node_messages = [node.create_full_sync_text("Message %d" % i, i + 10) for i in xrange(100)]
+        other.give_messages(node_messages, node)
+        messages.extend(node_messages)
+        request = [None, 1, 1000, 0, 1]
+
+        def stream(count):
+            rows = [0]
+
+            def execute(statement, bindings=()):
+                for row in other.community.dispersy.database.execute(statement, bindings):
+                    rows[0] += 1
+                    yield row
+
+            _, generator = other.community._stream_packets_for_bloomfilters([request], execute=execute).next()
+            return [packet for packet, _ in islice(generator, count)], rows[0]
+
+        def get_all():
+            _, generator = other.community._get_packets_for_bloomfilters([request]).next()
+            return [packet for packet, in generator]
+
+        packets, rows = other.call(stream, 1000)
+        self.assertEqual(sorted(packets), sorted(other.call(get_all)))
+        self.assertTrue(set(message.packet for message in messages).issubset(packets))
+
+        # two pages are read for the first ten packets, plus a few rows for the other meta messages
+        packets, rows = other.call(stream, 10)
+        self.assertEqual(len(packets), 10)
+        self.assertGreaterEqual(rows, SYNC_RESPONSE_PAGE_SIZE * 3)
+        self.assertLess(rows, SYNC_RESPONSE_PAGE_SIZE * 4)
+
+    def test_sync_response_cache(self):
+        """
+        An identical bloom filter request is answered from the sync response cache, storing a new
+        message invalidates the cached responses.
+        """
+        node, other, messages = self._create_nodes_messages()
+        statistics = other.community.statistics
+
+        def request(count):
+            other.give_message(node.create_introduction_request(other.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, []), 42), node)
+            responses = node.receive_messages(names=[u"full-sync-text"], return_after=count)
+            return sorted(message.packet for _, message in responses)
+
+        packets = sorted(message.packet for message in messages)
+        self.assertEqual(request(len(packets)), packets)
+        self.assertEqual((statistics.sync_response_cache_hit, statistics.sync_response_cache_miss), (0, 1))
+
+        self.assertEqual(request(len(packets)), packets)
+        self.assertEqual((statistics.sync_response_cache_hit, statistics.sync_response_cache_miss), (1, 1))
+
+        message = other.create_full_sync_text("Message 30", 40)
+        other.store([message])
+        packets = sorted(packets + [message.packet])
+        self.assertEqual(request(len(packets)), packets)
+        self.assertEqual((statistics.sync_response_cache_hit, statistics.sync_response_cache_miss), (1, 2))
+
     def test_in_order(self):
         node, other, messages = self._create_nodes_messages('create_in_order_text')
         global_times = [message.distribution.global_time for message in messages]
@@ -95,6 +202,28 @@ class TestSync(DispersyTestFunc):
         self.assertNotEqual(response_times, sorted(global_times, reverse=True))
 
 
+    def test_random_order_not_cached(self):
+        """
+        Identical requests for RANDOM packets that do not fit in a single response are not answered
+        from the sync response cache, each response contains a different subset.
+        """
+        node, other = self.create_nodes(2)
+        other.send_identity(node)
+        messages = [other.create_random_order_text("Message %d" % i, i + 10) for i in xrange(200)]
+        other.store(messages)
+        statistics = other.community.statistics
+
+        def request():
+            other.give_message(node.create_introduction_request(other.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, []), 42), node)
+            return set(message.packet for _, message in node.receive_messages(names=[u"RANDOM-text"]))
+
+        first = request()
+        second = request()
+        self.assertTrue(first)
+        self.assertLess(len(first), len(messages))
+        self.assertNotEqual(first, second)
+        self.assertEqual(statistics.sync_response_cache_hit, 0)
+
     def test_mixed_order(self):
         node, other = self.create_nodes(2)
         other.send_identity(node)
@@ -349,3 +478,20 @@ class TestSync(DispersyTestFunc):
         create_double_signed_message(nodeC, nodeA, "Allow=True (2CA)", old_global_time)
 
         check_database_contents()
+
+    def test_recent_packets(self):
+        """
+        NODE gives OTHER the same message twice, the second packet must be dropped before it is
+        decoded.
+        """
+        node, other = self.create_nodes(2)
+        other.send_identity(node)
+
+        message = node.create_full_sync_text("Message", 42)
+        other.give_message(message, node)
+        other.assert_is_stored(message)
+        hit = other.call(lambda: other.community.statistics.recent_packets_hit)
+
+        other.give_message(message, node)
+        other.assert_count(message, 1)
+        self.assertEqual(other.call(lambda: other.community.statistics.recent_packets_hit), hit + 1)
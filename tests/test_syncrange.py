@@ -0,0 +1,79 @@
+from ..logger import get_logger
+from ..util import blocking_call_on_reactor_thread
+from .dispersytestclass import DispersyTestFunc
+logger = get_logger(__name__)
+
+
+class TestSyncRangeIndex(DispersyTestFunc):
+
+    @blocking_call_on_reactor_thread
+    def _count_syncable(self, node):
+        sync_range = node.community._sync_range
+        return node.community.dispersy.database.execute(u"SELECT COUNT(*) FROM sync WHERE meta_message IN (%s) AND undone = 0" % u", ".join(unicode(meta.database_id) for meta in sync_range.meta_messages)).next()[0]
+
+    @blocking_call_on_reactor_thread
+    def _get_syncable_packets(self, node, time_low, time_high):
+        sync_range = node.community._sync_range
+        return [str(packet) for packet, in node.community.dispersy.database.execute(u"SELECT packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time BETWEEN ? AND ?" % u", ".join(unicode(meta.database_id) for meta in sync_range.meta_messages), (time_low, time_high))]
+
+    def test_claim(self):
+        """
+        NODE stores messages, the claimed bloom filter must contain all of them.
+        """
+        node, = self.create_nodes(1)
+        sync_range = node.community._sync_range
+
+        messages = [node.create_full_sync_text("Message #%d" % i, i + 10) for i in xrange(10)]
+        node.give_messages(messages, node)
+
+        time_low, time_high, modulo, offset, bloom_filter = node.call(sync_range.claim_sync_bloom_filter, 1, node.community.acceptable_global_time)
+        self.assertEqual((time_low, time_high, modulo, offset), (1, node.community.acceptable_global_time, 1, 0))
+        self.assertEqual(list(bloom_filter.not_filter((message.packet,) for message in messages)), [])
+        self.assertEqual(node.call(lambda: sync_range.total), self._count_syncable(node))
+
+        # messages stored after loading the index are added incrementally
+        messages = [node.create_full_sync_text("Message #%d" % i, i + 10) for i in xrange(10, 20)]
+        node.give_messages(messages, node)
+
+        _, _, _, _, bloom_filter = node.call(sync_range.claim_sync_bloom_filter, 1, node.community.acceptable_global_time)
+        self.assertEqual(list(bloom_filter.not_filter((message.packet,) for message in messages)), [])
+        self.assertEqual(node.call(lambda: sync_range.total), self._count_syncable(node))
+
+    def test_undo(self):
+        """
+        NODE undoes messages, the index must no longer count them.
+        """
+        node, = self.create_nodes(1)
+        sync_range = node.community._sync_range
+
+        messages = [node.create_full_sync_text("Should undo #%d" % i, i + 10) for i in xrange(10)]
+        node.give_messages(messages, node)
+        node.call(sync_range.claim_sync_bloom_filter, 1, node.community.acceptable_global_time)
+
+        undoes = [node.create_undo_own(message, i + 100, i + 1) for i, message in enumerate(messages)]
+        node.give_messages(undoes, node)
+        node.assert_is_undone(messages=messages)
+
+        self.assertEqual(node.call(lambda: sync_range.total), self._count_syncable(node))
+
+    def test_range(self):
+        """
+        When not all packets fit, the claimed range must be made of whole buckets and every packet
+        in that range must be in the bloom filter.
+        """
+        node, = self.create_nodes(1)
+        sync_range = node.community._sync_range
+
+        messages = [node.create_full_sync_text("Message #%d" % i, i + 10) for i in xrange(50)]
+        node.give_messages(messages, node)
+
+        # pretend that only 20 packets fit in a bloom filter
+        sync_range._capacity = 20
+        node.call(sync_range.reset)
+
+        for pivot in (1, 15, 30, 45, 59, 100):
+            time_low, time_high, _, _, bloom_filter = node.call(sync_range.claim_sync_bloom_filter, pivot, node.community.acceptable_global_time)
+            packets = self._get_syncable_packets(node, time_low, time_high)
+            self.assertLessEqual(len(packets), 20)
+            self.assertGreater(len(packets), 0)
+            self.assertEqual(list(bloom_filter.not_filter((packet,) for packet in packets)), [])
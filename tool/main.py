@@ -9,6 +9,7 @@ import signal
 from twisted.internet import reactor
 from twisted.python.log import addObserver
 
+from ..database import DEFAULT_TUNING_PROFILE, TUNING_PROFILES
 from ..dispersy import Dispersy
 from ..endpoint import StandaloneEndpoint
 from ..logger import get_logger, get_context_filter
@@ -56,6 +57,7 @@ def main_real(setup=None):
     command_line_parser.add_option("--memory-dump", action="store_true", help="use meliae to dump the memory periodically", default=False)
     command_line_parser.add_option("--databasefile", action="store", help="use an alternate databasefile", default=u"dispersy.db")
     command_line_parser.add_option("--statedir", action="store", type="string", help="Use an alternate statedir", default=u".")
+    command_line_parser.add_option("--database-tuning", action="store", type="choice", choices=sorted(TUNING_PROFILES), help="the SQLite settings to use", default=DEFAULT_TUNING_PROFILE)
     command_line_parser.add_option("--ip", action="store", type="string", default="0.0.0.0", help="Dispersy uses this ip")
     command_line_parser.add_option("--port", action="store", type="int", help="Dispersy uses this UDL port", default=12345)
     command_line_parser.add_option("--script", action="store", type="string", help="Script to execute, i.e. module.module.class", default="")
@@ -85,7 +87,7 @@ def main_real(setup=None):
         addObserver(unhandled_error_observer)
 
     # setup
-    dispersy = Dispersy(StandaloneEndpoint(opt.port, opt.ip), unicode(opt.statedir), unicode(opt.databasefile))
+    dispersy = Dispersy(StandaloneEndpoint(opt.port, opt.ip), unicode(opt.statedir), unicode(opt.databasefile), database_tuning=unicode(opt.database_tuning))
     dispersy.statistics.enable_debug_statistics(opt.debugstatistics)
 
     def signal_handler(sig, frame):
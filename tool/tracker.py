@@ -35,9 +35,10 @@ from ..community import Community, HardKilledCommunity
 from ..conversion import BinaryConversion
 from ..crypto import NoVerifyCrypto, NoCrypto
 from ..dispersy import Dispersy
-from ..endpoint import StandaloneEndpoint
+from ..endpoint import StandaloneEndpoint, MmsgEndpoint
 from ..exception import ConversionNotFoundException, CommunityNotFoundException
 from ..logger import get_logger, get_context_filter
+from ..ratelimiter import RateLimiter
 
 
 COMMUNITY_CLEANUP_INTERVAL = 180.0
@@ -230,7 +231,7 @@ class TrackerCommunity(Community):
 class TrackerDispersy(Dispersy):
 
     def __init__(self, endpoint, working_directory, silent=False, crypto=NoVerifyCrypto()):
-        super(TrackerDispersy, self).__init__(endpoint, working_directory, u":memory:", crypto)
+        super(TrackerDispersy, self).__init__(endpoint, working_directory, u":memory:", crypto, database_tuning=u"tracker-in-memory")
 
         # location of persistent storage
         self._persistent_storage_filename = os.path.join(working_directory, "persistent-storage.data")
@@ -349,6 +350,9 @@ def main():
     command_line_parser.add_option("--port", action="store", type="int", help="Dispersy uses this UDL port", default=6421)
     command_line_parser.add_option("--silent", action="store_true", help="Prevent tracker printing to console", default=False)
     command_line_parser.add_option("--crypto", action="store", type="string", default="ECCrytpo", help="The Crypto object type Dispersy is going to use")
+    command_line_parser.add_option("--mmsg", action="store_true", help="receive and send packets in batches using recvmmsg/sendmmsg (Linux only)", default=False)
+    command_line_parser.add_option("--upload-rate", action="store", type="int", help="limit the upload bandwidth to this many bytes per second", default=0)
+    command_line_parser.add_option("--candidate-upload-rate", action="store", type="int", help="limit the upload bandwidth to each peer to this many bytes per second", default=0)
 
     context_filter = get_context_filter()
     command_line_parser.add_option("--log-identifier", type="string", help="this 'identifier' key is included in each log entry (i.e. it can be used in the logger format string)", default=context_filter.identifier)
@@ -369,7 +373,10 @@ def main():
 
     def run():
         # setup
-        dispersy = TrackerDispersy(StandaloneEndpoint(opt.port, opt.ip), unicode(opt.statedir), bool(opt.silent), crypto)
+        endpoint = MmsgEndpoint(opt.port, opt.ip) if opt.mmsg else StandaloneEndpoint(opt.port, opt.ip)
+        if opt.upload_rate or opt.candidate_upload_rate:
+            endpoint.set_rate_limiter(RateLimiter(opt.upload_rate or None, opt.candidate_upload_rate or None))
+        dispersy = TrackerDispersy(endpoint, unicode(opt.statedir), bool(opt.silent), crypto)
         container[0] = dispersy
         def signal_handler(sig, frame):
             logger.warning("Received signal '%s' in %s (shutting down)", sig, frame)